@@ -4,20 +4,46 @@ GUI for control of an Aladdin pump with the option to simultaneously
 control a VICI EUHA motorized valve.
 
 The GUI is implemented with Remi, and may be remote via TCP/IP
+
+All device I/O is done by one worker thread per device (Aladdin pump, EUHA
+valve), the GUI only queues commands and reads the last polled state, so that
+it never waits for a device. The events of the injection program are
+executed at their planned times by a scheduler thread; the program log file
+has the planned and actual time of each event, the time its device commands
+were done, and a timing report per cycle.
+
+The program can be replayed in virtual time, against device models, with
+FlowInjectPilot_replay.py (days in seconds). FlowInjectPilot_service.py runs
+the same app without GUI, controlled through a JSON REST/WebSocket API:
+the settings (menus, spin boxes) and the enabled state of the controls are
+plain attributes of the app, that the widgets show and the API reads.
+
+Runtime metrics (round trips, schedule lateness, program timing, errors)
+are served on the same port as /metrics (Prometheus text format) and
+/metrics.json
 """
 
 import sys
 import re
-from time import time, sleep
+import json
+import queue
+import threading
 from datetime import datetime
 
 import remi.gui as gui
 import remi
+import remi.server
 
 from remi_extras import LineWriterBox
 
-from devcomms.aladdin import Aladdin
 from devcomms.aladdin import serial
+from devcomms.aladdin_bus import AladdinBus
+from devcomms.aladdin_config import AladdinShadow
+# scheduling uses a monotonic clock, converted to wall time for display
+# (real time, or virtual time, see FlowInjectPilot_replay.py)
+from devcomms.timing import clock, sleep, wall_time, command_key, EventScheduler
+from devcomms.metrics import Registry
+from devcomms.worker import DeviceWorker
 
 
 ## choose between VICI_EUHA or VICI_TTL (migration from VICI_EUHA to VICI_TTL)
@@ -36,6 +62,8 @@ from devcomms.vici_ttl import VICI_TTL as VICI_control
 # server IP address, port
 IP_ADDRESS = '0.0.0.0' #localhost
 IP_PORT = 9013 # make sure that every instance has its own port!!
+# VICI EUHA valve control and program (set from IP_PORT, see __main__)
+VICI_EUHA_MODE = True
 
 # drop-down menu items and associated parameter strings
 # They are either simple lists (when the menu items are the strings)
@@ -60,10 +88,25 @@ syringetypes = list(syringetype_items.keys())
 
 pumprates = ['0.5', '1.0', '2.0', '4.0', '10.0', '20.0', '50.0']
 
+# ranges of the numeric settings (spin boxes): min, max, step
+fillvolume_range = (0.1, 15.0, 0.1) # ml
+progperiod_range = (5, 120, 1) # min.
+progstep_range = (1, 15, 1) # pre-fill, fill, post-fill (min.)
+
 # healthy pauses during Aladdin communication/operations
 ALADDIN_LONGSLEEP = 1.0
 ALADDIN_SHORTSLEEP = 0.2
 
+# pump activation: read the pump configuration (query sweep the first time,
+# a 3-query check at later activations) and only send the commands that
+# change something (shadow copy), instead of sending the complete
+# configuration sequence
+ALADDIN_SHADOW = True
+ALADDIN_VERIFY = False # read back (full sweep) and check after activation
+# commands in flight during sweeps; 1: one at a time (pipelining, > 1, is
+# only tested on the simulator, not yet on a real pump)
+ALADDIN_PIPELINE_DEPTH = 1
+
 # UI update schedule - used in idle(self)
 SCHEDULE_STEP = 1.0 # in seconds
 EUHA_SCHEDULE_STEP = 1.0 # in seconds
@@ -97,33 +140,94 @@ BKGND_COLOR = "rgb(255, 245, 195)"
 # Utility functions
 
 def isotimestr():
-    return datetime.now().isoformat().split('.')[0]
+    return datetime.fromtimestamp(wall_time(clock())).isoformat().split('.')[0]
 
 
 def isostamp(tstamp):
-    return datetime.fromtimestamp(tstamp).isoformat()
+    # tstamp: clock() time
+    return datetime.fromtimestamp(wall_time(tstamp)).isoformat()
 
 ####
 
 
 class AladdinPumpSteady(remi.App):
     def __init__(self, *args):
+        self.init_state()
+        super(AladdinPumpSteady, self).__init__(*args)
+
+
+    def init_state(self, euha_mode = None, instance = None):
+        # configuration of this instance (default: from the module settings)
+        self.euha_mode = VICI_EUHA_MODE if euha_mode is None else euha_mode
+        self.instance = str(IP_PORT) if instance is None else instance
+
         self.pump_reply_parse_re = re.compile(r"I(\d+\.?\d*)W(\d+\.?\d*)(UL|ML)")
 
         self.aladdin = None # this corresponds to unactivated Aladdin connection
+        self.shadow = None # shadow copy of the pump configuration
         self.activated = False # status of Aladdin communications
-        self.next_sched = 0.0 # just to initialize (contains time of next scheduled aladdin idle loop event)
+        self.pump_worker = None # device worker threads, created by main()
+        self.pump_seq = None # last pump state snapshot processed by idle
+        self.pump_nmissed = 0
 
         self.euha = None # this corresponds to unactivated VICI EUHA connection
         self.euha_activated = False  # status of VICI EUHA communications
-        self.euha_next_sched = 0.0
+        self.euha_worker = None
+        self.euha_seq = None
+        self.euha_nmissed = 0
+
+        self.logq = queue.Queue() # log lines, written to linewriter by idle
         
         self.program_running = False
+        self.prog_lock = threading.RLock() # program events and log file
         
         # set number of program cycles TODO: set this in UI!!!
         self.program_maxcycles = PROG_MAXCYCLES # 0 = indefinitely
-        
-        super(AladdinPumpSteady, self).__init__(*args)
+
+        # settings (set by the menus and spin boxes of the GUI, or by the
+        # API), used at activation and by the program
+        self.port_str = commports[0]
+        self.pumpid = pumpIDs[0]
+        self.syringetype = syringetypes[0]
+        self.fill_ml = 0.5
+        self.pumpratestr = pumprates[0] # this should be the lowest pump rate
+        self.euha_port_str = commports[0]
+        self.prog_period = 20. # program (min.)
+        self.prog_prefill = 1.
+        self.prog_fill = 1.
+        self.prog_postfill = 1.
+
+        # enabled state of the controls (see enable), shown by their widgets
+        # when there is a GUI (main)
+        self.enabled = {}
+        self.widgets = None # control name -> widgets
+        
+        self.init_metrics()
+
+
+    def init_metrics(self):
+        # runtime metrics, served as /metrics (Prometheus) and /metrics.json
+        self.metrics = Registry(const_labels = {'instance': self.instance})
+        m = self.metrics
+        self.m_aladdin_rtt = m.histogram('pilot_aladdin_roundtrip_seconds',
+                    'Aladdin command round trip (including bus queueing)', ['cmd'])
+        self.m_vici_rtt = m.histogram('pilot_vici_roundtrip_seconds',
+                    'VICI valve command round trip', ['cmd'])
+        self.m_lateness = m.histogram('pilot_schedule_lateness_seconds',
+                    'lateness of scheduled events', ['loop'])
+        self.m_missed = m.counter('pilot_schedule_missed_total',
+                    'scheduled events skipped (fast forward)', ['loop'])
+        self.m_prog_event = m.histogram('pilot_program_event_seconds',
+                    'time from planned program event to completion of its commands', ['event'])
+        self.m_prog_cycle = m.histogram('pilot_program_cycle_seconds',
+                    'time between successive injections',
+                    buckets = (60, 300, 600, 1200, 1800, 3600, 7200))
+        self.m_idle = m.histogram('pilot_idle_seconds',
+                    'duration of idle() calls')
+        self.m_errors = m.counter('pilot_errors_total',
+                    'errors and glitches', ['kind'])
+        self.m_state = m.gauge('pilot_state',
+                    'activated (1) or not (0)', ['what'])
 
 
 
@@ -131,12 +235,11 @@ class AladdinPumpSteady(remi.App):
         ### DEFINE GUI LAYOUT and WIDGETS
         
         
-        global VICI_EUHA_MODE
-        # use a global variable to indicate whether to activate 'DOUBLE' mode
+        # self.euha_mode indicates whether to activate 'DOUBLE' mode
         # (i.e. have room for VICI EUHA control)
         
         
-        if not VICI_EUHA_MODE:
+        if not self.euha_mode:
             containerw = 420
         else:
             containerw = 780
@@ -149,7 +252,7 @@ class AladdinPumpSteady(remi.App):
         doublebox = gui.HBox()
                
                 
-        if VICI_EUHA_MODE:
+        if self.euha_mode:
             vbox_main2 = gui.VBox()
             # set background color
             vbox_main2.css_background_color = BKGND_COLOR
@@ -209,7 +312,7 @@ class AladdinPumpSteady(remi.App):
             m2_hbox31 = gui.HBox()
             m2_hbox31.append(gui.Label('Period', 
                                     width=120))
-            self.m2_spin31 = gui.SpinBox(20, 5, 120, 1,
+            self.m2_spin31 = gui.SpinBox(self.prog_period, *progperiod_range,
                                  width=120)
             m2_hbox31.append(self.m2_spin31)
             m2_hbox31.append(gui.Label('min.'))
@@ -218,7 +321,7 @@ class AladdinPumpSteady(remi.App):
             m2_hbox32 = gui.HBox()
             m2_hbox32.append(gui.Label('Pre-fill', 
                                     width=120))
-            self.m2_spin32 = gui.SpinBox(1, 1, 15, 1,
+            self.m2_spin32 = gui.SpinBox(self.prog_prefill, *progstep_range,
                                  width=120)
             m2_hbox32.append(self.m2_spin32)
             m2_hbox32.append(gui.Label('min.'))
@@ -227,7 +330,7 @@ class AladdinPumpSteady(remi.App):
             m2_hbox33 = gui.HBox()
             m2_hbox33.append(gui.Label('Fill', 
                                     width=120))
-            self.m2_spin33 = gui.SpinBox(1, 1, 15, 1,
+            self.m2_spin33 = gui.SpinBox(self.prog_fill, *progstep_range,
                                  width=120)
             m2_hbox33.append(self.m2_spin33)
             m2_hbox33.append(gui.Label('min.'))
@@ -236,7 +339,7 @@ class AladdinPumpSteady(remi.App):
             m2_hbox34 = gui.HBox()
             m2_hbox34.append(gui.Label('Post-fill', 
                                     width=120))
-            self.m2_spin34 = gui.SpinBox(1, 1, 15, 1,
+            self.m2_spin34 = gui.SpinBox(self.prog_postfill, *progstep_range,
                                  width=120)
             m2_hbox34.append(self.m2_spin34)
             m2_hbox34.append(gui.Label('min.'))
@@ -293,7 +396,7 @@ class AladdinPumpSteady(remi.App):
         hbox14 = gui.HBox()
         hbox14.append(gui.Label('fill volume', 
                                 width=120))
-        self.spin14 = gui.SpinBox(0.5, 0.1, 15.0, 0.1,
+        self.spin14 = gui.SpinBox(self.fill_ml, *fillvolume_range,
                              width=120)
         hbox14.append(self.spin14)
         hbox14.append(gui.Label('ml'))
@@ -347,6 +450,7 @@ class AladdinPumpSteady(remi.App):
         self.linewriter = LineWriterBox(height=140,width=360,
                                         maxlines=80,
                                         reverse_out=True,
+                                        autoflush=False, # see flush_log
                             initlines=['New lines are added on top.',
                                        'read this from bottom to top',
                                        'if you want chronological order',
@@ -372,17 +476,35 @@ class AladdinPumpSteady(remi.App):
         
 
         ###########################
-        # set default values (before event handlers active)
+        # show the settings (before event handlers active)
         # (Q: does the set_value method trigger event handler?)
-        self.dmenu22.set_value(pumprates[0]) # this should be the lowest pump rate
-        
-        
+        self.dmenu11.set_value(self.port_str)
+        self.dmenu12.set_value(self.pumpid)
+        self.dmenu13.set_value(self.syringetype)
+        self.dmenu22.set_value(self.pumpratestr)
+        if self.euha_mode:
+            self.m2_dmenu11.set_value(self.euha_port_str)
+        
+        # widgets of the controls (see enable)
+        self.widgets = {'pump_activate': [self.button151],
+                        'pump_deactivate': [self.button152],
+                        'pump_settings': [self.dmenu11, self.dmenu12,
+                                          self.dmenu13, self.spin14],
+                        'pump_start': [self.button211],
+                        'pump_stop': [self.button212],
+                        'pump_rate': [self.dmenu22]}
+        if self.euha_mode:
+            self.widgets.update({'valve_activate': [self.m2_button151],
+                                 'valve_deactivate': [self.m2_button152],
+                                 'valve_port': [self.m2_dmenu11],
+                                 'valve_pos': [self.m2_button211,
+                                               self.m2_button212],
+                                 'program_start': [self.m2_button351],
+                                 'program_stop': [self.m2_button352]})
 
         ################################
         # INITIALIZE VALUES, SET STATEs 
-        self.deactivate()
-        if VICI_EUHA_MODE:
-            self.euha_deactivate()
+        self.init_workers()
         
         
         #################################
@@ -390,13 +512,18 @@ class AladdinPumpSteady(remi.App):
         # put all event handler initializations here, 
         # to be executed
         # only when all widgets have been created
+        self.dmenu11.onchange.do(self.port11)
+        self.dmenu12.onchange.do(self.pumpid12)
+        self.dmenu13.onchange.do(self.syringe13)
+        self.spin14.onchange.do(self.fillvolume14)
         self.button151.onclick.do(self.activate151)
         self.button152.onclick.do(self.deactivate152)
         self.button211.onclick.do(self.start211)
         self.button212.onclick.do(self.stop212)
         self.dmenu22.onchange.do(self.pumprate22)
         self.button41.onclick.do(self.close41)
-        if VICI_EUHA_MODE:
+        if self.euha_mode:
+            self.m2_dmenu11.onchange.do(self.m2_port11)
             self.m2_button151.onclick.do(self.m2_activate151)
             self.m2_button152.onclick.do(self.m2_deactivate152)
             self.m2_button211.onclick.do(self.m2_euha_posA_211)
@@ -412,168 +539,163 @@ class AladdinPumpSteady(remi.App):
         return cntr_main
 
 
+    def init_workers(self):
+        # device workers and program scheduler, controls in the deactivated
+        # state; called by main(), or instead of it (app without GUI)
+        self.pump_worker = self.new_worker('Aladdin')
+        self.euha_worker = self.new_worker('EUHA')
+        # program events are executed at their planned times by a thread
+        self.prog_sched = self.new_scheduler('program')
+        self.deactivate()
+        if self.euha_mode:
+            self.euha_deactivate()
+
+
+    def enable(self, **controls):
+        # enabled state of the controls (e.g. pump_start = False), and of
+        # their widgets
+        self.enabled.update(controls)
+        if self.widgets is None:
+            return
+        for name, enabled in controls.items():
+            for widget in self.widgets.get(name, []):
+                if widget.get_enabled() != enabled:
+                    widget.set_enabled(enabled)
+
+
 
     ###################
     #### Event loop, idle activity
 
     def idle(self):
-        global VICI_EUHA_MODE
-        
+        if self.pump_worker is None:
+            return # init_workers() not yet executed
+
+        t_idle = clock()
+
+        # all device I/O is done by the device workers: here, we only
+        # process the results (callbacks of finished commands, and the last
+        # polled state), and never wait for a device
+        self.pump_worker.process_done()
+        self.euha_worker.process_done()
+
         # HERE: monitor pump status when pump activated
-        # every SCHEDULE_STEP seconds
+        # every SCHEDULE_STEP seconds (polled by the pump worker)
         # update buttons color to reflect status
         # check dispensed volume
-        if self.activated:
-            t1 = time()
-            if t1 > self.next_sched:
-                # get pump state 
-                pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, 'DIS')
-                if pump_reply is None:
-                    self.linewriter.writeln('GLITCH: Aladdin comms lost')
-                    pump_status = '?'
-                else:
-                    # self.linewriter.writeln('status='+pump_status +
-                    #                       '    reply='+pump_reply)
-                    self.label4.set_text('pump status: '+pump_status +
-                                            '     ---- volumes: '+pump_reply)
-                    # change UI buttons state to reflect pump state
-                    if pump_status == 'W': # withdraw! => ERROR
-                        self.linewriter.writeln('ERROR: Withdraw activity detected. Stopping.')
-                        self.aladdin.pump_cmd(self.pumpid, 'STP')
-                    elif pump_status == 'I':
-                        self.button211.css_background_color = "rgb(0,200,0)"
-                        self.button212.css_background_color = ""
-                        self.dmenu22.set_enabled(False) # cannot change RATE when pumping
-                    elif pump_status == 'P' or pump_status == 'S':
-                        self.button211.css_background_color = ""
-                        self.button212.css_background_color = "rgb(220,0,0)"
-                        self.dmenu22.set_enabled(True) # OK to change RATE
-                    else:
-                        self.button211.css_background_color = ""
-                        self.button212.css_background_color = ""
+        snap = self.pump_worker.state
+        if self.activated and (snap is not None) and (snap.seq != self.pump_seq):
+            self.pump_seq = snap.seq
+            self.m_lateness.observe(snap.lateness, loop = 'aladdin')
+            self.m_missed.inc(self.pump_worker.nmissed - self.pump_nmissed,
+                              loop = 'aladdin')
+            self.pump_nmissed = self.pump_worker.nmissed
+            pump_status, pump_reply = snap.result or (None, None)
+            if pump_reply is None:
+                self.m_errors.inc(kind = 'glitch')
+                self.log('GLITCH: Aladdin comms lost')
+                pump_status = '?'
+            else:
+                # self.linewriter.writeln('status='+pump_status +
+                #                       '    reply='+pump_reply)
+                self.show_pump(pump_status, pump_reply)
+                # change UI buttons state to reflect pump state
+                if pump_status == 'W': # withdraw! => ERROR
+                    self.m_errors.inc(kind = 'withdraw')
+                    self.log('ERROR: Withdraw activity detected. Stopping.')
+                    self.pump_worker.submit(self.pump_cmd, 'STP')
+                elif pump_status == 'I':
+                    self.enable(pump_rate = False) # cannot change RATE when pumping
+                elif pump_status == 'P' or pump_status == 'S':
+                    self.enable(pump_rate = True) # OK to change RATE
                         
-                    # Check if total injected volume exceeds the initial fill volume
-                    # of the syringe.
-                    # Instead of relying entirely on the 'VOL' setting in the pump
-                    # controller (which stops the pump automatically), we explicitly
-                    # check here the injected volume. This is much safer, since
-                    # the 'VOL' dispense volume seems to be reset upon stopping
-                    # and restarting the pump, while the overall injected volume
-                    # reported by the pump is true to how much volume was injected
-                    # overal.
-                    # (1) decode pump_reply (using precompiled regex, which
-                    #      decomposes the useful information into groups)
-                    #      TODO: include this directly in aladdin.py
-                    prparse = self.pump_reply_parse_re.search(pump_reply)
-                    if prparse:
-                        injvol = float(prparse.group(1))
-                        # wdvol = float(prparse.group(2))
-                        units = prparse.group(3)
-                        if units==self.vol_units:
-                            if injvol >= self.volvalue:
-                                # END PUMPING!!
-                                self.linewriter.writeln('COMPLETE: syringe fill volume dispensed. deactivating.')
-                                self.linewriter.writeln('Change syringe.')
-                                self.deactivate()
-                            else:
-                                pass
-                                # business as usual (TODO: we could update display of injected volume
+                # Check if total injected volume exceeds the initial fill volume
+                # of the syringe.
+                # Instead of relying entirely on the 'VOL' setting in the pump
+                # controller (which stops the pump automatically), we explicitly
+                # check here the injected volume. This is much safer, since
+                # the 'VOL' dispense volume seems to be reset upon stopping
+                # and restarting the pump, while the overall injected volume
+                # reported by the pump is true to how much volume was injected
+                # overal.
+                # (1) decode pump_reply (using precompiled regex, which
+                #      decomposes the useful information into groups)
+                #      TODO: include this directly in aladdin.py
+                prparse = self.pump_reply_parse_re.search(pump_reply)
+                if prparse:
+                    injvol = float(prparse.group(1))
+                    # wdvol = float(prparse.group(2))
+                    units = prparse.group(3)
+                    if units==self.vol_units:
+                        if injvol >= self.volvalue:
+                            # END PUMPING!!
+                            self.log('COMPLETE: syringe fill volume dispensed. deactivating.')
+                            self.log('Change syringe.')
+                            self.deactivate()
                         else:
-                            self.linewriter.writeln('WARNING: pump VOL units do no match.')
+                            pass
+                            # business as usual (TODO: we could update display of injected volume
                     else:
-                        self.linewriter.writeln('WARNING: could not decode pump reply.')
-
-
-                # set time for next event
-                while t1 > self.next_sched: # fast forward if necessary, do not execute missed events, but keep rhythm!
-                    self.next_sched = self.next_sched + SCHEDULE_STEP
-                    
-        if VICI_EUHA_MODE and self.euha_activated: # the VICI_EUHA_MODE is redundant, in principle
-            t2 = time()
-            if t2 > self.euha_next_sched:
-                pos = self.euha.get_pos()
-                self.m2_label4.set_text(isotimestr()+\
-                                        ' - EUHA active. pos='+pos)
-                if pos == 'A':
-                    self.m2_button211.css_background_color = "rgb(0,200,0)"
-                    self.m2_button212.css_background_color = ""
-                elif pos == 'B':
-                    self.m2_button211.css_background_color = ""
-                    self.m2_button212.css_background_color = "rgb(0,200,0)"
+                        self.m_errors.inc(kind = 'units')
+                        self.log('WARNING: pump VOL units do no match.')
                 else:
-                    self.m2_button211.css_background_color = ""
-                    self.m2_button212.css_background_color = ""
-                    
-                # set time for next event
-                while t2 > self.euha_next_sched: # fast forward if necessary, do not execute missed events, but keep rhythm!
-                    self.euha_next_sched = self.euha_next_sched + SCHEDULE_STEP                
-                
-
-        if self.program_running:
-            # fast event processing (program stages)
-            t3 = time()
-            if t3 > self.prog_Tnext:
-                if self.prog_step==0:
-                    self.prog_step=1
-                    
-                    self.linewriter.writeln('PROGRAM EVENT: start pre-fill')
-                    self.aladdin.pump_cmd(self.pumpid, 'STP')
-                    self.euha.set_pos(EUHA_FILL_POSITION)
-
-                    self.prog_logfile.write(isostamp(t3)+'\t'+\
-                                            'pre-fill'+'\n')
-                    self.prog_Tnext = self.prog_Tnext + PROG_UI_TO_SECONDS*self.prog_prefill
-                elif self.prog_step==1:
-                    self.prog_step=2
-                    
-                    self.linewriter.writeln('PROGRAM EVENT: start fill')
-                    # self.euha.set_pos(EUHA_FILL_POSITION)
-                    self.aladdin.pump_cmd(self.pumpid, 'RUN')
-
-                    self.prog_logfile.write(isostamp(t3)+'\t'+\
-                                            'fill'+'\n')
-                    self.prog_Tnext = self.prog_Tnext + PROG_UI_TO_SECONDS*self.prog_fill
-                elif self.prog_step==2:
-                    self.prog_step=3
-                    
-                    self.linewriter.writeln('PROGRAM EVENT: start post-fill')
-                    # self.euha.set_pos(EUHA_FILL_POSITION)
-                    self.aladdin.pump_cmd(self.pumpid, 'STP')
-                    
-                    self.prog_logfile.write(isostamp(t3)+'\t'+\
-                                            'post-fill'+'\n')
-                    self.prog_Tnext = self.prog_Tnext + PROG_UI_TO_SECONDS*self.prog_postfill
-                elif self.prog_step==3:
-                    self.prog_step=0
-                    
-                    self.linewriter.writeln('PROGRAM EVENT: *** INJEKT and return to initial state ***')
-                    self.euha.set_pos(EUHA_REST_POSITION)
-                    # self.aladdin.pump_cmd(self.pumpid, 'STP')
-                    
-                    self.prog_logfile.write(isostamp(t3)+'\t'+\
-                                            'INJEKT'+'\n')
-                    self.prog_logfile.flush() # Flush so that the injection event is directly written to disk    
-                        
-                    self.prog_Tnext = self.prog_Tnext +\
-                        PROG_UI_TO_SECONDS*(self.prog_period-(self.prog_prefill+\
-                            self.prog_fill+self.prog_postfill))
-                    self.linewriter.writeln('next event (pre-fill): '+\
-    datetime.fromtimestamp(self.prog_Tnext).isoformat().split('T')[1])
-                        
-                    # complete cycle
-                    # max number of cycles
-                    self.program_cycles += 1
-                    if (self.program_maxcycles > 0)\
-                           and (self.program_cycles >= self.program_maxcycles):
-                        # end program
-                        t4 = time()
-                        self.prog_logfile.write(isostamp(t4)+'\t'+\
-                                                'Number of cycles reached. Ending program.'+'\n')
-                        # the following should work
-                        self.m2_stopprog352(None)   
-                    
-                    
+                    self.m_errors.inc(kind = 'decode')
+                    self.log('WARNING: could not decode pump reply.')
+
+
+        snap = self.euha_worker.state
+        if self.euha_mode and self.euha_activated\
+                and (snap is not None) and (snap.seq != self.euha_seq): # the euha_mode is redundant, in principle
+            self.euha_seq = snap.seq
+            self.m_lateness.observe(snap.lateness, loop = 'euha')
+            self.m_missed.inc(self.euha_worker.nmissed - self.euha_nmissed,
+                              loop = 'euha')
+            self.euha_nmissed = self.euha_worker.nmissed
+            pos = snap.result or '?'
+            self.show_valve(pos)
+            if pos not in ['A', 'B']:
+                self.m_errors.inc(kind = 'vici_pos')
+
+
+        if self.program_running and self.prog_end:
+            # number of cycles reached (see prog_cmd_done)
+            self.m2_stopprog352(None)
             
+        self.flush_log()
+        self.m_idle.observe(clock() - t_idle)
+
+
+    def show_pump(self, pump_status, pump_reply):
+        # GUI: pump status and volumes, button colors
+        if self.widgets is None:
+            return
+        self.label4.set_text('pump status: '+pump_status +
+                             '     ---- volumes: '+pump_reply)
+        if pump_status == 'I':
+            self.button211.css_background_color = "rgb(0,200,0)"
+            self.button212.css_background_color = ""
+        elif pump_status == 'P' or pump_status == 'S':
+            self.button211.css_background_color = ""
+            self.button212.css_background_color = "rgb(220,0,0)"
+        elif pump_status != 'W': # withdraw: unchanged (pump stopped)
+            self.button211.css_background_color = ""
+            self.button212.css_background_color = ""
+
+    def show_valve(self, pos):
+        # GUI: valve position, button colors
+        if self.widgets is None:
+            return
+        self.m2_label4.set_text(isotimestr()+\
+                                ' - EUHA active. pos='+pos)
+        if pos == 'A':
+            self.m2_button211.css_background_color = "rgb(0,200,0)"
+            self.m2_button212.css_background_color = ""
+        elif pos == 'B':
+            self.m2_button211.css_background_color = ""
+            self.m2_button212.css_background_color = "rgb(0,200,0)"
+        else:
+            self.m2_button211.css_background_color = ""
+            self.m2_button212.css_background_color = ""
         
 
 
@@ -581,29 +703,41 @@ class AladdinPumpSteady(remi.App):
     ###################
     #### EVENT HANDLERS
     
+    def port11(self, widget, value):
+        self.port_str = value
+
+    def pumpid12(self, widget, value):
+        self.pumpid = value
+
+    def syringe13(self, widget, value):
+        self.syringetype = value
+
+    def fillvolume14(self, widget, value):
+        self.fill_ml = float(value)
+
     def activate151(self, widget):
         self.activate()
        
     def deactivate152(self, widget):
         #TODO dialogue: ARE YOU SURE?
         self.deactivate()
-        self.linewriter.writeln('Aladdin pump comms deactivated')
+        self.log('Aladdin pump comms deactivated')
 
     def start211(self, widget):
-        self.linewriter.writeln('Start pump command')
-        self.dmenu22.set_enabled(False) # cannot change RATE when pumping
-        self.start_pump()
+        self.log('Start pump command')
+        self.enable(pump_rate = False) # cannot change RATE when pumping
+        self.pump_worker.submit(self.start_pump)
 
 
     def stop212(self, widget):
-        self.linewriter.writeln('Stop command')
-        self.stop_pump()
-        self.dmenu22.set_enabled(True) # OK to change RATE
+        self.log('Stop command')
+        self.pump_worker.submit(self.stop_pump)
+        self.enable(pump_rate = True) # OK to change RATE
         
     def pumprate22(self, widget, value):
         self.pumpratestr = value
-        self.linewriter.writeln('new pump rate: '+self.pumpratestr)
-        self.updatepumprate()
+        self.log('new pump rate: '+self.pumpratestr)
+        self.pump_worker.submit(self.updatepumprate, self.pumpratestr)
         
     def close41(self, widget):
         closedialog = gui.GenericDialog('Please confirm',
@@ -615,18 +749,29 @@ class AladdinPumpSteady(remi.App):
         print('Application is being terminated')
         #stop pump deactivate comms
         # enter deactivated state
-        if VICI_EUHA_MODE:
+        if self.euha_mode:
             self.euha_deactivate()
         self.deactivate()
+        # wait for the device workers to finish (closing the ports)
+        self.prog_sched.stop()
+        self.pump_worker.stop()
+        self.euha_worker.stop()
         sleep(ALADDIN_LONGSLEEP) 
         self.close()
         
     def m2_check_spin3x(self, widget, value):
         self.m2_getvalues_spin3x()
+        if self.check_prog_period():
+            self.m2_spin31.set_value(self.prog_period)
+
+    def check_prog_period(self):
+        # the period should leave time for the injection (corrected if
+        # not, returns True then)
         total_preinjekt = self.prog_prefill+self.prog_fill+self.prog_postfill
         if (self.prog_period < PROG_INJEKT_MIN+total_preinjekt):
             self.prog_period = PROG_INJEKT_MIN+total_preinjekt
-            self.m2_spin31.set_value(self.prog_period)
+            return True
+        return False
     
     def m2_getvalues_spin3x(self):
         self.prog_period = float(self.m2_spin31.get_value())
@@ -640,164 +785,188 @@ class AladdinPumpSteady(remi.App):
         if self.program_running:
             # quick protection against multiple RUN PROGRAMS
             return
-        if (self.aladdin is None) or (self.euha is None):
-            self.linewriter.writeln('Activate both Aladdin and VICI EUHA...')
+        if not (self.activated and self.euha_activated):
+            self.log('Activate both Aladdin and VICI EUHA...')
             return
         
         
-        self.linewriter.writeln('RUN PROGRAM')
+        self.log('RUN PROGRAM')
         
-        self.aladdin.pump_cmd(self.pumpid, 'STP')
-        self.euha.set_pos(EUHA_REST_POSITION)
-        self.linewriter.writeln('pump stopped. valve in rest position')
+        self.pump_worker.submit(self.pump_cmd, 'STP')
+        self.euha_worker.submit(self.euha_set_pos, EUHA_REST_POSITION)
+        self.log('pump stopped. valve in rest position')
 
-        self.m2_getvalues_spin3x()
-        
-        t0 = time()
-        # intialize log file
-        logfname = 'program_log_'+\
-   datetime.fromtimestamp(t0).strftime('%y%m%d_%H%M%S')+'.txt'
+        t0 = clock()
+        # intialize log file (one per instance: several may run at once)
+        logfname = 'program_log_'+self.instance+'_'+\
+   datetime.fromtimestamp(wall_time(t0)).strftime('%y%m%d_%H%M%S')+'.txt'
         self.prog_logfile = open(logfname, 'w')
+        self.prog_logfile.write('# time\tevent\tplanned\tlateness (ms)\t'
+                                'commands done (ms after planned)\n')
         
         # Set UI button to active (Green)
-        self.m2_button351.css_background_color = "rgb(0,200,0)"
+        if self.widgets is not None:
+            self.m2_button351.css_background_color = "rgb(0,200,0)"
         
         # max number of cycles
         self.program_cycles = 0
-        self.linewriter.writeln('Max. number of cycles: {0:d} !!! '
+        self.prog_t_injekt = None
+        self.log('Max. number of cycles: {0:d} !!! '
                                     .format(self.program_maxcycles))
         
         # initialize program
-        self.prog_step = 0
+        self.prog_recs = [] # program events of the current cycle(s)
+        self.prog_end = False
         Tnext = t0+PROG_PRE_ROLL_S
-        self.prog_Tnext = Tnext
         self.program_running = True
+        self.prog_sched.at(Tnext, self.prog_event, 0)
         
-        self.linewriter.writeln('next event (pre-fill): '+\
-            datetime.fromtimestamp(self.prog_Tnext).isoformat().split('T')[1])
+        self.log('next event (pre-fill): '+\
+            datetime.fromtimestamp(wall_time(Tnext)).isoformat().split('T')[1])
         
        
     def m2_stopprog352(self, widget):
         if not self.program_running:
             # quick protection against multiple END PROGRAMS
             return
-        self.program_running = False
-        self.prog_logfile.close()
-        self.linewriter.writeln('END PROGRAM')
+        with self.prog_lock:
+            self.program_running = False
+            self.prog_sched.cancel()
+            self.prog_logfile.close()
+        self.log('END PROGRAM')
         
-        self.aladdin.pump_cmd(self.pumpid, 'STP')
-        self.euha.set_pos(EUHA_REST_POSITION)
-        self.linewriter.writeln('pump stopped. valve in rest position')
+        self.pump_worker.submit(self.pump_cmd, 'STP')
+        self.euha_worker.submit(self.euha_set_pos, EUHA_REST_POSITION)
+        self.log('pump stopped. valve in rest position')
         
         # Set UI button to inactive (default colour)
-        self.m2_button351.css_background_color = ""
+        if self.widgets is not None:
+            self.m2_button351.css_background_color = ""
     
     ####################
     #### DEEPER FUNCTIONS
     
 
     def deactivate(self):
-        if self.activated:
-             self.aladdin.pump_cmd(self.pumpid, 'STP') # stop pump 
-        if self.aladdin is not None: # a COM port is active
-            # stop everything (if activated)
-            # free COM port (destroy object?)
-            #TODO: UI should react immediately?
-            #    current the UI is only update after this handler exits.
-            #  
-            #   this will require re-programming =>
-            #    put all real pump action in the 'idle' via a message queue
-            self.aladdin.close()
-            sleep(ALADDIN_SHORTSLEEP) # give some time to close?
-            self.aladdin = None # unbind object
+        # the pump worker stops the pump and closes the port,
+        # the UI enters the 'deactivated' state immediately
+        self.pump_worker.clear_poll()
+        self.pump_worker.submit(self.pump_close, self.activated)
 
         # put UI in 'deactivated' state
-        #self.button152.css_background_color = "rgb(255,0,0)"
-        self.button151.css_background_color = ""
-        self.button151.set_enabled(True)
-        self.button152.set_enabled(False)
-        self.dmenu11.set_enabled(True)
-        self.dmenu12.set_enabled(True)
-        self.dmenu13.set_enabled(True)
-        self.spin14.set_enabled(True)
-        self.button211.set_enabled(False)
-        self.button212.set_enabled(False)
-        self.dmenu22.set_enabled(False)
-        
-        #
-        self.label4.set_text('Aladdin pump comms inactive')
-        
+        self.enable(pump_activate = True, pump_deactivate = False,
+                    pump_settings = True, pump_start = False,
+                    pump_stop = False, pump_rate = False)
+        if self.widgets is not None:
+            #self.button152.css_background_color = "rgb(255,0,0)"
+            self.button151.css_background_color = ""
+            self.label4.set_text('Aladdin pump comms inactive')
+
         # set 'deactivated' state
         self.activated = False
-        
-        
+
+
     def activate(self):
         # enter transition between deactivate and activated state
-        self.button151.css_background_color = "rgb(0,200,0)"
-        self.button152.css_background_color = ""
-        self.button151.set_enabled(False)
-        self.dmenu11.set_enabled(False)
-        self.dmenu12.set_enabled(False)
-        self.dmenu13.set_enabled(False)
-        self.spin14.set_enabled(False)
-        
-        # get configuration from UI
-        self.linewriter.writeln('***CONFIGURATION***')
-        self.linewriter.writeln('comm port   :'+ self.dmenu11.get_value())
-        self.linewriter.writeln('pump ID     :'+ self.dmenu12.get_value())
-        self.linewriter.writeln('syringe     :'+ self.dmenu13.get_value())
+        if self.widgets is not None:
+            self.button151.css_background_color = "rgb(0,200,0)"
+            self.button152.css_background_color = ""
+        self.enable(pump_activate = False, pump_settings = False)
+
+        # configuration (settings)
+        self.log('***CONFIGURATION***')
+        self.log('comm port   :'+ self.port_str)
+        self.log('pump ID     :'+ self.pumpid)
+        self.log('syringe     :'+ self.syringetype)
         #self.linewriter.writeln('        ALADDIN='+
-        #                         syringetype_items[self.dmenu13.get_value()])
-        self.linewriter.writeln('fill volume :'+ self.spin14.get_value()) # this is also a string, to be converted
-        self.linewriter.writeln('*******************')
+        #                         syringetype_items[self.syringetype])
+        self.log('fill volume :'+ str(self.fill_ml))
+        self.log('*******************')
 
-        initialization_OK = False
-        
         # PUMP INITIALIZATION
-        # get configuration from UI (for real)
-        self.port_str = self.dmenu11.get_value()
-        self.pumpid = self.dmenu12.get_value()
-        self.syringetype = self.dmenu13.get_value()
         aladdin_syringe_cmd = syringetype_items[self.syringetype]
-        self.pumpratestr = self.dmenu22.get_value()
-        
+
+        # the pump worker does the rest; activate_done is called (from
+        # idle) when finished
+        self.pump_worker.submit(self.pump_activate, aladdin_syringe_cmd,
+                                self.fill_ml, callback = self.activate_done)
+
+
+    def activate_done(self, fut):
+        try:
+            initialization_OK = fut.result()
+        except Exception as ex:
+            self.log('ERROR: pump initialization: '+ str(ex))
+            initialization_OK = False
+
+        # if OK then set pump control UI buttons color
+        # if not OK then re-deactivate
+        if not initialization_OK:
+            self.deactivate()
+        else:
+            # fully enter 'activated' state
+            self.enable(pump_deactivate = True, pump_start = True,
+                        pump_stop = True, pump_rate = True)
+            self.pump_worker.set_poll(self.pump_poll, SCHEDULE_STEP)
+            self.activated = True
+
+
+    ####################
+    #### PUMP WORKER FUNCTIONS
+    # These are executed by the pump worker thread (the only thread that
+    # talks to the pump). They do not touch the widgets, and log via
+    # self.log()
+
+    def pump_activate(self, aladdin_syringe_cmd, fill_ml):
+        initialization_OK = False
+
         # 1. Open serial comms via Aladdin instance
         assert self.aladdin == None, 'aladdin connection already existing? (should not happen)'
 
         try:
-            self.aladdin = Aladdin(self.port_str)
-            self.linewriter.writeln('SUCCESS: serial comms port initialized.')
+            self.aladdin = self.open_pump(self.port_str)
+            self.log('SUCCESS: serial comms port initialized.')
             initialization_OK = True
         except serial.serialutil.SerialException:
-            self.linewriter.writeln('ERROR: Could not initialize serial comms port.')
+            self.log('ERROR: Could not initialize serial comms port.')
             initialization_OK = False
-            
+
         # 2. Initialization routine
         # currently this is the basic sequence from aladdin-pilot2-dev3
+        sent = None # commands sent in shadow mode
         if initialization_OK:
-            for cmdstr in [
+            cmdstrs = [
                     # step 1: prepare stopped pump
                     'VER','VER','STP', # make sure pump communicating and stopped (todo check expected responses)
-                    
+
                     # step 2: check preferences!
                     'PF',#todo if not OK, set value (THIS SHOULD BE 0, the pump should stop after power disruption)
-                    
+
                     # step 2: reset program
                     # overwrite current program with standard 'unprogrammed' operation
                     # I do not know how to delete steps from program via RS232
                     'PHN2','FUNSTP', # second phase stop pump 'end program?)
                     'PHN1','FUNRAT','VOL0.0', # first phase: infinite injection
-                    
+
                     # step 3: with the standard program in place, we can use pump as normal
                     aladdin_syringe_cmd, # select syringe diameter - this control units for VOL
                     'RAT'+self.pumpratestr+'UM', # rate
                     'DIRINF', # inject
                     'CLDINF', # clear dispensed volume (inject)
-                    ]:
+                    ]
+            if ALADDIN_SHADOW:
+                sent = self.shadow_activate(cmdstrs)
+                if sent is not None:
+                    cmdstrs = [] # done
+                    if any(reply is None for _, _, reply in sent):
+                        self.log('ERROR: Pump not responding (check port & pumpID)')
+                        initialization_OK = False
+        if initialization_OK:
+            for cmdstr in cmdstrs:
                 #self.linewriter.writeln('===============')
-                self.linewriter.writeln('cmdstr = '+ cmdstr)
+                self.log('cmdstr = '+ cmdstr)
                 try:
-                    pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, cmdstr)
+                    pump_status, pump_reply = self.pump_cmd(cmdstr)
                 except AssertionError:
                     # during initialization, apparent comm errors can occur
                     # if trying to communicate with a connected device that is
@@ -807,37 +976,42 @@ class AladdinPumpSteady(remi.App):
                     print('Unexpected reply from connected device (not an Aladdin pump)')
                     pump_reply = None
                 if pump_reply is None:
-                    self.linewriter.writeln('ERROR: Pump not responding (check port & pumpID)')
+                    self.log('ERROR: Pump not responding (check port & pumpID)')
                     initialization_OK = False
                     break
                 else:
-                    self.linewriter.writeln('    reply = '+ pump_reply+  
+                    self.log('    reply = '+ pump_reply+
                                             '    status = '+pump_status)
                     #self.linewriter.writeln('================')
 
-        # if still OK then get VOL units 
-        if initialization_OK:
+        # if still OK then get VOL units
+        # (the shadow copy has them, unless the syringe diameter changed)
+        if initialization_OK and (sent is not None)\
+                and not any(c.startswith('DIA') for c, _, _ in sent):
+            self.vol_units = self.shadow.units
+            self.log('VOL units   :'+ self.vol_units)
+        elif initialization_OK:
             cmdstr = 'DIS'
-            self.linewriter.writeln('cmdstr = '+ cmdstr)
-            pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, cmdstr)
+            self.log('cmdstr = '+ cmdstr)
+            pump_status, pump_reply = self.pump_cmd(cmdstr)
             if pump_reply is None:
-                self.linewriter.writeln('ERROR: Pump not responding (check port & pumpID)')
+                self.log('ERROR: Pump not responding (check port & pumpID)')
                 initialization_OK = False
             else:
-                self.linewriter.writeln('    reply = '+ pump_reply+  
+                self.log('    reply = '+ pump_reply+
                                         '    status = '+pump_status)
                 self.vol_units = pump_reply[-2:]
                 if self.vol_units not in ['UL','ML']:
-                    self.linewriter.writeln('ERROR: unrecognized volume (VOL) units')
+                    self.log('ERROR: unrecognized volume (VOL) units')
                     initialization_OK = False
-       
+
         # if still OK then set VOL
         if initialization_OK:
             # UI is always in ML, apply conversion to UL for pump if necessary
             #  vol_units are the pump volume units
             #  volvalue has the same units as pump units
             unitconv = 1000 if self.vol_units=='UL' else 1
-            self.volvalue = float(self.spin14.get_value()) * unitconv
+            self.volvalue = fill_ml * unitconv
             # self.linewriter.writeln('volvalue = {0:.2f} {1:s}'\
             #                         .format(self.volvalue, self.vol_units))
             cmdstr = 'VOL{0:.2f}'.format(self.volvalue)
@@ -845,53 +1019,134 @@ class AladdinPumpSteady(remi.App):
                 cmdstr = cmdstr[0:8]
                 if cmdstr[7]=='.':
                     cmdstr = cmdstr[0:7]
-            self.linewriter.writeln('cmdstr = '+ cmdstr)
-            pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, cmdstr)
+            if sent is not None:
+                # only if changed
+                sent = self.shadow_apply([cmdstr])
+                pump_status, pump_reply = sent[0][1:] if sent else ('', '')
+            else:
+                self.log('cmdstr = '+ cmdstr)
+                pump_status, pump_reply = self.pump_cmd(cmdstr)
             if pump_reply is None:
-                self.linewriter.writeln('ERROR: Pump not responding (check port & pumpID)')
+                self.log('ERROR: Pump not responding (check port & pumpID)')
                 initialization_OK = False
+            elif sent is not None:
+                pass # logged by shadow_apply
             else:
                 #TODO!!!! check if no pump error code
                 # setting an illegal volume returns a pump error!!
-                self.linewriter.writeln('    reply = '+ pump_reply+  
+                self.log('    reply = '+ pump_reply+
                                         '    status = '+pump_status)
-    
-        # if OK then set pump control UI buttons color
-        # if not OK then re-deactivate
-        if not initialization_OK:
-            self.deactivate()
-        else:
-            # fully enter 'activated' state
-            self.button152.set_enabled(True)
-            self.button211.set_enabled(True)
-            self.button212.set_enabled(True)
-            self.dmenu22.set_enabled(True)
-            self.next_sched = time() + SCHEDULE_STEP
-            self.activated = True
 
+        # optionally, read back the configuration
+        if initialization_OK and (sent is not None) and ALADDIN_VERIFY:
+            t = clock()
+            errors = self.shadow.verify()
+            self.m_aladdin_rtt.observe(clock() - t, cmd = 'VERIFY')
+            for error in errors:
+                self.m_errors.inc(kind = 'verify')
+                self.log('ERROR: verify: '+ error)
+            if errors:
+                initialization_OK = False
+            else:
+                self.log('configuration verified')
+
+        return initialization_OK
+
+
+    def pump_close(self, stop):
+        if stop and (self.aladdin is not None):
+             self.pump_cmd('STP') # stop pump
+        if self.shadow is not None:
+            # the pump may change while the port is closed (syringe swap,
+            # power cycle, front panel): read it again at next activation
+            self.shadow.invalidate()
+            self.shadow = None
+        if self.aladdin is not None: # a COM port is active
+            # stop everything (if activated)
+            # free COM port (destroy object?)
+            self.aladdin.close()
+            sleep(ALADDIN_SHORTSLEEP) # give some time to close?
+            self.aladdin = None # unbind object
+
+
+    def pump_poll(self):
+        # get pump state (polled every SCHEDULE_STEP, result in
+        # pump_worker.state, see idle)
+        return self.pump_cmd('DIS')
+
+
+    def shadow_activate(self, cmdstrs):
+        # Pipelined query sweep, then only the commands that change the
+        # pump configuration. Returns
+        # [(cmdstr, status, reply)] of the commands sent, or None if the
+        # sweep did not work (use the full sequence instead).
+        self.shadow = AladdinShadow.get(self.aladdin, self.pumpid,
+                                        ALADDIN_PIPELINE_DEPTH)
+        t = clock()
+        try:
+            ok = self.shadow.refresh()
+        except AssertionError:
+            print('Unexpected reply from connected device (not an Aladdin pump)')
+            self.shadow.valid = False
+            ok = False
+        self.m_aladdin_rtt.observe(clock() - t, cmd = 'SWEEP')
+        if not ok:
+            self.log('WARNING: configuration sweep failed.')
+            self.shadow = None
+            return None
+        self.log('pump        :'+ self.shadow.version)
+        # VOL is set to the fill volume afterwards (same phase)
+        return self.shadow_apply([c for c in cmdstrs if c != 'VOL0.0'])
+
+    def shadow_apply(self, cmdstrs):
+        t = clock()
+        sent = self.shadow.apply(cmdstrs)
+        if sent:
+            self.m_aladdin_rtt.observe(clock() - t, cmd = 'APPLY')
+        for cmdstr, pump_status, pump_reply in sent:
+            self.log('cmdstr = '+ cmdstr)
+            if pump_reply is None:
+                self.m_errors.inc(kind = 'no_reply')
+            else:
+                self.log('    reply = '+ pump_reply+  
+                                        '    status = '+pump_status)
+        self.log('{0:d} command(s) sent (shadow copy)'\
+                                .format(len(sent)))
+        return sent
+
+    def pump_cmd(self, cmdstr):
+        # all Aladdin commands of the app go through here (for the metrics)
+        t = clock()
+        pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, cmdstr)
+        self.m_aladdin_rtt.observe(clock() - t, cmd = command_key(cmdstr))
+        if pump_reply is None:
+            self.m_errors.inc(kind = 'no_reply')
+        if self.shadow is not None:
+            self.shadow.note(cmdstr, pump_status, pump_reply)
+        return pump_status, pump_reply
 
     def start_pump(self):
-        pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, 'RUN')
+        pump_status, pump_reply = self.pump_cmd('RUN')
         # no checks yet, just send command
         # if successful, the status should update itself (see idle)
         
     def stop_pump(self):
-        pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, 'STP')
+        pump_status, pump_reply = self.pump_cmd('STP')
         # no checks yet, just send command
         # if successful, the status should update itself (see idle)
         
-    def updatepumprate(self):
-        cmdstr = 'RAT'+self.pumpratestr+'UM'
-        pump_status, pump_reply = self.aladdin.pump_cmd(self.pumpid, cmdstr)
+    def updatepumprate(self, pumpratestr):
+        cmdstr = 'RAT'+pumpratestr+'UM'
+        pump_status, pump_reply = self.pump_cmd(cmdstr)
         # no checks yet, just send command and print return
         # WARNING for best performance, we should check and set pump rate
         # menu to the value reported back by the pump
         # The pump rate can not be changed when pumping
-        self.linewriter.writeln('cmdstr = '+ cmdstr)
+        self.log('cmdstr = '+ cmdstr)
         if pump_reply is None:
-            self.linewriter.writeln('ERROR: Pump not responding (check port & pumpID)')
+            self.log('ERROR: Pump not responding (check port & pumpID)')
         else:
-            self.linewriter.writeln('    reply = '+ pump_reply+  
+            self.log('    reply = '+ pump_reply+  
                                     '    status = '+pump_status)
             #self.linewriter.writeln('================')
             
@@ -905,21 +1160,24 @@ class AladdinPumpSteady(remi.App):
     ###################
     #### EUHA EVENT HANDLERS
     
+    def m2_port11(self, widget, value):
+        self.euha_port_str = value
+
     def m2_activate151(self, widget):
-        self.linewriter.writeln(isotimestr()+' EUHA activate')
+        self.log(isotimestr()+' EUHA activate')
         self.euha_activate()
 
        
     def m2_deactivate152(self, widget):
-        self.linewriter.writeln(isotimestr()+' EUHA deactivate')
+        self.log(isotimestr()+' EUHA deactivate')
         self.euha_deactivate()
 
     def m2_euha_posA_211(self, widget):
-        self.linewriter.writeln(isotimestr()+' EUHA pos. A')
+        self.log(isotimestr()+' EUHA pos. A')
         self.euha_posA()
 
     def m2_euha_posB_212(self, widget):
-        self.linewriter.writeln(isotimestr()+' EUHA pos. B')
+        self.log(isotimestr()+' EUHA pos. B')
         self.euha_posB()
 
 
@@ -929,73 +1187,53 @@ class AladdinPumpSteady(remi.App):
     
 
     def euha_deactivate(self):
-        if self.euha_activated:
-            self.euha.set_pos(EUHA_REST_POSITION)
-            assert self.euha.get_pos()=='B', 'Something very wrong with EUHA Valve... cannot move'
+        # the EUHA worker returns the valve to rest and closes the port,
+        # the UI enters the 'deactivated' state immediately
+        self.euha_worker.clear_poll()
+        self.euha_worker.submit(self.vici_close, self.euha_activated)
 
         # set 'deactivated' state
         self.euha_activated = False
 
-        if self.euha is not None: # a COM port is active
-            self.euha.close()
-            sleep(ALADDIN_SHORTSLEEP) # give some time to close?
-            self.euha = None # unbind object
-
         # put UI in 'deactivated' state
-        #self.button152.css_background_color = "rgb(255,0,0)"
-        self.m2_button151.css_background_color = ""
-        self.m2_button151.set_enabled(True)
-        self.m2_button152.set_enabled(False)
-        self.m2_dmenu11.set_enabled(True)
-        self.m2_button211.set_enabled(False)
-        self.m2_button212.set_enabled(False)
-        
-        self.m2_button351.set_enabled(False)
-        self.m2_button352.set_enabled(False)
-
-        self.m2_label4.set_text('EUHA comms inactive')
+        self.enable(valve_activate = True, valve_deactivate = False,
+                    valve_port = True, valve_pos = False,
+                    program_start = False, program_stop = False)
+        if self.widgets is not None:
+            #self.button152.css_background_color = "rgb(255,0,0)"
+            self.m2_button151.css_background_color = ""
+            self.m2_label4.set_text('EUHA comms inactive')
         
 
         
         
     def euha_activate(self):
         # enter transition between deactivate and activated state
-        self.m2_button151.css_background_color = "rgb(0,200,0)"
-        self.m2_button152.css_background_color = ""
-        self.m2_button151.set_enabled(False)
-        self.m2_dmenu11.set_enabled(False)
+        if self.widgets is not None:
+            self.m2_button151.css_background_color = "rgb(0,200,0)"
+            self.m2_button152.css_background_color = ""
+        self.enable(valve_activate = False, valve_port = False)
 
-        # get configuration from UI
-        self.linewriter.writeln('***EUHA CONFIGURATION***')
-        self.linewriter.writeln('comm port   :'+ self.m2_dmenu11.get_value())
-        self.linewriter.writeln('*******************')
+        # configuration (settings)
+        self.log('***EUHA CONFIGURATION***')
+        self.log('comm port   :'+ self.euha_port_str)
+        self.log('*******************')
 
 
         
         # EUHA INITIALIZATION
-        # get configuration from UI (for real)
-        self.euha_port_str = self.m2_dmenu11.get_value()
+        # the EUHA worker does the rest; euha_activate_done is called (from
+        # idle) when finished
+        self.euha_worker.submit(self.vici_activate,
+                                callback = self.euha_activate_done)
 
-        
-        # 1. Open serial comms via Aladdin instance
-        assert self.euha == None, 'EUHA connection already existing? (should not happen)'
 
-        initialization_OK = False
-      
+    def euha_activate_done(self, fut):
         try:
-            self.euha = VICI_control(self.euha_port_str)
-            initialization_OK = True
+            initialization_OK = fut.result()
         except Exception as ex:
-            self.linewriter.writeln('EUHA init error: '+str(ex))
-            self.euha = None
+            self.log('EUHA init error: '+str(ex))
             initialization_OK = False
-        
-        
-        # 2. Initialization routine
-        if initialization_OK:
-            self.euha.set_pos(EUHA_REST_POSITION)
-            assert self.euha.get_pos()=='B', 'Something very wrong with EUHA Valve... cannot move'
-           
 
         # if OK then set pump control UI buttons color
         # if not OK then re-deactivate
@@ -1003,24 +1241,230 @@ class AladdinPumpSteady(remi.App):
             self.euha_deactivate()
         else:
             # fully enter 'activated' state
-            self.m2_button152.set_enabled(True)
-            self.m2_button211.set_enabled(True)
-            self.m2_button212.set_enabled(True)
-                    
-            self.m2_button351.set_enabled(True)
-            self.m2_button352.set_enabled(True)
+            self.enable(valve_deactivate = True, valve_pos = True,
+                        program_start = True, program_stop = True)
             
             self.euha_activated = True
-            self.euha_next_sched = time() + EUHA_SCHEDULE_STEP
-            self.linewriter.writeln('EUHA valve comms successfully activated!')
-            self.linewriter.writeln('EUHA valve position: '+self.euha.get_pos())
-            
+            self.euha_worker.set_poll(self.euha_get_pos, EUHA_SCHEDULE_STEP)
+            self.log('EUHA valve comms successfully activated!')
+
+
+    ####################
+    #### EUHA WORKER FUNCTIONS
+    # executed by the EUHA worker thread (see PUMP WORKER FUNCTIONS)
+
+    def vici_activate(self):
+        # 1. Open serial comms via VICI_control instance
+        assert self.euha == None, 'EUHA connection already existing? (should not happen)'
+
+        try:
+            self.euha = self.open_valve(self.euha_port_str)
+        except Exception as ex:
+            self.log('EUHA init error: '+str(ex))
+            self.euha = None
+            return False
+
+        # 2. Initialization routine
+        try:
+            self.euha_set_pos(EUHA_REST_POSITION)
+            pos = self.euha_get_pos()
+            assert pos=='B', 'Something very wrong with EUHA Valve... cannot move'
+        except Exception:
+            self.vici_close(False)
+            raise
+        self.log('EUHA valve position: '+pos)
+        return True
+
+    def vici_close(self, rest):
+        if rest and (self.euha is not None):
+            self.euha_set_pos(EUHA_REST_POSITION)
+            assert self.euha_get_pos()=='B', 'Something very wrong with EUHA Valve... cannot move'
+
+        if self.euha is not None: # a COM port is active
+            self.euha.close()
+            sleep(ALADDIN_SHORTSLEEP) # give some time to close?
+            self.euha = None # unbind object
+
+    def euha_get_pos(self):
+        t = clock()
+        pos = self.euha.get_pos()
+        self.m_vici_rtt.observe(clock() - t, cmd = 'get_pos')
+        return pos
+
+    def euha_set_pos(self, pos):
+        t = clock()
+        self.euha.set_pos(pos)
+        self.m_vici_rtt.observe(clock() - t, cmd = 'set_pos')
+
     def euha_posA(self):
-        self.euha.set_pos('A')
+        self.euha_worker.submit(self.euha_set_pos, 'A')
         
     def euha_posB(self):
-        self.euha.set_pos('B')
-        
+        self.euha_worker.submit(self.euha_set_pos, 'B')
+
+
+    ####################
+    #### Workers, scheduler, devices
+    # (replaced by virtual time versions in FlowInjectPilot_replay.py)
+
+    def new_worker(self, name):
+        return DeviceWorker(name)
+
+    def new_scheduler(self, name):
+        return EventScheduler(name)
+
+    def open_pump(self, port_str):
+        # pumps on the same port (in this process) share one AladdinBus
+        return AladdinBus.attach(port_str)
+
+    def open_valve(self, port_str):
+        return VICI_control(port_str)
+
+
+    ####################
+    #### Log, program commands
+
+    def log(self, line):
+        # may be called from any thread, the lines are written to the
+        # linewriter widget by idle (flush_log)
+        self.logq.put(line)
+
+    def flush_log(self):
+        while True:
+            try:
+                line = self.logq.get_nowait()
+            except queue.Empty:
+                break
+            self.linewriter.writeln(line)
+        # one update per tick, only the new lines are sent to the browser
+        self.linewriter.flush(self)
+
+    ####################
+    #### PROGRAM EVENTS
+    # The program events are executed by the program scheduler thread
+    # (self.prog_sched), at their planned times. They only queue the device
+    # commands (to the device workers), and plan the next event.
+
+    def prog_event(self, t_plan, t_act, step):
+        with self.prog_lock:
+            if not self.program_running:
+                return # stopped in the meantime
+            self.m_lateness.observe(t_act - t_plan, loop = 'program')
+            if step==0:
+                self.log('PROGRAM EVENT: start pre-fill')
+                self.prog_cmds('pre-fill', t_plan, t_act,
+                        [(self.pump_worker, self.pump_cmd, 'STP'),
+                         (self.euha_worker, self.euha_set_pos, EUHA_FILL_POSITION)])
+                duration = self.prog_prefill
+            elif step==1:
+                self.log('PROGRAM EVENT: start fill')
+                self.prog_cmds('fill', t_plan, t_act,
+                        [(self.pump_worker, self.pump_cmd, 'RUN')])
+                duration = self.prog_fill
+            elif step==2:
+                self.log('PROGRAM EVENT: start post-fill')
+                self.prog_cmds('post-fill', t_plan, t_act,
+                        [(self.pump_worker, self.pump_cmd, 'STP')])
+                duration = self.prog_postfill
+            elif step==3:
+                self.log('PROGRAM EVENT: *** INJEKT and return to initial state ***')
+                if self.prog_t_injekt is not None:
+                    self.m_prog_cycle.observe(t_act - self.prog_t_injekt)
+                self.prog_t_injekt = t_act
+                self.prog_cmds('INJEKT', t_plan, t_act,
+                        [(self.euha_worker, self.euha_set_pos, EUHA_REST_POSITION)])
+                # complete cycle (after the INJEKT record: same cycle as
+                # the other events of the cycle)
+                self.program_cycles += 1
+                duration = self.prog_period-(self.prog_prefill+\
+                                self.prog_fill+self.prog_postfill)
+                # max number of cycles
+                if (self.program_maxcycles > 0)\
+                       and (self.program_cycles >= self.program_maxcycles):
+                    return # program ends when INJEKT done (prog_cmd_done)
+            # plan next event, relative to the planned time (no drift)
+            t_next = t_plan + PROG_UI_TO_SECONDS*duration
+            self.prog_sched.at(t_next, self.prog_event, (step+1) % 4)
+            if step==3:
+                self.log('next event (pre-fill): '+\
+        datetime.fromtimestamp(wall_time(t_next)).isoformat().split('T')[1])
+
+    def prog_cmds(self, event, t_plan, t_act, cmds):
+        # queue the commands of a program event, prog_cmd_done logs the
+        # event when all are done; the records of a cycle (program_cycles:
+        # cycles completed before it) are removed after its INJEKT
+        rec = {'event': event, 'cycle': self.program_cycles,
+               'planned': t_plan, 'actual': t_act, 'pending': len(cmds)}
+        self.prog_recs.append(rec)
+        for worker, func, arg in cmds:
+            fut = worker.submit(func, arg)
+            fut.add_done_callback(lambda fut: self.prog_cmd_done(rec))
+
+    def prog_cmd_done(self, rec):
+        # called by the device workers
+        t_done = clock()
+        with self.prog_lock:
+            rec['pending'] -= 1
+            if rec['pending'] > 0:
+                return
+            rec['done'] = t_done
+            self.m_prog_event.observe(t_done - rec['planned'],
+                                      event = rec['event'])
+            if self.prog_logfile.closed:
+                return # program stopped
+            # time, event, planned time, lateness and completion (ms)
+            self.prog_logfile.write(isostamp(rec['actual'])+'\t'+\
+                                    rec['event']+'\t'+\
+                                    isostamp(rec['planned'])+'\t'+\
+                '{0:.3f}\t{1:.1f}\n'.format(1e3*(rec['actual']-rec['planned']),
+                                           1e3*(t_done-rec['planned'])))
+            if rec['event'] != 'INJEKT':
+                return
+            # cycle complete: jitter report (cycles numbered from 1)
+            recs = [r for r in self.prog_recs if r['cycle']==rec['cycle']]
+            self.prog_recs = [r for r in self.prog_recs
+                              if r['cycle']!=rec['cycle']]
+            report = 'cycle {0:d}: {1:d} events, lateness max {2:.3f} ms, '\
+                     'commands done max {3:.1f} ms (INJEKT {4:.1f} ms)'.format(
+                rec['cycle'] + 1, len(recs),
+                1e3*max(r['actual']-r['planned'] for r in recs),
+                1e3*max(r.get('done', t_done)-r['planned'] for r in recs),
+                1e3*(t_done-rec['planned']))
+            self.log(report)
+            self.prog_logfile.write('# '+report+'\n')
+            self.prog_logfile.flush() # Flush so that the injection event is directly written to disk    
+            if (self.program_maxcycles > 0)\
+                   and (rec['cycle'] + 1 >= self.program_maxcycles):
+                # end program
+                t4 = clock()
+                self.prog_logfile.write(isostamp(t4)+'\t'+\
+                                        'Number of cycles reached. Ending program.'+'\n')
+                self.prog_end = True # idle stops the program
+
+
+    ###################
+    #### Runtime metrics (HTTP)
+
+    def _process_all(self, func, **kwargs):
+        # serve /metrics and /metrics.json, everything else is remi's
+        path = func.split('?')[0]
+        if path not in ('/metrics', '/metrics.json'):
+            return super(AladdinPumpSteady, self)._process_all(func, **kwargs)
+        # this request handler is not the app instance that runs idle()
+        app = remi.server.clients.get(self.session, self)
+        app.m_state.set(int(app.activated), what = 'aladdin')
+        app.m_state.set(int(app.euha_activated), what = 'euha')
+        app.m_state.set(int(app.program_running), what = 'program')
+        if path == '/metrics':
+            content = app.metrics.prometheus()
+            ctype = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            content = json.dumps(app.metrics.as_dict(), indent = 1)
+            ctype = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-type', ctype)
+        self.end_headers()
+        self.wfile.write(content.encode('utf-8'))
 
     
 
@@ -1057,6 +1501,8 @@ if __name__ == "__main__":
     # optional parameters
     # start(MyApp,address='127.0.0.1', port=8081, multiple_instance=False,enable_file_cache=True, update_interval=0.1, start_browser=True)
     print('running on {0:s}:{1:d}'.format(IP_ADDRESS, IP_PORT))
+    print('metrics on http://{0:s}:{1:d}/metrics (or /metrics.json)'\
+          .format(IP_ADDRESS, IP_PORT))
     # print('you should open your browser yourself')
     remi.start(AladdinPumpSteady,
                title='FlowInjectPilot {0:d}'.format(IP_PORT), 
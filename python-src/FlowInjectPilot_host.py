@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Several FlowInjectPilot controllers in one process, without GUI
+
+    python FlowInjectPilot_host.py 9710 9911                (API on port 9000)
+    python FlowInjectPilot_host.py 9710 9418 --port 9013 --report 60
+    python FlowInjectPilot_host.py 9710 9418 --rig rig.json
+
+Each instance number (the IP_PORT of the GUI) gives a headless controller
+'p<number>', configured as the GUI with that port number: pump only for
+9500 and beyond, pump and valve below. All controllers share one API
+server and event loop (API in FlowInjectPilot_service.py, under
+/pilots/p<number>/...). Python, remi and the drivers are loaded only once,
+and pumps on the same serial port share one AladdinBus.
+
+This is an API host: the controllers have no GUI, and are used through the
+JSON API (and websocket) only, e.g. by scripts or for remote control. It
+does not serve the remi GUIs; those are started one process each by
+multilaunch.py and multilaunch-inject.py.
+
+With --rig, the pumps and valves of the controllers are activated at start,
+all at the same time (each device has its own worker; pumps on one port
+share the bus), with the settings of the API activation requests:
+
+    {"p9710": {"pump": {"port": "COM4", "pump_id": "01", "volume": 1.0},
+               "valve": {"port": "COM5"}},
+     "p9418": {"pump": {"port": "COM4", "pump_id": "02"}}}
+
+The readiness timeline of the devices (devcomms.startup) is printed when all
+are activated or have failed; the activation is seen by idle(), so the times
+are within UPDATE_INTERVAL.
+
+The log lines of all controllers go to the console, prefixed with the name
+of the controller. The supervisor reports the state of each instance:
+
+    GET /host       uptime, memory, threads, and per instance: start time,
+                    pump, valve and program state, log lines, errors, idle();
+                    readiness timeline of the --rig activation
+"""
+
+import json
+import argparse
+import threading
+
+try:
+    import resource # memory report (not on Windows)
+except ImportError:
+    resource = None
+
+import FlowInjectPilot as fip
+from FlowInjectPilot_service import PilotService
+from devcomms.webapi import WebAPI, Request
+from devcomms.timing import clock
+from devcomms.startup import Readiness
+
+
+DEFAULT_PORT = 9000
+
+
+
+class PilotHost(PilotService):
+    """PilotService with supervisor report and console log"""
+    def __init__(self, api, echo = True):
+        super(PilotHost, self).__init__(api)
+        self.echo = echo
+        self.t_start = clock()
+        self.startup = {} # name -> time taken to create the instance (s)
+        self.readiness = None # of activate_rig()
+        self.activating = {} # device name -> (pilot, 'pump' or 'valve')
+        api.route('GET', '/host', self.get_host)
+
+    def add(self, name, euha_mode = True):
+        t0 = clock()
+        pilot = super(PilotHost, self).add(name, euha_mode)
+        self.startup[name] = clock() - t0
+        return pilot
+
+    def activate_rig(self, rig):
+        """Activate the devices of `rig` ({pilot name: {"pump": settings,
+        "valve": settings}}) all at the same time"""
+        for name in rig:
+            if name not in self.pilots:
+                raise ValueError('rig: unknown instance '+name)
+        self.readiness = Readiness()
+        for name, conf in rig.items():
+            pilot = self.pilots[name]
+            if 'pump' in conf:
+                port = conf['pump'].get('port', pilot.port_str)
+                self.readiness.add(name+'.pump', 'aladdin', port)
+                self.readiness.start(name+'.pump')
+                self.activating[name+'.pump'] = (pilot, 'pump')
+                pilot.api_pump_activate(Request('POST', '', {}, {},
+                                                conf['pump']))
+            if 'valve' in conf:
+                port = conf['valve'].get('port', pilot.euha_port_str)
+                self.readiness.add(name+'.valve',
+                                   fip.VICI_control.__name__.lower(), port)
+                self.readiness.start(name+'.valve')
+                self.activating[name+'.valve'] = (pilot, 'valve')
+                pilot.api_valve_activate(Request('POST', '', {}, {},
+                                                 conf['valve']))
+
+    def check_activation(self):
+        # readiness of the devices being activated (after their idle())
+        for name, (pilot, device) in list(self.activating.items()):
+            if device == 'pump':
+                activated = pilot.activated
+                failed = pilot.enabled['pump_activate']
+            else:
+                activated = pilot.euha_activated
+                failed = pilot.enabled['valve_activate']
+            if activated:
+                self.readiness.ready(name)
+            elif failed: # deactivated again
+                self.readiness.failed(name, IOError('activation failed, '
+                                                    'see log'))
+            else:
+                continue
+            del self.activating[name]
+            if not self.activating:
+                print(self.readiness.report())
+
+    def idle(self):
+        super(PilotHost, self).idle()
+        if self.activating:
+            self.check_activation()
+
+    def publish(self, obj, topic):
+        if self.echo and obj['type'] == 'log':
+            print('[{0:s}] {1:s}'.format(obj['pilot'], obj['line']))
+        self.api.publish(obj, topic)
+
+    def instance_report(self, pilot):
+        state = pilot.state()
+        pump = state['pump']
+        rep = {'euha_mode': pilot.euha_mode,
+               'startup_s': self.startup.get(pilot.name),
+               'pump': pump['status'] if pump['activated'] else 'inactive',
+               'injected': pump['injected'],
+               'volume': pump['volume'],
+               'units': pump['units'],
+               'log_lines': pilot.nlines,
+               'errors': sum(pilot.m_errors.values.values()),
+               'commands_queued': pilot.pump_worker.pending()\
+                                  + pilot.euha_worker.pending()}
+        if pilot.euha_mode:
+            valve = state['valve']
+            rep['valve'] = valve['pos'] if valve['activated'] else 'inactive'
+            program = state['program']
+            rep['program'] = 'running' if program['running'] else 'stopped'
+            rep['cycles'] = program['cycles']
+        try:
+            s = pilot.m_idle.summary(())
+            rep['idle_mean_ms'] = 1e3 * s['mean']
+            rep['idle_max_ms'] = 1e3 * s['max']
+        except KeyError:
+            pass # idle() not yet called
+        return rep
+
+    def get_host(self, req):
+        rep = {'uptime_s': clock() - self.t_start,
+               'instances': len(self.pilots),
+               'threads': threading.active_count(),
+               'api_requests': self.api.nrequests,
+               'websocket_clients': len(self.api.clients)}
+        if resource is not None:
+            # ru_maxrss: kB on Linux
+            rep['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF)\
+                                        .ru_maxrss / 1024.
+        rep['pilots'] = {name: self.instance_report(pilot)
+                         for name, pilot in self.pilots.items()}
+        if self.readiness is not None:
+            rep['rig'] = self.readiness.as_dict()
+            rep['rig_ready_s'] = self.readiness.ready_time()
+        return rep
+
+    def report(self):
+        # one line per instance, on the console
+        for name, pilot in self.pilots.items():
+            rep = self.instance_report(pilot)
+            print('[{0:s}] pump {1:s}, valve {2:s}, program {3:s}, '
+                  '{4:d} errors'.format(name, rep['pump'],
+                                        rep.get('valve', '-'),
+                                        rep.get('program', '-'),
+                                        rep['errors']))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'FlowInjectPilot controllers in one process')
+    parser.add_argument('instances', type = int, nargs = '+',
+                        help = 'instance numbers (IP_PORT of the GUI)')
+    parser.add_argument('--address', default = fip.IP_ADDRESS)
+    parser.add_argument('--port', type = int, default = DEFAULT_PORT,
+                        help = 'API port (default: %(default)s)')
+    parser.add_argument('--report', type = float, default = 0.,
+                        help = 'print the state of the instances every '
+                               'REPORT seconds (0: never)')
+    parser.add_argument('--rig', help = 'JSON file: pump and valve settings '
+                                        'per instance, activated at start')
+    args = parser.parse_args()
+
+    api = WebAPI()
+    host = PilotHost(api)
+    t0 = clock()
+    for number in args.instances:
+        host.add('p{0:d}'.format(number), euha_mode = number < 9500)
+    print('{0:d} instance(s) started in {1:.3f} s: {2:s}'.format(
+        len(host.pilots), clock() - t0, ', '.join(host.pilots)))
+    if args.rig:
+        with open(args.rig, encoding = 'utf-8') as f:
+            host.activate_rig(json.load(f))
+    if args.report > 0:
+        api.every(args.report, host.report)
+    print('API on {0:s}:{1:d} (/pilots, /host, /ws)'.format(args.address,
+                                                            args.port))
+    api.run(args.address, args.port)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of the FlowInjectPilot injection program in virtual time
+
+The app (AladdinPumpSteady, without web server) is run against device models
+(devcomms.virtual) with a virtual clock: the pump and valve workers, the
+program scheduler and idle() are the ones of the app, but time jumps from
+one event to the next. A program of several days, until the syringe fill
+volume is dispensed (volume check of idle), is replayed in seconds:
+
+    python FlowInjectPilot_replay.py --period 20 --fill 1 --rate 10.0 --volume 5
+
+The program log file (program_log_replay_<date>_<time>.txt) is written as by
+the app, in virtual time. The replay ends when the program ends (--cycles), when
+the pump is deactivated (fill volume dispensed, errors), or after --days.
+The exit status is 0 if the program ran to its end or until the fill volume
+was dispensed, and the program event records of the finished cycles were
+released, 1 otherwise (for regression tests).
+"""
+
+import sys
+import queue
+import argparse
+from time import perf_counter
+
+import FlowInjectPilot as fip
+from devcomms import timing
+from devcomms.timing import clock
+from devcomms.virtual import (VirtualClock, VirtualScheduler, InlineWorker,
+                              AladdinModel, ValveModel)
+
+
+
+class ReplayPilot(fip.AladdinPumpSteady):
+    """The app in virtual time, against device models (no web server,
+    no widgets)"""
+    def __init__(self, vclock, echo = True):
+        self.vclock = vclock
+        self.echo = echo
+        self.pump_model = None
+        self.valve_model = None
+        self.init_state(euha_mode = True, instance = 'replay')
+
+    def new_worker(self, name):
+        return InlineWorker(name, self.vclock)
+
+    def new_scheduler(self, name):
+        return VirtualScheduler(name, self.vclock)
+
+    def open_pump(self, port_str):
+        if self.pump_model is None:
+            self.pump_model = AladdinModel(port_str, [self.pumpid])
+        return self.pump_model
+
+    def open_valve(self, port_str):
+        if self.valve_model is None:
+            self.valve_model = ValveModel(port_str, fip.EUHA_REST_POSITION)
+        return self.valve_model
+
+    def flush_log(self):
+        # log lines go to the console, with their (virtual) time
+        while True:
+            try:
+                line = self.logq.get_nowait()
+            except queue.Empty:
+                return
+            if self.echo:
+                print(fip.isotimestr(), line)
+
+
+
+def replay(args):
+    fip.PROG_MAXCYCLES = args.cycles
+    fip.SCHEDULE_STEP = args.poll
+    fip.EUHA_SCHEDULE_STEP = args.poll
+
+    vclock = VirtualClock()
+    timing.set_clock(vclock)
+    try:
+        app = ReplayPilot(vclock, echo = not args.quiet)
+        app.init_workers()
+
+        # pump and valve configuration, as in the UI
+        app.port_str = args.pump_port
+        app.pumpid = args.pump_id
+        app.syringetype = args.syringe
+        app.fill_ml = args.volume
+        app.pumpratestr = args.rate
+        app.euha_port_str = args.valve_port
+        app.activate()
+        app.euha_activate()
+        app.idle() # activation callbacks
+        if not (app.activated and app.euha_activated):
+            print('activation failed')
+            return 1
+
+        # program, as in the UI (minutes)
+        app.prog_period = args.period
+        app.prog_prefill = args.prefill
+        app.prog_fill = args.fill
+        app.prog_postfill = args.postfill
+        app.m2_runprog351(None)
+
+        nrecs = [0] # max number of program event records kept
+        def after():
+            app.idle()
+            nrecs[0] = max(nrecs[0], len(app.prog_recs))
+            if not (app.program_running and app.activated):
+                vclock.halt()
+
+        t_start = clock()
+        t0 = perf_counter()
+        vclock.run(until = t_start + 86400.*args.days, after = after)
+        dt_wall = perf_counter() - t0
+        dt_virtual = clock() - t_start
+
+        completed = not app.program_running # number of cycles reached
+        dispensed = not app.activated # deactivated by the volume check?
+        if app.program_running:
+            app.m2_stopprog352(None)
+        app.idle()
+
+        # injected volume, as displayed by the pump (volume check of idle)
+        _, reply = app.pump_model.pump_cmd(args.pump_id, 'DIS')
+        injvol = float(app.pump_reply_parse_re.search(reply).group(1))
+        print('replayed {0:.2f} h in {1:.2f} s ({2:.0f} x real time), '
+              '{3:d} events'.format(dt_virtual/3600., dt_wall,
+                                    dt_virtual/max(dt_wall, 1e-9),
+                                    vclock.nevent))
+        print('cycles: {0:d}, injected {1:g} of {2:g} {3:s}, '
+              'valve moves: {4:d}'.format(app.program_cycles, injvol,
+                                          app.volvalue, app.vol_units,
+                                          app.valve_model.nmove))
+        print('program event records kept: max {0:d}'.format(nrecs[0]))
+        if completed:
+            print('program ended: number of cycles reached')
+        elif dispensed:
+            print('program ended: pump deactivated')
+        else:
+            print('program still running after {0:g} days'.format(args.days))
+        # at most the 4 events of the current cycle
+        ok = (completed or (dispensed and injvol >= app.volvalue))\
+             and (nrecs[0] <= 4)
+        return 0 if ok else 1
+    finally:
+        timing.set_clock()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Replay the FlowInjectPilot program in virtual time')
+    parser.add_argument('--period', type = float, default = 20.,
+                        help = 'cycle period (min)')
+    parser.add_argument('--prefill', type = float, default = 1.)
+    parser.add_argument('--fill', type = float, default = 1.)
+    parser.add_argument('--postfill', type = float, default = 1.)
+    parser.add_argument('--cycles', type = int, default = 0,
+                        help = 'number of cycles (0 = until the syringe is empty)')
+    parser.add_argument('--rate', default = '10.0', choices = fip.pumprates,
+                        help = 'pump rate (µl/min)')
+    parser.add_argument('--volume', type = float, default = 1.0,
+                        help = 'syringe fill volume (ml)')
+    parser.add_argument('--syringe', default = fip.syringetypes[-1],
+                        choices = fip.syringetypes)
+    parser.add_argument('--pump-port', default = fip.commports[0])
+    parser.add_argument('--pump-id', default = fip.pumpIDs[0])
+    parser.add_argument('--valve-port', default = fip.commports[1])
+    parser.add_argument('--poll', type = float, default = fip.SCHEDULE_STEP,
+                        help = 'pump and valve poll period (s)')
+    parser.add_argument('--days', type = float, default = 30.,
+                        help = 'maximum (virtual) duration')
+    parser.add_argument('--quiet', action = 'store_true',
+                        help = 'no log lines, only the summary')
+    sys.exit(replay(parser.parse_args()))
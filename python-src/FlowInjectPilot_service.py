@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Headless FlowInjectPilot: pump and valve control through a JSON REST and
+WebSocket API, instead of the remi GUI
+
+The device logic, program engine and safety checks (withdraw detection, fill
+volume limit) are those of the GUI app (AladdinPumpSteady): the app runs
+without web page, its idle() is called every UPDATE_INTERVAL seconds by the
+API server, and the API requests do what the buttons do, under the same
+conditions (a request for a button that is disabled in the GUI is refused).
+There is no widget tree: the settings and the enabled state of the controls
+are plain attributes of the app, which the GUI shows and the API reads.
+
+    python FlowInjectPilot_service.py 9013      (pilot 'p9013' on port 9013)
+
+REST API, JSON bodies and replies (<name>: name of the pilot):
+
+    GET  /pilots                          state of all pilots
+    GET  /pilots/<name>                   state (pump, valve, program)
+    GET  /pilots/<name>/log?since=<n>     log lines after line number n
+    GET  /pilots/<name>/metrics           Prometheus text (or metrics.json)
+    POST /pilots/<name>/pump/activate     {"port": "COM4", "pump_id": "01",
+                                           "syringe": "...", "volume": 1.0,
+                                           "rate": "1.0"}
+    POST /pilots/<name>/pump/deactivate
+    POST /pilots/<name>/pump/start
+    POST /pilots/<name>/pump/stop
+    POST /pilots/<name>/pump/rate         {"rate": "2.0"}
+    POST /pilots/<name>/valve/activate    {"port": "COM5"}
+    POST /pilots/<name>/valve/deactivate
+    POST /pilots/<name>/valve/pos         {"pos": "A"}
+    POST /pilots/<name>/program/start     {"period": 20, "prefill": 1,
+                                           "fill": 1, "postfill": 1} (min)
+    POST /pilots/<name>/program/stop
+
+Omitted settings keep their current value. Commands are queued to the device
+workers and return the state at once; the result shows in the next states.
+The WebSocket /ws (or /ws?topic=<name> for one pilot) streams the log lines,
+{"pilot": name, "type": "log", "n": n, "line": line}, and the state when it
+changes, {"pilot": name, "type": "state", "state": {...}}.
+"""
+
+import sys
+import queue
+from collections import deque
+
+import FlowInjectPilot as fip
+from devcomms.webapi import WebAPI
+
+
+# idle() period (s), as the remi update_interval of the GUI
+UPDATE_INTERVAL = 0.1
+# log lines kept per pilot (GET .../log)
+LOG_LINES = 1000
+
+
+
+def _choice(req, key, choices, default):
+    # setting `key` of the request (one of `choices`), or `default`
+    value = req.get(key)
+    if value is None:
+        return default
+    value = str(value)
+    if value not in choices:
+        raise ValueError('{0:s} should be one of: {1:s}'\
+                         .format(key, ', '.join(choices)))
+    return value
+
+
+def _number(req, key, vrange, default):
+    # setting `key` of the request (within vrange: min, max, step), or
+    # `default`
+    value = req.get(key)
+    if value is None:
+        return default
+    vmin, vmax = vrange[:2]
+    value = float(value)
+    if not (vmin <= value <= vmax):
+        raise ValueError('{0:s} should be between {1:g} and {2:g}'\
+                         .format(key, vmin, vmax))
+    return value
+
+
+
+class HeadlessPilot(fip.AladdinPumpSteady):
+    """The app without web page, controlled by PilotService"""
+    def __init__(self, name, euha_mode = True, publish = None):
+        self.name = name
+        self.publish = publish # publish(obj, topic), e.g. WebAPI.publish
+        self.lines = deque(maxlen = LOG_LINES) # (n, line)
+        self.nlines = 0
+        self.last_state = None
+        self.init_state(euha_mode, name)
+        self.init_workers() # no main(): no widgets
+
+    def flush_log(self):
+        while True:
+            try:
+                line = self.logq.get_nowait()
+            except queue.Empty:
+                return
+            self.nlines += 1
+            self.lines.append((self.nlines, line))
+            if self.publish is not None:
+                self.publish({'pilot': self.name, 'type': 'log',
+                              'n': self.nlines, 'line': line}, self.name)
+
+    def idle(self):
+        super(HeadlessPilot, self).idle()
+        state = self.state()
+        if state != self.last_state:
+            self.last_state = state
+            if self.publish is not None:
+                self.publish({'pilot': self.name, 'type': 'state',
+                              'state': state}, self.name)
+
+    def shutdown(self):
+        # as the close dialog of the GUI, without waiting
+        if self.euha_mode:
+            self.euha_deactivate()
+        self.deactivate()
+        self.prog_sched.stop()
+        self.pump_worker.stop()
+        self.euha_worker.stop()
+
+    def state(self):
+        pump = {'activated': self.activated,
+                'port': self.port_str,
+                'pump_id': self.pumpid,
+                'syringe': self.syringetype,
+                'rate': self.pumpratestr,
+                'status': None, 'reply': None, 'injected': None,
+                'volume': None, 'units': None}
+        snap = self.pump_worker.state
+        if self.activated:
+            pump['volume'] = self.volvalue
+            pump['units'] = self.vol_units
+            if (snap is not None) and (snap.result is not None):
+                pump['status'], pump['reply'] = snap.result
+                prparse = self.pump_reply_parse_re.search(pump['reply'] or '')
+                if prparse:
+                    pump['injected'] = float(prparse.group(1))
+        state = {'pump': pump}
+        if self.euha_mode:
+            snap = self.euha_worker.state
+            state['valve'] = {'activated': self.euha_activated,
+                              'port': self.euha_port_str,
+                              'pos': snap.result if self.euha_activated\
+                                     and (snap is not None) else None}
+            state['program'] = {'running': self.program_running,
+                'cycles': getattr(self, 'program_cycles', 0),
+                'max_cycles': self.program_maxcycles,
+                'period': self.prog_period,
+                'prefill': self.prog_prefill,
+                'fill': self.prog_fill,
+                'postfill': self.prog_postfill}
+        return state
+
+    def _check(self, control, what):
+        # refuse what the GUI does not allow (button or menu disabled)
+        if not self.enabled.get(control, False):
+            raise ValueError(what+' not possible now')
+
+    def api_pump_activate(self, req):
+        self._check('pump_activate', 'pump activation')
+        # check all settings before changing any
+        pumpid = _choice(req, 'pump_id', fip.pumpIDs, self.pumpid)
+        syringetype = _choice(req, 'syringe', fip.syringetypes,
+                              self.syringetype)
+        fill_ml = _number(req, 'volume', fip.fillvolume_range, self.fill_ml)
+        pumpratestr = _choice(req, 'rate', fip.pumprates, self.pumpratestr)
+        # any serial port (the GUI menu only has the usual ones)
+        self.port_str = str(req.get('port', self.port_str))
+        self.pumpid = pumpid
+        self.syringetype = syringetype
+        self.fill_ml = fill_ml
+        self.pumpratestr = pumpratestr
+        self.activate151(None)
+
+    def api_pump_deactivate(self, req):
+        self._check('pump_deactivate', 'pump deactivation')
+        self.deactivate152(None)
+
+    def api_pump_start(self, req):
+        self._check('pump_start', 'pump start')
+        self.start211(None)
+
+    def api_pump_stop(self, req):
+        self._check('pump_stop', 'pump stop')
+        self.stop212(None)
+
+    def api_pump_rate(self, req):
+        self._check('pump_rate', 'rate change')
+        rate = req.get('rate')
+        if rate not in fip.pumprates:
+            raise ValueError('rate should be one of: '+', '.join(fip.pumprates))
+        self.pumprate22(None, rate)
+
+    def _euha(self):
+        if not self.euha_mode:
+            raise ValueError('no valve (VICI EUHA mode off)')
+
+    def api_valve_activate(self, req):
+        self._euha()
+        self._check('valve_activate', 'valve activation')
+        self.euha_port_str = str(req.get('port', self.euha_port_str))
+        self.m2_activate151(None)
+
+    def api_valve_deactivate(self, req):
+        self._euha()
+        self._check('valve_deactivate', 'valve deactivation')
+        self.m2_deactivate152(None)
+
+    def api_valve_pos(self, req):
+        self._euha()
+        pos = req.get('pos')
+        if pos == 'A':
+            self._check('valve_pos', 'valve move')
+            self.m2_euha_posA_211(None)
+        elif pos == 'B':
+            self._check('valve_pos', 'valve move')
+            self.m2_euha_posB_212(None)
+        else:
+            raise ValueError('pos should be A or B')
+
+    def api_program_start(self, req):
+        self._euha()
+        self._check('program_start', 'program start')
+        if self.program_running:
+            raise ValueError('program already running')
+        period = _number(req, 'period', fip.progperiod_range,
+                         self.prog_period)
+        prefill = _number(req, 'prefill', fip.progstep_range,
+                          self.prog_prefill)
+        fill = _number(req, 'fill', fip.progstep_range, self.prog_fill)
+        postfill = _number(req, 'postfill', fip.progstep_range,
+                           self.prog_postfill)
+        self.prog_period = period
+        self.prog_prefill = prefill
+        self.prog_fill = fill
+        self.prog_postfill = postfill
+        self.check_prog_period() # period long enough
+        self.m2_runprog351(None)
+        if not self.program_running:
+            raise ValueError('program not started (see log)')
+
+    def api_program_stop(self, req):
+        self._euha()
+        self._check('program_stop', 'program stop')
+        self.m2_stopprog352(None)
+
+
+
+class PilotService:
+    """REST and WebSocket API for HeadlessPilots (see module docstring)"""
+    COMMANDS = ['pump/activate', 'pump/deactivate', 'pump/start',
+                'pump/stop', 'pump/rate', 'valve/activate',
+                'valve/deactivate', 'valve/pos', 'program/start',
+                'program/stop']
+
+    def __init__(self, api):
+        self.api = api
+        self.pilots = {} # name -> HeadlessPilot
+        api.route('GET', '/pilots', self.get_pilots)
+        api.route('GET', '/pilots/{name}', self.get_state)
+        api.route('GET', '/pilots/{name}/log', self.get_log)
+        api.route('GET', '/pilots/{name}/metrics', self.get_metrics)
+        api.route('GET', '/pilots/{name}/metrics.json', self.get_metrics_json)
+        for command in self.COMMANDS:
+            api.route('POST', '/pilots/{name}/'+command,
+                      self._command('api_'+command.replace('/', '_')))
+        api.every(UPDATE_INTERVAL, self.idle)
+        api.on_stop(self.close)
+
+    def add(self, name, euha_mode = True):
+        if name in self.pilots:
+            raise ValueError('pilot '+name+' exists')
+        pilot = HeadlessPilot(name, euha_mode, self.publish)
+        self.pilots[name] = pilot
+        return pilot
+
+    def publish(self, obj, topic):
+        self.api.publish(obj, topic)
+
+    def idle(self):
+        for pilot in self.pilots.values():
+            try:
+                pilot.idle()
+            except Exception as ex:
+                print('{0:s} idle: {1!r}'.format(pilot.name, ex))
+
+    def close(self):
+        for pilot in self.pilots.values():
+            pilot.shutdown()
+
+    def _command(self, method):
+        def handler(req):
+            pilot = self.pilots[req.params['name']]
+            getattr(pilot, method)(req)
+            return pilot.state()
+        return handler
+
+    def get_pilots(self, req):
+        return {name: pilot.state() for name, pilot in self.pilots.items()}
+
+    def get_state(self, req):
+        return self.pilots[req.params['name']].state()
+
+    def get_log(self, req):
+        pilot = self.pilots[req.params['name']]
+        since = int(req.get('since', 0))
+        return {'n': pilot.nlines,
+                'lines': [[n, line] for n, line in pilot.lines if n > since]}
+
+    def get_metrics(self, req):
+        return self.pilots[req.params['name']].metrics.prometheus()
+
+    def get_metrics_json(self, req):
+        return self.pilots[req.params['name']].metrics.as_dict()
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2:
+        fip.IP_PORT = int(sys.argv[1])
+
+    api = WebAPI()
+    service = PilotService(api)
+    # same configuration by port number as the GUI
+    service.add('p{0:d}'.format(fip.IP_PORT), euha_mode = fip.IP_PORT < 9500)
+    print('FlowInjectPilot API on {0:s}:{1:d} (/pilots, /ws)'\
+          .format(fip.IP_ADDRESS, fip.IP_PORT))
+    api.run(fip.IP_ADDRESS, fip.IP_PORT)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the Aladdin serial receive path
+
+Compares the original byte-at-a-time reader (`framed=False`) with the
+framed bulk reader (`framed=True`) of `devcomms.aladdin.Aladdin`. For each
+mode, `NCMD` identical commands are sent to the pump, and the round-trip
+time and the number of serial read/in_waiting calls per command are reported
+(read_until: calls, and the reads done by pyserial inside them, in `read`).
+
+The pump should be connected and idle ('DIS' does not change anything).
+With `port_str = None` the benchmark runs against the pseudo-terminal pump
+simulator (Linux), with the reply sent character by character at 9600 baud.
+"""
+
+from time import perf_counter
+from statistics import median
+
+import serial
+
+from devcomms.aladdin import Aladdin
+
+
+# Parameters
+
+# port_str = '/dev/ttyUSB0'
+port_str = 'COM6'
+# port_str = None # simulator
+pump_id = '01'
+cmdstr = 'DIS'
+NCMD = 200
+
+
+
+class CountingSerial:
+    """Wraps a serial.Serial object, counting the calls that hit the OS"""
+    def __init__(self, ser):
+        self._ser = ser
+        self.nread = 0
+        self.nwaiting = 0
+        self.nwrite = 0
+        self.nuntil = 0
+
+    def read(self, size=1):
+        self.nread += 1
+        return self._ser.read(size)
+
+    def read_until(self, expected=b'\n', size=None):
+        # pyserial reads byte by byte here: count those reads too
+        self.nuntil += 1
+        return serial.Serial.read_until(self, expected, size)
+
+    def write(self, data):
+        self.nwrite += 1
+        return self._ser.write(data)
+
+    @property
+    def in_waiting(self):
+        self.nwaiting += 1
+        return self._ser.in_waiting
+
+    def inWaiting(self):
+        self.nwaiting += 1
+        return self._ser.in_waiting
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+
+
+def bench(framed):
+    ala = Aladdin(port_str, framed = framed)
+    cser = CountingSerial(ala.ser)
+    ala.ser = cser
+    ala.pump_cmd(pump_id, cmdstr) # warm-up
+    cser.nread = cser.nwaiting = cser.nwrite = cser.nuntil = 0
+    rtts = []
+    for i in range(NCMD):
+        t0 = perf_counter()
+        pump_status, pump_reply = ala.pump_cmd(pump_id, cmdstr)
+        rtts.append(perf_counter() - t0)
+        assert pump_reply is not None, 'pump not responding'
+    ala.close()
+    print('framed = ', framed, '    reply = ', ala.last_reply)
+    print('    round trip (ms): median {0:.3f}   min {1:.3f}   max {2:.3f}'\
+          .format(1e3*median(rtts), 1e3*min(rtts), 1e3*max(rtts)))
+    print('    calls/command  : read {0:.2f}   in_waiting {1:.2f}'
+          '   read_until {2:.2f}   write {3:.2f}'\
+          .format(cser.nread/NCMD, cser.nwaiting/NCMD, cser.nuntil/NCMD,
+                  cser.nwrite/NCMD))
+
+
+
+if __name__ == '__main__':
+    if port_str is None:
+        from devcomms.simulators import AladdinSim
+        sim = AladdinSim(pump_ids = [pump_id], pace_chars = True).start()
+        port_str = sim.port
+    bench(framed = False)
+    bench(framed = True)
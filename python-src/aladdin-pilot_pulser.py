@@ -2,9 +2,12 @@
 
 __version__ = '241124'
 
-from time import sleep, time, strftime
+from time import strftime
 
-from devcomms.aladdin import Aladdin        
+from devcomms.aladdin import Aladdin
+# clock() and sleep() instead of time() and time.sleep(): monotonic, and
+# virtual time can be used for tests (devcomms.timing.set_clock)
+from devcomms.timing import clock, sleep, wall_time        
 
 
 
@@ -36,7 +39,7 @@ for comstr in ['04VER', '04STP']:
 print()
 print()
 
-t0 = time()
+t0 = clock()
 t00 = t0
 N = 0
 
@@ -44,15 +47,15 @@ fout = open(logfname,'w')
 while True:
     N+=1
     print('---')
-    print(N, strftime('%Y-%m-%d %H:%M:%S'), time()-t00, sep='\t')
-    fout.write('{0:d}\tRUN\t{1:f}\n'.format(N, time()))
-    print('\t',ala.send_recv('04RUN'), time()-t0)
-    while ((time()-t0) < time_on):
+    print(N, strftime('%Y-%m-%d %H:%M:%S'), clock()-t00, sep='\t')
+    fout.write('{0:d}\tRUN\t{1:f}\n'.format(N, wall_time(clock())))
+    print('\t',ala.send_recv('04RUN'), clock()-t0)
+    while ((clock()-t0) < time_on):
         sleep(timer_sleep)
-    print('\t',ala.send_recv('04STP'), time()-t0)
-    fout.write('{0:d}\tSTP\t{1:f}\n'.format(N, time()))
+    print('\t',ala.send_recv('04STP'), clock()-t0)
+    fout.write('{0:d}\tSTP\t{1:f}\n'.format(N, wall_time(clock())))
     fout.flush()
-    while ((time()-t0) < time_period):
+    while ((clock()-t0) < time_period):
         sleep(timer_sleep)
     t0 += time_period
    
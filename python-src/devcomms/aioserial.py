@@ -0,0 +1,135 @@
+"""
+Non-blocking serial transport for asyncio
+
+`AsyncSerial` wraps a pyserial `Serial` opened in non-blocking mode
+(timeout = 0). Reads wait for incoming data without blocking the event loop:
+on POSIX systems (selector event loop) the serial file descriptor is watched
+with `loop.add_reader`, elsewhere (e.g. Windows, proactor event loop) the
+input buffer is polled every `poll_interval` seconds with `asyncio.sleep`.
+
+This is the transport for the asyncio drivers (`AsyncAladdin`, `AsyncFSS`,
+`AsyncFLSH`, `AsyncVICI_TTL`, `AsyncVICI_EUHA`), which have the same command
+semantics as their blocking counterparts. Since none of them block, one event
+loop can drive many devices at the same time:
+
+    pumps = [await AsyncAladdin.open(p) for p in ports]
+    replies = await asyncio.gather(*[ala.pump_cmd('01', 'DIS')
+                                     for ala in pumps])
+"""
+
+import asyncio
+import serial
+
+from . import trace
+
+
+
+class AsyncSerial:
+    def __init__(self, port_str, baudrate = 9600, timeout = 1.0,
+                 poll_interval = 0.002, trace_name = None, **kwargs):
+        self.port_str = port_str
+        self.baudrate = baudrate
+        self.timeout = timeout # default timeout for reads (seconds)
+        self.poll_interval = poll_interval
+        self.ser = serial.Serial(port_str,
+                                 baudrate = baudrate,
+                                 timeout = 0, # non-blocking
+                                 **kwargs)
+        trace.attach(self.ser, trace_name or port_str) # if tracing enabled
+        self.rxbuf = bytearray()
+        try:
+            self._fd = self.ser.fileno()
+        except (AttributeError, NotImplementedError):
+            self._fd = None # no file descriptor to watch, use polling
+
+    def _take_waiting(self):
+        nwait = self.ser.in_waiting
+        if nwait > 0:
+            self.rxbuf += self.ser.read(nwait)
+        return nwait
+
+    async def wait_data(self, deadline):
+        # Wait until new data has been added to rxbuf, or until deadline.
+        # Returns False on timeout.
+        loop = asyncio.get_running_loop()
+        if self._take_waiting() > 0:
+            return True
+        if self._fd is not None:
+            fut = loop.create_future()
+            def _ready():
+                if not fut.done():
+                    fut.set_result(None)
+            try:
+                loop.add_reader(self._fd, _ready)
+            except NotImplementedError:
+                self._fd = None # event loop can not watch fd, poll instead
+            else:
+                try:
+                    await asyncio.wait_for(fut, max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    loop.remove_reader(self._fd)
+                return self._take_waiting() > 0
+        while loop.time() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            if self._take_waiting() > 0:
+                return True
+        return False
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        return asyncio.get_running_loop().time() + timeout
+
+    async def read(self, size = 1, timeout = None):
+        """Read up to `size` bytes. Returns fewer bytes on timeout."""
+        deadline = self._deadline(timeout)
+        while len(self.rxbuf) < size:
+            if not await self.wait_data(deadline):
+                break
+        data = bytes(self.rxbuf[:size])
+        del self.rxbuf[:size]
+        return data
+
+    async def read_until(self, expected = b'\n', timeout = None):
+        """Read up to and including `expected`, or what came before timeout."""
+        deadline = self._deadline(timeout)
+        istart = 0
+        while True:
+            i = self.rxbuf.find(expected, istart)
+            if i >= 0:
+                n = i + len(expected)
+                break
+            istart = max(0, len(self.rxbuf) - len(expected) + 1)
+            if not await self.wait_data(deadline):
+                n = len(self.rxbuf)
+                break
+        data = bytes(self.rxbuf[:n])
+        del self.rxbuf[:n]
+        return data
+
+    def read_waiting(self):
+        """Everything received so far (does not wait)"""
+        self._take_waiting()
+        data = bytes(self.rxbuf)
+        self.rxbuf.clear()
+        return data
+
+    async def write(self, data):
+        # short commands: the OS driver takes these immediately
+        self.ser.write(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.rxbuf) + self.ser.in_waiting
+
+    def reset_input_buffer(self):
+        self.rxbuf.clear()
+        self.ser.reset_input_buffer()
+
+    def reset_output_buffer(self):
+        self.ser.reset_output_buffer()
+
+    def close(self):
+        self.ser.close()
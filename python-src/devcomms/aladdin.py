@@ -1,10 +1,51 @@
 # Communications module (RS232) for Aladdin syringe pump
 
-from time import sleep
+import asyncio
+from collections import deque
+from time import sleep, perf_counter_ns
 import serial
 
+from .aioserial import AsyncSerial
+from .timing import LatencyStats
+from . import trace
+
+# reply frame delimiters
+STX = 0x02
+ETX = 0x03
+
+def parse_pump_reply(idstr, sendstr, reply):
+    """Decode pump reply into (pumpid, pumpstatus, pumpreply)"""
+    # decode expected reply, and raise error if not coherent
+    # TODO: improve error handling by raising Exceptions or other messaging
+    # reply can be None!! this should be handled
+    # if error raised => close communications? or try recovery... (retries...)
+    #   for now, make that decision in the main program
+    if reply is not None:
+        assert len(reply) > 2, 'unexpected response. sent: '+sendstr+\
+            ', received: '+reply
+        pumpid = reply[0:2]
+        assert pumpid == idstr, 'pump idstr not OK. sent: '+sendstr+\
+            ', received: '+reply
+        pumpstatus = reply[2]
+        # allowable pump statuses 
+        assert pumpstatus in ['A','P','S','I','W'],\
+            'pump status not supported. sent: '+sendstr+\
+                ', received: '+reply
+        pumpreply = reply[3:]
+    else:
+        # None receive, this is mostly the result of not receiving
+        # a response from the pump (timeout)
+        # TODO: handle timeouts better
+        # in this case, to transfer the message just output 'None'
+        # everywhere
+        pumpid = None
+        pumpstatus = None
+        pumpreply = None
+    return pumpid, pumpstatus, pumpreply
+
+
 class Aladdin:
-    def __init__(self, port_str, baudrate = 9600):
+    def __init__(self, port_str, baudrate = 9600, framed = True):
         self.port_str = port_str
         self.ser_timeout = 1.0
         self.baudrate = baudrate
@@ -12,17 +53,96 @@ class Aladdin:
                                  baudrate = self.baudrate,
                                  timeout = self.ser_timeout)
                                #default serial: 9600 baud, 8N1
+        trace.attach(self.ser, 'Aladdin '+port_str) # if tracing enabled
         self.ser.read(self.ser.inWaiting()) # flush buffer
         self.last_sendstr = None
         self.last_reply = None
         self.last_pumpid = None
         self.last_pumpstatus = None
         self.last_pumpreply = None
+        # timestamps (perf_counter_ns) of the last transaction, see timing.py
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('Aladdin '+port_str)
+        # receive path: `framed` pulls in whole STX...ETX frames with bulk
+        # reads, otherwise fall back to the original byte-at-a-time reader
+        self.framed = framed
+        self._rxbuf = bytearray() # re-used receive buffer (framed mode)
 
     def send_recv(self, sendstr_in):
         self.last_sendstr = sendstr_in
         sendstr = sendstr_in.encode(encoding='ascii') + b'\r'
+        self.t_send_ns = perf_counter_ns()
         self.ser.write(sendstr)
+        if self.framed:
+            reply = self.recv_frame()
+        else:
+            reply = self.recv_bytewise()
+        self.t_recv_ns = perf_counter_ns()
+        if reply is not None:
+            self.latency.record(sendstr_in, self.t_send_ns, self.t_recv_ns)
+            reply = self._decode(reply)
+        self.last_reply = reply
+        return reply
+
+    def _decode(self, reply):
+        try:
+            return reply.decode(encoding='ascii')
+        except UnicodeDecodeError:
+            print("Error in decoding reply from pump. Check communication cables.")
+            self._flush()
+            return "<COMMUNICATION ERROR>"
+
+    def _flush(self):
+        sleep(self.ser_timeout) # wait a while
+        self.ser.read(self.ser.inWaiting()) # flush buffer
+        self._rxbuf.clear()
+
+    def recv_frame(self):
+        """Receive one STX...ETX reply frame, using bulk reads.
+
+        After STX, whatever is waiting in the input buffer is taken in a
+        single read. If the frame is still incomplete, the rest of it is on
+        the line: it is read with one blocking `read_until(ETX)` (serial
+        timeout). Bytes received after ETX are kept in the buffer for the
+        next frame.
+
+        Returns the frame contents (without STX, ETX) as bytes, or None if
+        nothing was received. Same results as `recv_bytewise`.
+        """
+        buf = self._rxbuf
+        if len(buf) == 0:
+            readch = self.ser.read(1)
+            if len(readch) == 0:
+                return None
+            buf += readch
+        if buf[0] != STX:
+            print('Warning: STX not received')
+            reply = bytes(buf) + self.ser.read(self.ser.in_waiting)
+            buf.clear()
+            return reply
+        ietx = buf.find(ETX, 1)
+        if ietx < 0:
+            nwait = self.ser.in_waiting
+            if nwait > 0:
+                nold = len(buf)
+                buf += self.ser.read(nwait)
+                ietx = buf.find(ETX, nold)
+        if ietx < 0:
+            nold = len(buf)
+            buf += self.ser.read_until(bytes([ETX]))
+            ietx = buf.find(ETX, nold)
+            if ietx < 0:
+                # timeout: return incomplete frame, like recv_bytewise
+                reply = bytes(buf[1:])
+                buf.clear()
+                return reply
+        reply = bytes(buf[1:ietx])
+        del buf[:ietx+1]
+        return reply
+
+    def recv_bytewise(self):
+        """Original receive path: one `read(1)` per byte."""
         reply = bytes()
         readch = self.ser.read(1)
         if len(readch) == 0:
@@ -36,15 +156,6 @@ class Aladdin:
                 while ((readch != b'\x03') and (len(readch) != 0)):
                     reply = reply + readch
                     readch = self.ser.read(1)
-        if reply is not None:
-            try:
-                reply = reply.decode(encoding='ascii')
-            except UnicodeDecodeError:
-                print("Error in decoding reply from pump. Check communication cables.")
-                sleep(self.ser_timeout) # wait a while
-                self.ser.read(self.ser.inWaiting()) # flush buffer
-                reply = "<COMMUNICATION ERROR>"
-        self.last_reply = reply
         return reply
     
     def pump_cmd(self, idstr: str, cmdstr: str ) -> (str, str):
@@ -52,43 +163,136 @@ class Aladdin:
         #TODO; check cmdstr
         sendstr = idstr + cmdstr
         reply = self.send_recv(sendstr)
-        # decode expected reply, and raise error if not coherent
-        # TODO: improve error handling by raising Exceptions or other messaging
-        # reply can be None!! this should be handled
-        # if error raised => close communications? or try recovery... (retries...)
-        #   for now, make that decision in the main program
-        if reply is not None:
-            assert len(reply) > 2, 'unexpected response. sent: '+sendstr+\
-                ', received: '+reply
-            pumpid = reply[0:2]
-            assert pumpid == idstr, 'pump idstr not OK. sent: '+sendstr+\
-                ', received: '+reply
-            pumpstatus = reply[2]
-            # allowable pump statuses 
-            assert pumpstatus in ['A','P','S','I','W'],\
-                'pump status not supported. sent: '+sendstr+\
-                    ', received: '+reply
-            pumpreply = reply[3:]
-        else:
-            # None receive, this is mostly the result of not receiving
-            # a response from the pump (timeout)
-            # TODO: handle timeouts better
-            # in this case, to transfer the message just output 'None'
-            # everywhere
-            pumpid = None
-            pumpstatus = None
-            pumpreply = None
-
+        pumpid, pumpstatus, pumpreply = parse_pump_reply(idstr, sendstr, reply)
         self.last_pumpid = pumpid
         self.last_pumpstatus = pumpstatus
         self.last_pumpreply = pumpreply
         return (pumpstatus, pumpreply)
+
+    def pump_cmds(self, idstr, cmdstrs, depth = 1):
+        """Send a series of commands to pump `idstr`, optionally pipelined.
+
+        Up to `depth` commands are written before the reply to the first of
+        them is read (the pump replies in order), so that the round trips
+        overlap. Returns a list of (pumpstatus, pumpreply), one per command.
+        The default (1) sends one command at a time: several commands in
+        flight (RS-232, no flow control) have not been tested on a real
+        pump yet, only on the simulator.
+
+        A missing reply leaves the pipeline out of step: the input is then
+        flushed and (None, None) is returned for that command and all
+        commands after it."""
+        results = []
+        pending = deque() # (sendstr, t_send_ns) of the commands in flight
+        i = 0
+        while len(results) < len(cmdstrs):
+            while (i < len(cmdstrs)) and (len(pending) < depth):
+                sendstr = idstr + cmdstrs[i]
+                self.t_send_ns = perf_counter_ns()
+                self.ser.write(sendstr.encode(encoding='ascii') + b'\r')
+                pending.append((sendstr, self.t_send_ns))
+                i += 1
+            sendstr, t_send_ns = pending.popleft()
+            if self.framed:
+                reply = self.recv_frame()
+            else:
+                reply = self.recv_bytewise()
+            self.t_recv_ns = perf_counter_ns()
+            self.last_sendstr = sendstr
+            if reply is None:
+                self._flush()
+                self.last_reply = None
+                results += [(None, None)] * (len(cmdstrs) - len(results))
+                break
+            self.latency.record(sendstr, t_send_ns, self.t_recv_ns)
+            reply = self._decode(reply)
+            self.last_reply = reply
+            pumpid, pumpstatus, pumpreply = parse_pump_reply(idstr, sendstr, reply)
+            self.last_pumpid = pumpid
+            self.last_pumpstatus = pumpstatus
+            self.last_pumpreply = pumpreply
+            results.append((pumpstatus, pumpreply))
+        return results
     
     def close(self):
         self.ser.close()
 
 
 
+class AsyncAladdin:
+    """asyncio version of Aladdin, with the same command semantics
+
+        ala = await AsyncAladdin.open(port_str)
+        pump_status, pump_reply = await ala.pump_cmd('01', 'DIS')
+
+    The reply frame is received with a single timeout (`ser_timeout`) for the
+    whole frame, instead of a timeout per character."""
+    def __init__(self, port_str, baudrate = 9600):
+        self.port_str = port_str
+        self.ser_timeout = 1.0
+        self.baudrate = baudrate
+        self.ser = AsyncSerial(port_str,
+                               baudrate = self.baudrate,
+                               timeout = self.ser_timeout,
+                               trace_name = 'AsyncAladdin '+port_str)
+        self.ser.read_waiting() # flush buffer
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.last_sendstr = None
+        self.last_reply = None
+        self.last_pumpid = None
+        self.last_pumpstatus = None
+        self.last_pumpreply = None
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('AsyncAladdin '+port_str)
+
+    @classmethod
+    async def open(cls, port_str, baudrate = 9600):
+        return cls(port_str, baudrate)
+
+    async def send_recv(self, sendstr_in):
+        async with self.lock:
+            self.last_sendstr = sendstr_in
+            sendstr = sendstr_in.encode(encoding='ascii') + b'\r'
+            self.t_send_ns = perf_counter_ns()
+            await self.ser.write(sendstr)
+            readch = await self.ser.read(1)
+            if len(readch) == 0:
+                reply = None
+            elif readch[0] != STX:
+                print('Warning: STX not received')
+                reply = readch + self.ser.read_waiting()
+            else:
+                reply = await self.ser.read_until(bytes([ETX]))
+                if reply.endswith(bytes([ETX])):
+                    reply = reply[:-1]
+            self.t_recv_ns = perf_counter_ns()
+            if reply is not None:
+                self.latency.record(sendstr_in, self.t_send_ns, self.t_recv_ns)
+                try:
+                    reply = reply.decode(encoding='ascii')
+                except UnicodeDecodeError:
+                    print("Error in decoding reply from pump. Check communication cables.")
+                    await asyncio.sleep(self.ser_timeout) # wait a while
+                    self.ser.read_waiting() # flush buffer
+                    reply = "<COMMUNICATION ERROR>"
+            self.last_reply = reply
+        return reply
+
+    async def pump_cmd(self, idstr: str, cmdstr: str ) -> (str, str):
+        sendstr = idstr + cmdstr
+        reply = await self.send_recv(sendstr)
+        pumpid, pumpstatus, pumpreply = parse_pump_reply(idstr, sendstr, reply)
+        self.last_pumpid = pumpid
+        self.last_pumpstatus = pumpstatus
+        self.last_pumpreply = pumpreply
+        return (pumpstatus, pumpreply)
+
+    def close(self):
+        self.ser.close()
+
+
+
 if __name__=='__main__':
     # TODO put some self test code here
     pass
@@ -0,0 +1,321 @@
+"""
+Shared RS232 bus for networked Aladdin pumps
+
+Aladdin pumps can be daisy-chained on a single serial port, each pump having
+its own address (pump ID). Only one `Aladdin` object (one `serial.Serial`) can
+own the port. `AladdinBus` owns this connection and hands out any number of
+handles (`AladdinBusHandle`) that have the same interface as `Aladdin`, so that
+several controllers (e.g. several GUI apps in one process) can use pumps on the
+same port.
+
+All commands are executed by a single bus thread, one command at a time,
+back-to-back. The pending commands of the different handles are served
+round-robin (one command per handle per turn), so that no handle can starve
+the others. A handle can also register a periodic poll (typically 'DIS' once
+per second), which takes the handle's turn when it has no pending command.
+
+    h1 = AladdinBus.attach('COM4')
+    h2 = AladdinBus.attach('COM4') # same bus, same serial port
+    h1.pump_cmd('01', 'RUN')
+    h1.pump_cmds('01', ['DIA', 'RAT', 'DIS']) # series, one turn on the bus
+    h2.set_poll('02', 'DIS', 1.0)
+    ...
+    print(h2.poll_result)
+    print(AladdinBus.get('COM4').stats())
+    h1.close()
+    h2.close() # last handle closes the serial port
+"""
+
+import threading
+from collections import deque
+from time import monotonic
+
+from .aladdin import Aladdin
+
+
+
+class _BusJob:
+    """A single command waiting for its turn on the bus"""
+    def __init__(self, idstr, cmdstr, depth = None):
+        self.idstr = idstr
+        self.cmdstr = cmdstr # list of commands for a pipelined series
+        self.depth = depth
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.sendstr = None
+        self.reply = None
+        self.pumpid = None
+
+
+
+class AladdinBusHandle:
+    """Handle on an AladdinBus, usable in place of an `Aladdin` object"""
+    def __init__(self, bus):
+        self.bus = bus
+        self.port_str = bus.port_str
+        self.jobs = deque()
+        self.closed = False
+        # poll configuration and last poll result
+        self.poll_idstr = None
+        self.poll_cmdstr = None
+        self.poll_period = None
+        self.poll_next = 0.0
+        self.poll_result = None # (monotonic time, pumpstatus, pumpreply)
+        self.poll_count = 0
+        # same attributes as Aladdin
+        self.last_sendstr = None
+        self.last_reply = None
+        self.last_pumpid = None
+        self.last_pumpstatus = None
+        self.last_pumpreply = None
+        # statistics
+        self.ncmd = 0
+        self.t_busy = 0.0
+
+    def pump_cmd(self, idstr: str, cmdstr: str) -> (str, str):
+        """Send command to pump `idstr` and wait for the reply.
+
+        Same semantics as `Aladdin.pump_cmd`."""
+        job = self.bus.submit(self, idstr, cmdstr)
+        job.done.wait()
+        if job.exception is not None:
+            raise job.exception
+        self.last_sendstr, self.last_reply = job.sendstr, job.reply
+        (self.last_pumpid,
+         self.last_pumpstatus,
+         self.last_pumpreply) = job.pumpid, *job.result
+        return job.result
+
+    def pump_cmds(self, idstr, cmdstrs, depth = 1):
+        """Pipelined series of commands, as `Aladdin.pump_cmds`.
+
+        The whole series takes a single turn on the bus."""
+        if not cmdstrs:
+            return []
+        job = self.bus.submit(self, idstr, list(cmdstrs), depth)
+        job.done.wait()
+        if job.exception is not None:
+            raise job.exception
+        self.last_sendstr, self.last_reply = job.sendstr, job.reply
+        return job.result
+
+    def send_recv(self, sendstr_in):
+        """Raw command (with pump ID prepended), as `Aladdin.send_recv`"""
+        job = self.bus.submit(self, None, sendstr_in)
+        job.done.wait()
+        if job.exception is not None:
+            raise job.exception
+        self.last_sendstr, self.last_reply = job.sendstr, job.reply
+        return job.reply
+
+    def set_poll(self, idstr, cmdstr, period):
+        """Have the bus send `cmdstr` to pump `idstr` every `period` seconds.
+
+        The last result is available in `poll_result`."""
+        with self.bus.cv:
+            self.poll_idstr = idstr
+            self.poll_cmdstr = cmdstr
+            self.poll_period = period
+            self.poll_next = monotonic()
+            self.bus.cv.notify()
+
+    def clear_poll(self):
+        with self.bus.cv:
+            self.poll_period = None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.bus.release(self)
+
+
+
+class AladdinBus:
+    # one bus per serial port (in this process)
+    _buses = {}
+    _buses_lock = threading.Lock()
+
+    @classmethod
+    def attach(cls, port_str, baudrate = 9600):
+        """Get a new handle on the bus of `port_str`. Opens the port if needed.
+
+        Raises serial.SerialException if the port can not be opened."""
+        with cls._buses_lock:
+            bus = cls._buses.get(port_str)
+            if bus is None:
+                bus = cls(port_str, baudrate)
+                cls._buses[port_str] = bus
+            return bus.new_handle()
+
+    @classmethod
+    def get(cls, port_str):
+        """The currently open bus for `port_str` (or None)"""
+        with cls._buses_lock:
+            return cls._buses.get(port_str)
+
+    def __init__(self, port_str, baudrate = 9600):
+        self.port_str = port_str
+        self.baudrate = baudrate
+        self.aladdin = Aladdin(port_str, baudrate)
+        self.handles = []
+        self.cv = threading.Condition()
+        self.rr_next = 0 # round-robin position in self.handles
+        self.running = True
+        # statistics
+        self.t_start = monotonic()
+        self.t_busy = 0.0
+        self.ncmd = 0
+        self.npoll = 0
+        self.ntimeout = 0
+        self.nchars = 0 # characters on the line (both directions)
+        self.thread = threading.Thread(target = self._run,
+                                       name = 'AladdinBus '+port_str,
+                                       daemon = True)
+        self.thread.start()
+
+    def new_handle(self):
+        handle = AladdinBusHandle(self)
+        with self.cv:
+            self.handles.append(handle)
+        return handle
+
+    def release(self, handle):
+        with AladdinBus._buses_lock:
+            with self.cv:
+                if handle in self.handles:
+                    self.handles.remove(handle)
+                for job in handle.jobs:
+                    job.exception = IOError('AladdinBus handle closed')
+                    job.done.set()
+                handle.jobs.clear()
+                last = (len(self.handles) == 0)
+                if last:
+                    self.running = False
+                self.cv.notify()
+            if last:
+                # close the port before anyone can re-open it
+                self.thread.join()
+                self.aladdin.close()
+                AladdinBus._buses.pop(self.port_str, None)
+
+    def submit(self, handle, idstr, cmdstr, depth = None):
+        job = _BusJob(idstr, cmdstr, depth)
+        with self.cv:
+            if handle.closed or not self.running:
+                raise IOError('AladdinBus handle closed')
+            handle.jobs.append(job)
+            self.cv.notify()
+        return job
+
+    def _next_job(self, tnow):
+        # Round-robin over the handles, starting after the handle served last.
+        # Returns (handle, job, is_poll) or None, and the time until the
+        # next poll is due (None if no polls).
+        nh = len(self.handles)
+        twait = None
+        for k in range(nh):
+            i = (self.rr_next + k) % nh
+            handle = self.handles[i]
+            if handle.jobs:
+                self.rr_next = i + 1
+                return (handle, handle.jobs.popleft(), False), 0.0
+            if handle.poll_period is not None:
+                if tnow >= handle.poll_next:
+                    self.rr_next = i + 1
+                    # keep rhythm, do not execute missed polls
+                    while handle.poll_next <= tnow:
+                        handle.poll_next += handle.poll_period
+                    job = _BusJob(handle.poll_idstr, handle.poll_cmdstr)
+                    return (handle, job, True), 0.0
+                dt = handle.poll_next - tnow
+                if (twait is None) or (dt < twait):
+                    twait = dt
+        return None, twait
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while True:
+                    if not self.running:
+                        return
+                    item, twait = self._next_job(monotonic())
+                    if item is not None:
+                        break
+                    self.cv.wait(twait)
+            handle, job, is_poll = item
+            t0 = monotonic()
+            try:
+                self._execute(job)
+                t1 = monotonic()
+                with self.cv:
+                    self.t_busy += t1 - t0
+                    handle.t_busy += t1 - t0
+                    handle.ncmd += 1
+                    if is_poll:
+                        self.npoll += 1
+                        if job.exception is None:
+                            handle.poll_result = (t1, *job.result)
+                            handle.poll_count += 1
+                    else:
+                        self.ncmd += 1
+            finally:
+                job.done.set() # the caller never waits forever
+
+    def _execute(self, job):
+        ala = self.aladdin
+        nchars = 0
+        try:
+            if job.depth is not None:
+                job.result = ala.pump_cmds(job.idstr, job.cmdstr, job.depth)
+                job.reply = ala.last_reply
+                # all but the last command (counted below)
+                for cmdstr, (status, reply) in zip(job.cmdstr[:-1], job.result):
+                    nchars += len(job.idstr + cmdstr) + 1
+                    if reply is not None:
+                        nchars += len(job.idstr) + len(reply) + 3
+            elif job.idstr is None:
+                job.reply = ala.send_recv(job.cmdstr)
+                job.result = None
+            else:
+                job.result = ala.pump_cmd(job.idstr, job.cmdstr)
+                job.reply = ala.last_reply
+                job.pumpid = ala.last_pumpid
+        except Exception as ex:
+            # e.g. AssertionError on unexpected reply, passed to the caller
+            job.exception = ex
+            job.reply = ala.last_reply
+        job.sendstr = ala.last_sendstr
+        # line occupation: command + CR, reply + STX/ETX (no last_sendstr:
+        # nothing sent yet on this bus)
+        if ala.last_sendstr is not None:
+            self.nchars += nchars + len(ala.last_sendstr) + 1
+        if job.reply is None:
+            self.ntimeout += 1
+        else:
+            self.nchars += len(job.reply) + 2
+
+    def stats(self):
+        """Bus utilization report (dict)
+
+        `utilization` is the fraction of time the bus was busy with a command
+        (including waiting for the pump to reply), `line_utilization` is the
+        fraction of the line capacity (baudrate, 10 bits per character) used
+        for actually transferring characters."""
+        with self.cv:
+            elapsed = monotonic() - self.t_start
+            rep = {'port': self.port_str,
+                   'elapsed_s': elapsed,
+                   'busy_s': self.t_busy,
+                   'utilization': self.t_busy / elapsed,
+                   'line_utilization': 10*self.nchars / (self.baudrate*elapsed),
+                   'commands': self.ncmd,
+                   'polls': self.npoll,
+                   'timeouts': self.ntimeout,
+                   'cmd_rate': (self.ncmd + self.npoll) / elapsed,
+                   'latency': self.aladdin.latency.summary(),
+                   'handles': [{'commands': h.ncmd,
+                                'busy_s': h.t_busy,
+                                'poll': h.poll_cmdstr if h.poll_period else None}
+                               for h in self.handles]}
+        return rep
@@ -0,0 +1,301 @@
+"""
+Shadow copy of the configuration of an Aladdin pump
+
+Configuring a pump the safe way (write every setting, one round trip each)
+takes a dozen or more round trips. `AladdinShadow` reads the configuration
+of the pump once, with a query sweep (`Aladdin.pump_cmds`, pipelined if
+`depth` > 1), and then only sends the setting commands whose values differ
+from that copy:
+
+    shadow = AladdinShadow.get(ala, '01')
+    if shadow.refresh(): # sweep the first time, later only 'DIS' or CHECK
+        sent = shadow.apply(['PHN2', 'FUNSTP', 'PHN1', 'FUNRAT',
+                             'DIA14.60', 'RAT1.0UM', 'DIRINF', 'CLDINF'])
+        for cmdstr, pump_status, pump_reply in sent:
+            ...
+        errors = shadow.verify() # optional: read back and compare
+
+`ala` is an `Aladdin` or an `AladdinBusHandle`. There is one shadow copy per
+port and pump ID (in this process). Call `invalidate()` when the port is
+closed: the pump may be changed while nobody is watching (syringe swap,
+power cycle, another pump on the address), so the next `refresh()` first
+checks the firmware version, syringe diameter and volume units (CHECK, 3
+queries) and reads it all again only if they differ.
+Commands sent to the pump by other means should be passed to `note()`, so
+that the copy stays up to date. The commands given to
+`apply` are the usual command strings, executed in order:
+
+    setting commands (DIA, RAT, VOL, DIR, FUN, PF with an argument) are only
+        sent if the value differs from the shadow copy; the pump's number
+        format (4 significant digits) is taken into account
+    PHN selects the program phase (RAT, VOL, DIR and FUN are per phase); it
+        is only sent when a setting in that phase has to be sent
+    STP is only sent if the pump is not stopped (status 'S'; STP also
+        resets a paused program), CLDINF/CLDWDR only if the dispensed volume
+        is not 0, VER and queries are not sent at all
+    anything else is always sent
+
+The shadow copy is only valid as long as nobody else changes the pump (front
+panel, power cycle, other programs); `sweep()` again, or `verify()`, when in
+doubt. Writing DIA makes the volume settings and the dispensed volumes
+unknown (they are sent or read again).
+"""
+
+# query sweep: ends in phase 1, the phase used for normal operation
+SWEEP = ['VER', 'PF', 'DIA', 'PHN2', 'FUN', 'PHN1', 'FUN', 'RAT', 'DIR',
+         'VOL', 'DIS']
+# quick check of a known pump after the port was closed (see refresh)
+CHECK = ['VER', 'DIA', 'DIS']
+
+# settings with a value per program phase
+PHASED = ['FUN', 'RAT', 'VOL', 'DIR']
+NUMERIC = ['DIA', 'RAT', 'VOL']
+SETTINGS = ['PF', 'DIA'] + PHASED
+
+_shadows = {} # (port_str, idstr) -> AladdinShadow
+
+
+
+def split_cmd(cmdstr):
+    """'RAT1.5UM' -> ('RAT', '1.5UM'), 'DIRINF' -> ('DIR', 'INF')"""
+    cmdstr = cmdstr.strip().upper()
+    for prefix in ['DIR', 'CLD', 'FUN']:
+        if cmdstr.startswith(prefix):
+            return prefix, cmdstr[len(prefix):]
+    j = 0
+    while j < len(cmdstr) and cmdstr[j].isalpha():
+        j += 1
+    return cmdstr[:j], cmdstr[j:]
+
+
+def normalize(key, value):
+    """Comparable form of a setting value ('0.50' and '0.500ML' -> (0.5, 'ML'))"""
+    if value is None:
+        return None
+    if key not in NUMERIC:
+        return value.strip().upper()
+    value = value.strip().upper()
+    j = len(value)
+    while j > 0 and value[j-1].isalpha():
+        j -= 1
+    try:
+        x = float('{0:.4g}'.format(float(value[:j])))
+    except ValueError:
+        return value
+    return (x, value[j:])
+
+
+def parse_dis(reply):
+    """'I0.250W0.000ML' -> ((0.25, 0.0), 'ML')"""
+    try:
+        dispensed = (float(reply[1:reply.index('W')]),
+                     float(reply[reply.index('W')+1:-2]))
+    except ValueError:
+        dispensed = (None, None)
+    return dispensed, reply[-2:]
+
+
+def same(key, a, b):
+    a, b = normalize(key, a), normalize(key, b)
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        # units only count when both sides have them
+        return (a[0] == b[0]) and ((a[1] == b[1]) or not (a[1] and b[1]))
+    return a == b
+
+
+
+class AladdinShadow:
+    def __init__(self, ala, idstr, depth = 1):
+        self.ala = ala
+        self.idstr = idstr
+        self.depth = depth
+        self.valid = False
+        self.stale = False # port was closed: check before use
+        self.settings = {} # (phase, key) -> value as read/written
+        self.phase = None
+        self.status = None # pump status letter of the last reply
+        self.dispensed = None # (infused, withdrawn) as read with DIS
+        self.units = None # volume units, 'UL' or 'ML'
+        self.version = None
+        self.nsent = 0 # statistics: commands sent by apply
+        self.nsweep = 0
+        self.ncheck = 0
+
+    @classmethod
+    def get(cls, ala, idstr, depth = 1):
+        """The shadow copy of pump `idstr` on the port of `ala`"""
+        key = (ala.port_str, idstr)
+        shadow = _shadows.get(key)
+        if shadow is None:
+            shadow = cls(ala, idstr, depth)
+            _shadows[key] = shadow
+        shadow.ala = ala # the port may have been re-opened
+        shadow.depth = depth
+        return shadow
+
+    def _read(self):
+        # query sweep -> (settings, phase, status, dispensed, units, version)
+        # or None if the pump did not reply
+        replies = self.ala.pump_cmds(self.idstr, SWEEP, self.depth)
+        if any(status is None for status, reply in replies):
+            return None
+        settings = {}
+        phase = None
+        for cmdstr, (status, reply) in zip(SWEEP, replies):
+            key, arg = split_cmd(cmdstr)
+            if key == 'PHN':
+                # phase not selected (e.g. pump running): phase unknown
+                phase = None if reply.startswith('?') else int(arg)
+            elif key in SETTINGS:
+                # unsupported query ('?...'): value unknown, always send
+                unknown = reply.startswith('?') or\
+                    ((key in PHASED) and (phase is None))
+                value = None if unknown else reply
+                settings[(phase if key in PHASED else 0, key)] = value
+        status, dis = replies[-1]
+        return (settings, phase, status) + parse_dis(dis) + (replies[0][1],)
+
+    def sweep(self):
+        """Read the configuration of the pump. Returns False if no reply.
+
+        The sweep selects program phase 2, then phase 1 (to read the
+        functions of both phases): the pump is left in phase 1."""
+        result = self._read()
+        self.nsweep += 1
+        self.valid = result is not None
+        self.stale = False
+        if self.valid:
+            (self.settings, self.phase, self.status, self.dispensed,
+             self.units, self.version) = result
+        return self.valid
+
+    def invalidate(self):
+        """Port closed: the next refresh() checks the pump first"""
+        self.stale = True
+
+    def check(self):
+        """Quick check (CHECK) that the pump still matches the copy: same
+        firmware version, syringe diameter and volume units. Updates the
+        status and dispensed volumes. Returns False if it differs."""
+        replies = self.ala.pump_cmds(self.idstr, CHECK, self.depth)
+        self.ncheck += 1
+        if any(status is None for status, reply in replies):
+            return False
+        (_, version), (_, dia), (status, dis) = replies
+        dispensed, units = parse_dis(dis)
+        if (version != self.version) or (units != self.units) or\
+                not same('DIA', dia, self.settings.get((0, 'DIA'))):
+            return False
+        self.status, self.dispensed = status, dispensed
+        self.phase = None # may have been changed: selected again when needed
+        self.stale = False
+        return True
+
+    def refresh(self):
+        """Sweep if there is no valid copy, check (CHECK) if the port was
+        closed and sweep if that fails, otherwise only read the status and
+        dispensed volumes. Returns False if no reply."""
+        if self.valid and self.stale and self.check():
+            return True
+        if (not self.valid) or self.stale:
+            return self.sweep()
+        (status, reply), = self.ala.pump_cmds(self.idstr, ['DIS'], self.depth)
+        self.note('DIS', status, reply)
+        return self.valid
+
+    def note(self, cmdstr, status, reply):
+        """Update the shadow copy with a command sent to the pump"""
+        if status is None:
+            self.valid = False # lost track of the pump
+            return
+        self.status = status
+        if reply.startswith('?'):
+            return # error: nothing changed
+        key, arg = split_cmd(cmdstr)
+        if key == 'PHN' and arg:
+            self.phase = int(arg)
+        elif key in SETTINGS and arg:
+            self.settings[(self.phase if key in PHASED else 0, key)] = arg
+            if key == 'DIA':
+                # volumes in the new units: not known anymore
+                for skey in self.settings:
+                    if skey[1] == 'VOL':
+                        self.settings[skey] = None
+                self.dispensed = (None, None)
+                self.units = None
+        elif key == 'CLD':
+            i = 0 if arg == 'INF' else 1
+            self.dispensed = self.dispensed[:i] + (0.0,) +\
+                self.dispensed[i+1:]
+        elif key == 'DIS':
+            self.dispensed, self.units = parse_dis(reply)
+
+    def plan(self, cmdstrs):
+        """The commands of `cmdstrs` that have to be sent (list)"""
+        assert self.valid, 'no shadow copy, sweep() first'
+        todo = []
+        phase = self.phase # phase of the pump after the commands in todo
+        want_phase = self.phase # phase selected by cmdstrs
+        for cmdstr in cmdstrs:
+            key, arg = split_cmd(cmdstr)
+            if key == 'PHN':
+                want_phase = int(arg)
+                continue
+            if (key == 'VER') or ((key in SETTINGS) and not arg):
+                continue # queries: already known
+            if key in SETTINGS:
+                skey = (want_phase if key in PHASED else 0, key)
+                if same(key, self.settings.get(skey), arg):
+                    continue
+            elif key == 'STP':
+                if self.status == 'S':
+                    continue
+            elif key == 'CLD':
+                i = 0 if arg == 'INF' else 1
+                if self.dispensed[i] == 0.0:
+                    continue
+            if (key in PHASED) and (want_phase is not None)\
+                    and (phase != want_phase):
+                todo.append('PHN{0:d}'.format(want_phase))
+                phase = want_phase
+            todo.append(cmdstr)
+        if (want_phase is not None) and (phase != want_phase):
+            # leave the pump in the phase selected by cmdstrs
+            todo.append('PHN{0:d}'.format(want_phase))
+        return todo
+
+    def apply(self, cmdstrs):
+        """Send the commands of `cmdstrs` that change something (one series)
+
+        Returns [(cmdstr, pump_status, pump_reply)] of the commands sent.
+        The shadow copy is updated with the accepted settings (a reply
+        starting with '?' is an error: setting not changed)."""
+        todo = self.plan(cmdstrs)
+        if not todo:
+            return []
+        replies = self.ala.pump_cmds(self.idstr, todo, self.depth)
+        self.nsent += len(todo)
+        for cmdstr, (status, reply) in zip(todo, replies):
+            self.note(cmdstr, status, reply)
+            if status is None:
+                break
+        return [(cmdstr, status, reply)
+                for cmdstr, (status, reply) in zip(todo, replies)]
+
+    def verify(self):
+        """Read back the configuration and compare with the shadow copy.
+
+        Returns a list of differences (strings); empty if all is well."""
+        result = self._read()
+        if result is None:
+            return ['no reply from pump']
+        settings = result[0]
+        errors = []
+        for skey, value in sorted(self.settings.items()):
+            if (value is not None) and not same(skey[1], settings.get(skey), value):
+                errors.append('{0:s} (phase {1:d}): expected {2:s}, read {3!s}'\
+                              .format(skey[1], skey[0], value, settings.get(skey)))
+        self.settings, self.phase, self.status, self.dispensed, self.units,\
+            self.version = result
+        self.valid = True
+        return errors
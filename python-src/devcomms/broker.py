@@ -0,0 +1,366 @@
+"""
+Serial port broker: share devices between several programs
+
+Only one process can open a given serial port. The broker is a small local
+server that owns the serial ports, and serves the device methods over a
+socket (TCP on localhost, or a Unix domain socket). Programs use drop-in
+proxies instead of the real device classes:
+
+    from devcomms.broker import Aladdin_proxy as Aladdin
+    from devcomms.broker import MOLTECH_FSS_proxy as MOLTECH_FSS
+    from devcomms.broker import VICI_TTL_proxy as VICI_TTL
+
+A device is opened by the broker when the first client asks for it, and stays
+open for all later clients (no re-open and re-initialization costs). Several
+Aladdin pumps on one port share the same connection.
+
+Start the broker with
+
+    python -m devcomms.broker                          (tcp://127.0.0.1:7650)
+    python -m devcomms.broker unix:///tmp/devcomms.sock
+
+Protocol: one JSON object per line. Requests
+
+    {"id": 1, "op": "open", "kind": "aladdin", "port": "COM4"}
+    {"id": 2, "op": "call", "port": "COM4", "method": "pump_cmd",
+     "args": ["01", "DIS"]}
+
+are answered by {"id": ..., "result": ...} or
+{"id": ..., "error": "AssertionError", "message": "..."}. A line that is not
+a JSON object is answered by {"id": null, "error": "ValueError", ...}, and
+the connection stays open. Requests are pipelined: a client may send many
+requests without waiting for replies.
+Requests for different devices are executed concurrently (using the asyncio
+drivers), requests for the same device are executed in order of arrival.
+Replies come back as soon as they are ready, and are matched to the requests
+by their "id".
+"""
+
+import sys
+import json
+import socket
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import serial
+
+from .aladdin import AsyncAladdin, parse_pump_reply
+from .moltech_fss import AsyncFSS
+from .vici_ttl import AsyncVICI_TTL
+
+
+DEFAULT_BROKER = 'tcp://127.0.0.1:7650'
+
+# device kinds served by the broker, with the methods that clients may call
+# and the attributes that are sent to the client on opening
+DEVICE_KINDS = {
+    'aladdin': (AsyncAladdin, ['send_recv', 'pump_cmd'], []),
+    'fss': (AsyncFSS, ['get_measurement'], ['name', 'info']),
+    'vici_ttl': (AsyncVICI_TTL, ['sendrecv', 'get_pos', 'set_pos'], []),
+}
+
+# exceptions that are re-raised as such in the client
+_EXCEPTIONS = {'AssertionError': AssertionError,
+               'ValueError': ValueError,
+               'OSError': OSError,
+               'SystemError': SystemError,
+               'SerialException': serial.SerialException}
+
+
+
+def _encode(value):
+    # JSON has no bytes type (VICI_TTL.sendrecv returns bytes)
+    if isinstance(value, bytes):
+        return {'bytes': value.decode('latin-1')}
+    if isinstance(value, (tuple, list)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and 'bytes' in value:
+        return value['bytes'].encode('latin-1')
+    if isinstance(value, list):
+        return tuple(_decode(v) for v in value)
+    return value
+
+
+def _parse_address(address):
+    if address.startswith('unix://'):
+        return 'unix', address[len('unix://'):]
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        return 'tcp', (host, int(port))
+    raise ValueError('Unknown broker address: '+address)
+
+
+
+####
+# Broker (server side)
+
+class Broker:
+    def __init__(self, address = DEFAULT_BROKER):
+        self.address = address
+        self.devices = {} # port_str -> (kind, async device object)
+        self.opening = {} # port_str -> asyncio.Lock (one opening at a time)
+        self.ncalls = 0
+
+    async def open_device(self, kind, port):
+        lock = self.opening.setdefault(port, asyncio.Lock())
+        async with lock:
+            if port in self.devices:
+                devkind, dev = self.devices[port]
+                if devkind != kind:
+                    raise ValueError('port '+port+' already in use for '+devkind)
+            else:
+                cls = DEVICE_KINDS[kind][0]
+                dev = await cls.open(port)
+                self.devices[port] = (kind, dev)
+                print('broker: opened', kind, 'on', port)
+        attrs = DEVICE_KINDS[kind][2]
+        return {a: getattr(dev, a) for a in attrs}
+
+    async def call(self, port, method, args):
+        kind, dev = self.devices[port]
+        if method not in DEVICE_KINDS[kind][1]:
+            raise ValueError('method not available: '+method)
+        args = [_decode(a) for a in args]
+        self.ncalls += 1
+        return await getattr(dev, method)(*args)
+
+    async def handle_request(self, req, writer):
+        try:
+            if req['op'] == 'open':
+                result = await self.open_device(req['kind'], req['port'])
+            elif req['op'] == 'call':
+                result = await self.call(req['port'], req['method'],
+                                         req.get('args', []))
+            else:
+                raise ValueError('unknown op: '+str(req['op']))
+            rep = {'id': req['id'], 'result': _encode(result)}
+        except Exception as ex:
+            name = type(ex).__name__
+            if isinstance(ex, OSError) and name not in _EXCEPTIONS:
+                name = 'OSError'
+            rep = {'id': req.get('id'), 'error': name, 'message': str(ex)}
+        writer.write(json.dumps(rep).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line)
+                    if not isinstance(req, dict):
+                        raise ValueError('request is not a JSON object')
+                except ValueError as ex:
+                    # bad line: tell the client, keep the connection
+                    rep = {'id': None, 'error': 'ValueError',
+                           'message': str(ex)}
+                    writer.write(json.dumps(rep).encode('utf-8') + b'\n')
+                    await writer.drain()
+                    continue
+                # do not wait for the reply: next request can come in
+                task = asyncio.ensure_future(self.handle_request(req, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        family, addr = _parse_address(self.address)
+        if family == 'unix':
+            server = await asyncio.start_unix_server(self.handle_client, addr)
+        else:
+            server = await asyncio.start_server(self.handle_client, *addr)
+        print('broker: serving on', self.address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for kind, dev in self.devices.values():
+                dev.close()
+
+
+
+####
+# Client side
+
+class BrokerClient:
+    """Connection to the broker, shared by all proxies in this process.
+
+    `call_async` sends a request and returns a concurrent.futures.Future
+    without waiting for the reply (pipelining). `call` waits for the reply."""
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, address = DEFAULT_BROKER):
+        with cls._clients_lock:
+            client = cls._clients.get(address)
+            if client is None or client.closed:
+                client = cls(address)
+                cls._clients[address] = client
+            return client
+
+    def __init__(self, address = DEFAULT_BROKER):
+        self.address = address
+        family, addr = _parse_address(address)
+        if family == 'unix':
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(addr)
+        self.rfile = self.sock.makefile('rb')
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {} # request id -> Future
+        self.closed = False
+        self.thread = threading.Thread(target = self._reader,
+                                       name = 'BrokerClient '+address,
+                                       daemon = True)
+        self.thread.start()
+
+    def _reader(self):
+        try:
+            for line in self.rfile:
+                rep = json.loads(line)
+                with self.lock:
+                    fut = self.pending.pop(rep['id'], None)
+                if fut is None:
+                    continue
+                if 'error' in rep:
+                    exc = _EXCEPTIONS.get(rep['error'], RuntimeError)
+                    fut.set_exception(exc(rep['message']))
+                else:
+                    fut.set_result(_decode(rep['result']))
+        except OSError:
+            pass
+        # connection lost: fail whatever is still waiting
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for fut in pending:
+            fut.set_exception(OSError('connection to broker lost'))
+
+    def call_async(self, req):
+        fut = Future()
+        with self.lock:
+            if self.closed:
+                raise OSError('connection to broker lost')
+            self.next_id += 1
+            req['id'] = self.next_id
+            self.pending[self.next_id] = fut
+            self.sock.sendall(json.dumps(req).encode('utf-8') + b'\n')
+        return fut
+
+    def call(self, req):
+        return self.call_async(req).result()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.sock.close()
+
+
+
+class _DeviceProxy:
+    kind = None
+
+    def __init__(self, port_str, broker = DEFAULT_BROKER):
+        self.port_str = port_str
+        self.client = BrokerClient.get(broker)
+        attrs = self.client.call({'op': 'open',
+                                  'kind': self.kind,
+                                  'port': port_str})
+        for name, value in attrs.items():
+            setattr(self, name, value)
+
+    def submit(self, method, *args):
+        """Pipelined call: returns a Future, does not wait for the reply"""
+        return self.client.call_async({'op': 'call',
+                                       'port': self.port_str,
+                                       'method': method,
+                                       'args': _encode(list(args))})
+
+    def _call(self, method, *args):
+        return self.submit(method, *args).result()
+
+    def close(self):
+        # the device itself stays open in the broker, for the other clients
+        pass
+
+
+
+class Aladdin_proxy(_DeviceProxy):
+    """Drop-in for devcomms.aladdin.Aladdin, via the broker"""
+    kind = 'aladdin'
+
+    def __init__(self, port_str, baudrate = 9600, broker = DEFAULT_BROKER):
+        super().__init__(port_str, broker)
+        self.last_sendstr = None
+        self.last_reply = None
+        self.last_pumpid = None
+        self.last_pumpstatus = None
+        self.last_pumpreply = None
+
+    def send_recv(self, sendstr_in):
+        self.last_sendstr = sendstr_in
+        self.last_reply = self._call('send_recv', sendstr_in)
+        return self.last_reply
+
+    def pump_cmd(self, idstr: str, cmdstr: str ) -> (str, str):
+        sendstr = idstr + cmdstr
+        reply = self.send_recv(sendstr)
+        pumpid, pumpstatus, pumpreply = parse_pump_reply(idstr, sendstr, reply)
+        self.last_pumpid = pumpid
+        self.last_pumpstatus = pumpstatus
+        self.last_pumpreply = pumpreply
+        return (pumpstatus, pumpreply)
+
+
+
+class MOLTECH_FSS_proxy(_DeviceProxy):
+    """Drop-in for devcomms.moltech_fss.MOLTECH_FSS, via the broker"""
+    kind = 'fss'
+
+    def __init__(self, port_str, baudrate = 9600, broker = DEFAULT_BROKER):
+        super().__init__(port_str, broker)
+
+    def get_measurement(self):
+        return self._call('get_measurement')
+
+
+
+class VICI_TTL_proxy(_DeviceProxy):
+    """Drop-in for devcomms.vici_ttl.VICI_TTL, via the broker"""
+    kind = 'vici_ttl'
+
+    def sendrecv(self, send_str):
+        self.lastreply = self._call('sendrecv', send_str)
+        return self.lastreply
+
+    def get_pos(self):
+        return self._call('get_pos')
+
+    def set_pos(self, pos):
+        self._call('set_pos', pos)
+
+
+
+if __name__ == '__main__':
+    address = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_BROKER
+    try:
+        asyncio.run(Broker(address).serve())
+    except KeyboardInterrupt:
+        print('broker: stopped')
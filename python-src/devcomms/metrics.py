@@ -0,0 +1,213 @@
+"""
+Counters, gauges and histograms for monitoring long-running programs
+
+Lightweight (no dependencies), thread-safe, for exposing the health of a
+running program in the Prometheus text format, or as JSON:
+
+    metrics = Registry(const_labels = {'instance': '9013'})
+    polls = metrics.histogram('pilot_poll_seconds', 'poll round trip')
+    errors = metrics.counter('pilot_errors_total', 'errors', ['kind'])
+    ...
+    polls.observe(0.012)
+    errors.inc(kind = 'glitch')
+    ...
+    text = metrics.prometheus()
+    d = metrics.as_dict()
+
+`prometheus()` also exports the latency statistics of all devcomms drivers
+(devcomms.timing) as `devcomms_latency_seconds` summaries, unless disabled
+with `device_latency = False`.
+"""
+
+import math
+import threading
+
+from . import timing
+
+
+# histogram buckets (s) for serial round trips and scheduling lateness
+DEFAULT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0)
+
+
+def _fmt(v):
+    if v == math.inf:
+        return '+Inf'
+    if isinstance(v, int):
+        return str(v)
+    return repr(float(v))
+
+
+def _labelstr(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0:s}="{1:s}"'.format(k, str(v).replace('\\', '\\\\')
+                                                         .replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, helpstr, labelnames = ()):
+        self.name = name
+        self.help = helpstr
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {} # label values (tuple) -> value
+
+    def _key(self, labels):
+        assert set(labels) == set(self.labelnames),\
+            '{0:s}: labels should be {1!r}'.format(self.name, self.labelnames)
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def _items(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, n = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def samples(self):
+        for key, v in self._items():
+            yield '', key, v
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, v, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = v
+
+    def samples(self):
+        for key, v in self._items():
+            yield '', key, v
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, helpstr, labelnames = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, helpstr, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, v, **labels):
+        key = self._key(labels)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                # [counts per bucket (not cumulative), sum, max]
+                h = [[0]*len(self.buckets), 0.0, v]
+                self.values[key] = h
+            i = 0
+            while v > self.buckets[i]:
+                i += 1
+            h[0][i] += 1
+            h[1] += v
+            h[2] = max(h[2], v)
+
+    def _items(self):
+        with self.lock:
+            return sorted((key, (list(h[0]), h[1], h[2]))
+                          for key, h in self.values.items())
+
+    def samples(self):
+        for key, (counts, total, vmax) in self._items():
+            n = 0
+            for le, c in zip(self.buckets, counts):
+                n += c
+                yield '_bucket', key + (('le', _fmt(le)),), n
+            yield '_sum', key, total
+            yield '_count', key, n
+
+    def summary(self, key):
+        """{'count', 'sum', 'mean', 'max', 'buckets': {le: cumulative count}}"""
+        counts, total, vmax = dict(self._items())[key]
+        n = sum(counts)
+        cum = 0
+        buckets = {}
+        for le, c in zip(self.buckets, counts):
+            cum += c
+            buckets['+Inf' if le == math.inf else le] = cum
+        return {'count': n, 'sum': total, 'mean': total / max(1, n),
+                'max': vmax, 'buckets': buckets}
+
+
+
+class Registry:
+    def __init__(self, const_labels = None, device_latency = True):
+        self.const_labels = dict(const_labels or {})
+        self.device_latency = device_latency
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, helpstr, labelnames = ()):
+        return self._add(Counter(name, helpstr, labelnames))
+
+    def gauge(self, name, helpstr, labelnames = ()):
+        return self._add(Gauge(name, helpstr, labelnames))
+
+    def histogram(self, name, helpstr, labelnames = (), buckets = DEFAULT_BUCKETS):
+        return self._add(Histogram(name, helpstr, labelnames, buckets))
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format (string)"""
+        const = tuple(self.const_labels.items())
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP {0:s} {1:s}'.format(m.name, m.help))
+            lines.append('# TYPE {0:s} {1:s}'.format(m.name, m.kind))
+            for suffix, key, v in m.samples():
+                labels = const + tuple(zip(m.labelnames, key))
+                labels += tuple(x for x in key[len(m.labelnames):])
+                lines.append(m.name + suffix + _labelstr(labels) + ' ' + _fmt(v))
+        if self.device_latency:
+            lines += self._device_latency(const)
+        return '\n'.join(lines) + '\n'
+
+    def _device_latency(self, const):
+        name = 'devcomms_latency_seconds'
+        lines = ['# HELP {0:s} serial transaction latency per device and command'\
+                     .format(name),
+                 '# TYPE {0:s} summary'.format(name)]
+        for stats in timing.all_stats():
+            for cmd, s in sorted(stats.summary().items()):
+                labels = const + (('device', stats.device), ('cmd', cmd))
+                for q, field in (('0.5', 'median_ms'), ('0.99', 'p99_ms'),
+                                 ('1', 'max_ms')):
+                    lines.append(name + _labelstr(labels + (('quantile', q),))
+                                 + ' ' + _fmt(1e-3 * s[field]))
+                lines.append(name + '_count' + _labelstr(labels)
+                             + ' ' + _fmt(s['n']))
+        return lines
+
+    def as_dict(self):
+        """All metrics as a (JSON serializable) dict"""
+        d = {'labels': self.const_labels}
+        for m in self.metrics:
+            entries = []
+            for key, _ in m._items():
+                entry = dict(zip(m.labelnames, key))
+                if m.kind == 'histogram':
+                    entry.update(m.summary(key))
+                else:
+                    entry['value'] = dict(m._items())[key]
+                entries.append(entry)
+            d[m.name] = entries
+        if self.device_latency:
+            d['devcomms_latency'] = {stats.device: stats.summary()
+                                     for stats in timing.all_stats()
+                                     if stats.cmds}
+        return d
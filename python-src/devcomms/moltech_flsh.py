@@ -8,9 +8,14 @@ Martinus Werts, 2024
 MOLTECH-Anjou, CNRS, Université d'Angers
 """
 
+import asyncio
 import serial
 
-from time import sleep
+from time import sleep, perf_counter_ns
+
+from .aioserial import AsyncSerial
+from .timing import LatencyStats
+from . import trace
 
 class MOLTECH_FLSH:
     def __init__(self, port_str, baudrate=19200):
@@ -21,6 +26,11 @@ class MOLTECH_FLSH:
                                  baudrate = self.baudrate,
                                  timeout = self.ser_timeout)
                                  # default serial: 8N1
+        trace.attach(self.sport, 'MOLTECH_FLSH '+port_str) # if enabled
+        # timestamps (perf_counter_ns) of the last transaction, see timing.py
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('MOLTECH_FLSH '+port_str)
         
         # sleep is important!
         sleep(2.0) # give it some time to wake up (LOTS OF TIME...)
@@ -42,11 +52,18 @@ class MOLTECH_FLSH:
         self.sport.read(self.sport.inWaiting()) # flush
     
         
-    def get_status(self):
+    def get_status(self, cmd=None):
+        # `cmd`: command sent just before (at t_send_ns), of which this
+        # status reply completes the transaction
+        if cmd is None:
+            cmd = '?'
+            self.t_send_ns = perf_counter_ns()
         self.sport.write(b'?')
         self.lastdata = self.sport.read(1)
+        self.t_recv_ns = perf_counter_ns()
         decodata = self.lastdata.decode('ascii')
         if decodata in ['.', '!', 'E']:
+            self.latency.record(cmd, self.t_send_ns, self.t_recv_ns)
             return decodata
         else:
             # some unhandled error occurred?
@@ -54,19 +71,21 @@ class MOLTECH_FLSH:
             return None
   
         
-    def status_OK(self):
-        return (self.get_status() in ['!', '.'])
+    def status_OK(self, cmd=None):
+        return (self.get_status(cmd) in ['!', '.'])
         
         
     def stop(self):
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(b'.')
-        if not self.status_OK():
+        if not self.status_OK('.'):
             raise IOError('MOLTECH-FLSH Flashbox communication error (.)')
         
         
     def go(self):
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(b'!')
-        if not self.status_OK():
+        if not self.status_OK('!'):
             raise IOError('MOLTECH-FLSH Flashbox communication error (!)')
         
     
@@ -77,8 +96,9 @@ class MOLTECH_FLSH:
         # only show up for very short times
         Ntk_period = round(period_s / self.s_per_tick)
         comstr = f'P{Ntk_period}d'
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(comstr.encode('ascii'))
-        if not self.status_OK():
+        if not self.status_OK(comstr):
             raise IOError('MOLTECH-FLSH Flashbox communication error (P)')
         self.Ntk_period = Ntk_period
         self.period_s = Ntk_period * self.s_per_tick
@@ -93,12 +113,14 @@ class MOLTECH_FLSH:
         Ntk_on = 0 # hard-coded, simply start at 0 #TODO introduce phase/offset
         Ntk_off = Ntk_on + Ntk_width
         comstr = f'N{Ntk_on}d'
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(comstr.encode('ascii'))
-        if not self.status_OK():
+        if not self.status_OK(comstr):
             raise IOError('MOLTECH-FLSH Flashbox communication error (N)')
         comstr = f'F{Ntk_off}d'
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(comstr.encode('ascii'))      
-        if not self.status_OK():
+        if not self.status_OK(comstr):
             raise IOError('MOLTECH-FLSH Flashbox communication error (F)')
         self.Ntk_width = Ntk_width
         self.width_s = Ntk_width * self.s_per_tick
@@ -106,3 +128,107 @@ class MOLTECH_FLSH:
 
     def close(self):
         self.sport.close()
+
+
+
+class AsyncFLSH:
+    """asyncio version of MOLTECH_FLSH, with the same command semantics
+
+        flshbx = await AsyncFLSH.open(port_str)
+        await flshbx.set_period_s(0.5)
+    """
+    def __init__(self, port_str, baudrate=19200):
+        self.port_str = port_str
+        self.ser_timeout = 2.0 # better safe than sorry
+        self.baudrate = baudrate
+        self.sport = AsyncSerial(port_str,
+                                 baudrate = self.baudrate,
+                                 timeout = self.ser_timeout,
+                                 trace_name = 'AsyncFLSH '+port_str)
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('AsyncFLSH '+port_str)
+        # set time calibration
+        # 'simple' calibration (for Arduino 16MHz, firmware 1.0)
+        self.s_per_tick = 6.25e-6
+
+    @classmethod
+    async def open(cls, port_str, baudrate=19200):
+        flshbx = cls(port_str, baudrate)
+        try:
+            await flshbx.initialize()
+        except:
+            flshbx.close()
+            raise
+        return flshbx
+
+    async def initialize(self):
+        # sleep is important!
+        await asyncio.sleep(2.0) # give it some time to wake up
+        self.flush_in() # flush buffer (superfluous)
+        # initiate communication
+        if not await self.status_OK():
+            raise SystemError('MOLTECH-FLSH Flashbox initialization error')
+        self.flush_in() # superfluous flush
+
+    def flush_in(self):
+        self.sport.read_waiting() # flush
+
+    async def _get_status(self, cmd=None):
+        # `cmd`: command sent just before, as in MOLTECH_FLSH.get_status
+        if cmd is None:
+            cmd = '?'
+            self.t_send_ns = perf_counter_ns()
+        await self.sport.write(b'?')
+        self.lastdata = await self.sport.read(1)
+        self.t_recv_ns = perf_counter_ns()
+        decodata = self.lastdata.decode('ascii')
+        if decodata in ['.', '!', 'E']:
+            self.latency.record(cmd, self.t_send_ns, self.t_recv_ns)
+            return decodata
+        else:
+            # some unhandled error occurred?
+            self.flush_in() # flush
+            return None
+
+    async def get_status(self):
+        async with self.lock:
+            return await self._get_status()
+
+    async def status_OK(self):
+        return (await self.get_status() in ['!', '.'])
+
+    async def _command(self, comstr, errstr):
+        # send command, and check status in the same transaction
+        async with self.lock:
+            self.t_send_ns = perf_counter_ns()
+            await self.sport.write(comstr.encode('ascii'))
+            if not (await self._get_status(comstr) in ['!', '.']):
+                raise IOError('MOLTECH-FLSH Flashbox communication error '+errstr)
+
+    async def stop(self):
+        await self._command('.', '(.)')
+
+    async def go(self):
+        await self._command('!', '(!)')
+
+    async def set_period_s(self, period_s):
+        # 'simple' single-coefficient calibration, see MOLTECH_FLSH
+        Ntk_period = round(period_s / self.s_per_tick)
+        await self._command(f'P{Ntk_period}d', '(P)')
+        self.Ntk_period = Ntk_period
+        self.period_s = Ntk_period * self.s_per_tick
+
+    async def set_width_s(self, width_s):
+        # 'simple' single-coefficient calibration, see MOLTECH_FLSH
+        Ntk_width = round(width_s / self.s_per_tick)
+        Ntk_on = 0 # hard-coded, simply start at 0 #TODO introduce phase/offset
+        Ntk_off = Ntk_on + Ntk_width
+        await self._command(f'N{Ntk_on}d', '(N)')
+        await self._command(f'F{Ntk_off}d', '(F)')
+        self.Ntk_width = Ntk_width
+        self.width_s = Ntk_width * self.s_per_tick
+
+    def close(self):
+        self.sport.close()
@@ -3,8 +3,17 @@ Communications with MOLTECH-FSS Flow Sensor modules
 
 Serial USB communications.
 """
+import asyncio
+import threading
+from time import perf_counter_ns
+
+import numpy as np
 import serial
 
+from .aioserial import AsyncSerial
+from .timing import LatencyStats, wall_time_ns
+from . import trace
+
 class MOLTECH_FSS:
     def __init__(self, port_str, baudrate=9600):
         self.port_str = port_str
@@ -14,7 +23,12 @@ class MOLTECH_FSS:
                                  baudrate = self.baudrate,
                                  timeout = self.ser_timeout)
                                #default serial: 9600 baud, 8N1
+        trace.attach(self.sport, 'MOLTECH_FSS '+port_str) # if enabled
         self.sport.read(self.sport.inWaiting()) # flush buffer
+        # timestamps (perf_counter_ns) of the last transaction, see timing.py
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('MOLTECH_FSS '+port_str)
         
         # initiate communication
         
@@ -33,6 +47,13 @@ class MOLTECH_FSS:
         self.sport.write(b'I!')
         self.info = self.get_response()
         self.sport.read(self.sport.inWaiting()) # flush
+
+        self.acq_thread = None
+        self.buffer = None
+        self.acq_ntimeout = 0
+        self.acq_ninvalid = 0
+        self.acq_t0_ns = None
+        self.acq_t1_ns = None
         
     def get_response(self):
         self.lastdata = self.sport.read_until(b'!')
@@ -44,14 +65,228 @@ class MOLTECH_FSS:
             return decodata[:-1]
         
     def close(self):
+        self.stop_acquisition()
         self.sport.close()
         
     def get_measurement(self):
+        assert self.acq_thread is None, 'continuous acquisition running'
+        self.t_send_ns = perf_counter_ns()
         self.sport.write(b'M!')
         indata = self.get_response()
+        self.t_recv_ns = perf_counter_ns()
+        if indata is not None:
+            self.latency.record('M', self.t_send_ns, self.t_recv_ns)
         return indata
-        
-    
+
+    # Continuous acquisition
+    #
+    # The firmware handles one command per loop (reply, then 20 ms loop
+    # delay). Commands that arrive while the module is busy wait in its
+    # serial buffer. Keeping `depth` (2) 'M!' requests outstanding, the module
+    # finds the next request waiting as soon as it has answered the previous
+    # one, and samples at its maximum rate, independently of the round trip
+    # time and of the Python side. A background thread sends the requests,
+    # parses the replies and stores them in a ring buffer (FSSRingBuffer).
+
+    def start_acquisition(self, bufsize=100000, depth=2):
+        assert self.acq_thread is None, 'continuous acquisition running'
+        self.sport.read(self.sport.inWaiting()) # flush
+        self.buffer = FSSRingBuffer(bufsize)
+        self.acq_depth = depth
+        self.acq_running = True
+        self.acq_ntimeout = 0
+        self.acq_ninvalid = 0
+        self.acq_t0_ns = perf_counter_ns()
+        self.acq_t0_abs = wall_time_ns(self.acq_t0_ns) # wall time for t = 0
+        self.acq_thread = threading.Thread(target=self._acquire,
+                                           name='FSS '+self.port_str,
+                                           daemon=True)
+        self.acq_thread.start()
+        return self.buffer
+
+    def stop_acquisition(self):
+        if self.acq_thread is None:
+            return
+        self.acq_running = False
+        self.acq_thread.join()
+        self.acq_thread = None
+        self.acq_t1_ns = perf_counter_ns()
+
+    def _acquire(self):
+        sport = self.sport
+        rxbuf = b''
+        inflight = 0
+        while True:
+            if self.acq_running:
+                if inflight < self.acq_depth:
+                    sport.write(b'M!' * (self.acq_depth - inflight))
+                    inflight = self.acq_depth
+            elif inflight == 0:
+                break
+            # wait for (at least) one byte, then take all that is there
+            chunk = sport.read(max(1, sport.in_waiting))
+            t = (perf_counter_ns() - self.acq_t0_ns) * 1e-9
+            if not chunk:
+                # timeout: request or reply lost, start again
+                self.acq_ntimeout += 1
+                rxbuf = b''
+                inflight = 0
+                continue
+            rxbuf += chunk
+            while b'!' in rxbuf:
+                rep, rxbuf = rxbuf.split(b'!', 1)
+                inflight -= 1
+                try:
+                    flow = float(rep)
+                except ValueError:
+                    self.acq_ninvalid += 1
+                    continue
+                self.buffer.push(t, flow)
+            inflight = max(inflight, 0)
+        sport.read(sport.inWaiting()) # flush
+
+    def acquisition_stats(self):
+        """Report on the continuous acquisition (dict)
+
+        `rate` is the achieved sample rate (samples/s), `dropped` counts
+        requests that did not give a sample (invalid replies, timeouts) and
+        `overwritten` the samples lost because the ring buffer was not read
+        in time. All zero if no acquisition has run."""
+        if self.acq_t0_ns is None:
+            t = 0.0
+        elif self.acq_thread is None:
+            t = (self.acq_t1_ns - self.acq_t0_ns) * 1e-9
+        else:
+            t = (perf_counter_ns() - self.acq_t0_ns) * 1e-9
+        buf = self.buffer
+        nwritten = 0 if buf is None else buf.nwritten
+        return {'elapsed_s': t,
+                'samples': nwritten,
+                'rate': nwritten / t if t > 0 else 0.0,
+                'invalid': self.acq_ninvalid,
+                'timeouts': self.acq_ntimeout,
+                'dropped': self.acq_ninvalid + self.acq_ntimeout,
+                'overwritten': 0 if buf is None else buf.noverwritten}
+
+
+
+class FSSRingBuffer:
+    """Preallocated buffer for the last `size` samples (t, flow)
+
+    Written by the acquisition thread. `read_new()` returns the samples
+    that came in since the previous call (in order), `latest(n)` the last
+    n samples. Time t is in seconds (perf_counter, relative to the start
+    of the acquisition)."""
+    def __init__(self, size):
+        self.size = size
+        self.t = np.zeros(size)
+        self.flow = np.zeros(size)
+        self.nwritten = 0 # total number of samples written
+        self.nread = 0 # position of the reader
+        self.noverwritten = 0 # samples overwritten before being read
+        self.lock = threading.Lock()
+
+    def push(self, t, flow):
+        with self.lock:
+            i = self.nwritten % self.size
+            self.t[i] = t
+            self.flow[i] = flow
+            self.nwritten += 1
+
+    def _get(self, nstart, nstop):
+        # samples nstart..nstop-1 (must still be in the buffer)
+        idx = np.arange(nstart, nstop) % self.size
+        return self.t[idx], self.flow[idx]
+
+    def read_new(self):
+        with self.lock:
+            nstart = self.nread
+            if self.nwritten - nstart > self.size:
+                self.noverwritten += self.nwritten - self.size - nstart
+                nstart = self.nwritten - self.size
+            self.nread = self.nwritten
+            return self._get(nstart, self.nwritten)
+
+    def latest(self, n):
+        with self.lock:
+            n = min(n, self.nwritten, self.size)
+            return self._get(self.nwritten - n, self.nwritten)
+
+
+
+
+class AsyncFSS:
+    """asyncio version of MOLTECH_FSS, with the same command semantics
+
+        fss = await AsyncFSS.open(port_str)
+        flow = await fss.get_measurement()
+    """
+    def __init__(self, port_str, baudrate=9600):
+        self.port_str = port_str
+        self.ser_timeout = 2.0 # should be longer than FSS unit timeout
+        self.baudrate = baudrate
+        self.sport = AsyncSerial(port_str,
+                                 baudrate = self.baudrate,
+                                 timeout = self.ser_timeout,
+                                 trace_name = 'AsyncFSS '+port_str)
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.name = None
+        self.info = None
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('AsyncFSS '+port_str)
+
+    @classmethod
+    async def open(cls, port_str, baudrate=9600):
+        fss = cls(port_str, baudrate)
+        try:
+            await fss.initialize()
+        except:
+            fss.close()
+            raise
+        return fss
+
+    async def initialize(self):
+        self.sport.read_waiting() # flush buffer
+
+        # first "dummy cycle" to reset comms
+        await self.sport.write(b'!')
+        await self.sport.read_until(b'!')
+        self.sport.read_waiting() # flush
+
+        # get sensor name
+        await self.sport.write(b'?!')
+        self.name = await self.get_response()
+        self.sport.read_waiting() # flush
+
+        # get sensor info
+        await self.sport.write(b'I!')
+        self.info = await self.get_response()
+        self.sport.read_waiting() # flush
+
+    async def get_response(self):
+        self.lastdata = await self.sport.read_until(b'!')
+        decodata = self.lastdata.decode('ascii')
+        if not decodata.endswith('!'):
+            # invalid reply received
+            return None
+        else:
+            return decodata[:-1]
+
+    def close(self):
+        self.sport.close()
+
+    async def get_measurement(self):
+        async with self.lock:
+            self.t_send_ns = perf_counter_ns()
+            await self.sport.write(b'M!')
+            indata = await self.get_response()
+            self.t_recv_ns = perf_counter_ns()
+            if indata is not None:
+                self.latency.record('M', self.t_send_ns, self.t_recv_ns)
+        return indata
+
+
 
 class MOLTECH_FSS_dummy:
     """Dummy version, for development purposes
@@ -0,0 +1,435 @@
+"""
+Multi-device recipes, compiled to a timeline of device commands
+
+A recipe (JSON, or YAML if PyYAML is installed) describes the devices and one
+cycle of timed steps, repeated `cycles` times every `period` seconds, with
+optional per-cycle parameter sweeps:
+
+    {
+      "name": "inject",
+      "devices": {
+        "pump":  {"kind": "aladdin", "port": "COM4", "id": "01"},
+        "valve": {"kind": "vici_ttl", "port": "COM5"},
+        "flash": {"kind": "flsh", "port": "COM6"}
+      },
+      "start": 10,
+      "period": 1200,
+      "cycles": 6,
+      "sweep": {"rate": ["0.5", "1.0", "2.0"]},
+      "steps": [
+        {"t": 0,    "device": "pump",  "do": "cmd", "arg": "STP"},
+        {"t": 0,    "device": "valve", "do": "pos", "arg": "A"},
+        {"t": 0,    "device": "pump",  "do": "cmd", "arg": "RAT{rate}UM"},
+        {"t": 300,  "device": "pump",  "do": "cmd", "arg": "RUN"},
+        {"t": 900,  "device": "pump",  "do": "cmd", "arg": "STP"},
+        {"t": 1080, "device": "valve", "do": "pos", "arg": "B"},
+        {"t": 1080, "device": "flash", "do": "go"}
+      ]
+    }
+
+Times are in seconds. `start` is the time from the start of the run to the
+first cycle, `t` the time of a step from the start of its cycle. Cycle k
+(0, 1, ...) takes element k of each sweep list (the list is repeated if it
+is shorter than the number of cycles), which is substituted in the string
+arguments ('RAT{rate}UM'); an argument that is only '{name}' is replaced by
+the value itself (e.g. a number). Actions per device kind:
+
+    aladdin     cmd <command string>     (e.g. 'RUN', 'RAT1.0UM')
+    vici_ttl,
+    vici_euha   pos <'A' or 'B'>
+    flsh        go, stop, period <s>, width <s>
+
+`compile_recipe()` expands all cycles into one sorted `Timeline`, and checks
+it before anything is sent: unknown devices and actions, bad arguments,
+steps outside the period, conflicting steps (same setting of the same device
+at the same time; RUN, STP and DIR of a pump are one setting, its run
+state), and the bus time budget. The commands on one serial port are
+executed one after the other, each taking about `CMD_TIME` (or the
+`cmd_time` of the device, in seconds); a step may not be delayed more than
+`tolerance` seconds (recipe, default 0.1 s) by the commands before it on its
+port. All problems are reported together, in one ValueError.
+
+    timeline = compile_recipe(load_recipe('inject.json'))
+    print(timeline.summary())
+    runner = RecipeRunner(timeline)
+    runner.open() # open the devices (see devcomms.startup)
+    runner.start()
+    runner.wait()
+    runner.close()
+
+`RecipeRunner` has one `DeviceWorker` per serial port, which owns the
+devices on that port, and an `EventScheduler` that dispatches the events at
+their planned times. Each event has been compiled to a method name and its
+arguments, bound to the device once (`open()`), so that dispatching an event
+takes constant time. Per event, the planned and actual time and the time
+the command was done are recorded (`runner.records`), and reported per
+cycle.
+"""
+
+import json
+import threading
+from collections import namedtuple
+
+from .timing import clock, EventScheduler
+from .startup import Startup
+from .aladdin_config import split_cmd
+
+
+# one command of the timeline; t: time from the start of the run (s),
+# key: what the command sets (for the conflict check)
+Event = namedtuple('Event', ['t', 'cycle', 'step', 'device', 'method',
+                             'args', 'key', 'cost'])
+
+# estimated duration of one command (s), per device kind
+CMD_TIME = {'aladdin': 0.04, # 9600 baud round trip
+            'vici_ttl': 0.4, # valve switching, firmware pause
+            'vici_euha': 0.4,
+            'flsh': 0.01}
+
+DEFAULT_TOLERANCE = 0.1 # s
+
+# pump commands that change the run state, one key for the conflict check
+RUN_STATE = {'RUN': 'run state', 'STP': 'run state', 'DIR': 'run state'}
+
+
+def _pos(arg):
+    if arg not in ['A', 'B']:
+        raise ValueError("position should be 'A' or 'B'")
+    return (arg,)
+
+def _seconds(arg):
+    x = float(arg)
+    if x <= 0:
+        raise ValueError('time should be > 0')
+    return (x,)
+
+def _pump_cmd(arg):
+    if (arg is None) or not str(arg).strip():
+        raise ValueError('pump command expected')
+    return (str(arg).strip().upper(),)
+
+def _none(arg):
+    if arg is not None:
+        raise ValueError('no argument expected')
+    return ()
+
+# device kind -> {action: (method, argument check -> method args, number
+# of transactions)}
+ACTIONS = {
+    'aladdin': {'cmd': ('pump_cmd', _pump_cmd, 1)},
+    'vici_ttl': {'pos': ('set_pos', _pos, 1)},
+    'vici_euha': {'pos': ('set_pos', _pos, 1)},
+    'flsh': {'go': ('go', _none, 1),
+             'stop': ('stop', _none, 1),
+             'period': ('set_period_s', _seconds, 1),
+             'width': ('set_width_s', _seconds, 2)},
+}
+
+
+
+def load_recipe(path):
+    """Recipe (dict) from a JSON or YAML (.yaml, .yml) file"""
+    with open(path, encoding = 'utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('YAML recipes need PyYAML (pip install pyyaml)')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _substitute(arg, params):
+    if not isinstance(arg, str):
+        return arg
+    name = arg[1:-1]
+    if arg.startswith('{') and arg.endswith('}') and (name in params):
+        return params[name] # the value itself, not as a string
+    return arg.format(**params)
+
+
+def _args(step, dev, check, arg):
+    # method arguments, and what the command sets (for the conflict check)
+    args = check(arg)
+    if dev['kind'] == 'aladdin':
+        key = split_cmd(args[0])[0]
+        # RUN, STP and DIR all set whether (and which way) the pump runs
+        return (dev['id'],) + args, RUN_STATE.get(key, key)
+    return args, step['do']
+
+
+def compile_recipe(recipe):
+    """Check a recipe (dict) and expand it to a `Timeline`"""
+    errors = []
+    devices = recipe.get('devices', {})
+    for name, dev in devices.items():
+        if dev.get('kind') not in ACTIONS:
+            errors.append('device {0:s}: unknown kind {1!r}'.format(
+                name, dev.get('kind')))
+        elif 'port' not in dev:
+            errors.append('device {0:s}: no port'.format(name))
+        elif (dev['kind'] == 'aladdin') and ('id' not in dev):
+            errors.append('device {0:s}: no pump id'.format(name))
+    # one device per port, except Aladdin pumps (several on one bus)
+    ports = {}
+    for name, dev in devices.items():
+        ports.setdefault(dev.get('port'), []).append(dev.get('kind'))
+    for port, kinds in ports.items():
+        if (len(kinds) > 1) and (set(kinds) != {'aladdin'}):
+            errors.append('port {0!s}: only Aladdin pumps can share a port'\
+                          .format(port))
+    sweep = recipe.get('sweep', {})
+    for pname, values in sweep.items():
+        if not (isinstance(values, list) and values):
+            errors.append('sweep {0:s}: should be a non-empty list'.format(pname))
+    try:
+        period = float(recipe['period'])
+        start = float(recipe.get('start', 0.0))
+        ncycles = int(recipe.get('cycles',
+                                 max([len(v) for v in sweep.values()] or [1])))
+        tolerance = float(recipe.get('tolerance', DEFAULT_TOLERANCE))
+        assert (period > 0) and (start >= 0) and (ncycles >= 1)
+    except (KeyError, ValueError, TypeError, AssertionError):
+        errors.append('period (> 0), start (>= 0) and cycles (>= 1) '
+                      'should be numbers')
+    if errors:
+        raise ValueError('recipe:\n  '+'\n  '.join(errors))
+
+    # check the steps once: steps of one cycle, in order of time (steps at
+    # the same time: in the order of the recipe)
+    steps = []
+    for nstep, step in enumerate(recipe.get('steps', [])):
+        where = 'step {0:d}'.format(nstep)
+        try:
+            t = float(step['t'])
+            dev = devices[step['device']]
+            method, check, ntrans = ACTIONS[dev['kind']][step['do']]
+        except (KeyError, ValueError, TypeError) as ex:
+            errors.append(where+': missing or unknown '+str(ex))
+            continue
+        if not (0 <= t < period):
+            errors.append(where+': t should be in [0, period)')
+            continue
+        arg = step.get('arg')
+        fixed = None # (args, key) if the same in all cycles
+        if not (isinstance(arg, str) and ('{' in arg)):
+            try:
+                fixed = _args(step, dev, check, arg)
+            except (ValueError, TypeError) as ex:
+                errors.append(where+': bad argument: '+str(ex))
+                continue
+        cost = ntrans * float(dev.get('cmd_time', CMD_TIME[dev['kind']]))
+        steps.append((t, nstep, step, dev, method, check, cost, fixed))
+    steps.sort(key = lambda item: item[0])
+    if errors:
+        raise ValueError('recipe:\n  '+'\n  '.join(errors))
+
+    # expand the cycles (the events are in order of time, since all steps
+    # are within the period)
+    events = []
+    for cycle in range(ncycles):
+        params = {pname: values[cycle % len(values)]
+                  for pname, values in sweep.items()}
+        params['cycle'] = cycle
+        t0 = start + cycle*period
+        for t, nstep, step, dev, method, check, cost, fixed in steps:
+            if fixed is None:
+                try:
+                    fixed = _args(step, dev, check,
+                                  _substitute(step['arg'], params))
+                except (KeyError, ValueError, TypeError, IndexError) as ex:
+                    errors.append('step {0:d} (cycle {1:d}): bad argument: {2!s}'\
+                                  .format(nstep, cycle, ex))
+                    continue
+            args, key = fixed
+            events.append(Event(t0 + t, cycle, nstep, step['device'], method,
+                                args, key, cost))
+        if len(errors) > 20:
+            break # no need to repeat the same errors for all cycles
+
+    timeline = Timeline(recipe, events, ncycles, period, start, tolerance)
+    errors += timeline.check()
+    if errors:
+        raise ValueError('recipe:\n  '+'\n  '.join(errors[:20]) +
+                         ('\n  ... ({0:d} problems)'.format(len(errors))
+                          if len(errors) > 20 else ''))
+    return timeline
+
+
+
+class Timeline:
+    """The events of a compiled recipe, in order of time"""
+    def __init__(self, recipe, events, ncycles, period, start, tolerance):
+        self.recipe = recipe
+        self.name = recipe.get('name', '')
+        self.devices = recipe.get('devices', {})
+        self.events = events
+        self.ncycles = ncycles
+        self.period = period
+        self.start = start
+        self.tolerance = tolerance
+        self.busy = {} # port -> estimated time the port is busy (s)
+        self.max_delay = {} # port -> largest estimated delay of a command
+
+    def port(self, device):
+        return self.devices[device]['port']
+
+    def check(self):
+        """Conflicts and bus time budget (list of problems)"""
+        errors = []
+        ports = {name: dev['port'] for name, dev in self.devices.items()}
+        free = {} # port -> estimated time the port is free again
+        busy = {}
+        max_delay = {}
+        t = None
+        seen = {} # (device, key) -> event, for the events at time t
+        for ev in self.events:
+            if ev.t != t:
+                t = ev.t
+                seen = {}
+            other = seen.setdefault((ev.device, ev.key), ev)
+            if (other is not ev) and (other.args != ev.args):
+                errors.append('steps {0:d} and {1:d} (cycle {2:d}): '
+                              'conflicting {3:s} for {4:s}'.format(
+                                  other.step, ev.step, ev.cycle, ev.key,
+                                  ev.device))
+            port = ports[ev.device]
+            t_free = free.get(port, t)
+            if t_free > t:
+                # waits for the earlier commands on the port
+                delay = t_free - t
+                if delay > max_delay.get(port, 0.0):
+                    max_delay[port] = delay
+                if delay > self.tolerance:
+                    errors.append('step {0:d} (cycle {1:d}): delayed {2:.3f} s '
+                                  'by earlier commands on {3:s} (bus time '
+                                  'budget)'.format(ev.step, ev.cycle, delay, port))
+                free[port] = t_free + ev.cost
+            else:
+                free[port] = t + ev.cost
+            busy[port] = busy.get(port, 0.0) + ev.cost
+        self.busy = busy
+        self.max_delay = max_delay
+        return errors
+
+    def duration(self):
+        return self.start + self.ncycles*self.period
+
+    def summary(self):
+        lines = ['recipe {0!r}: {1:d} events, {2:d} cycles of {3:g} s, '
+                 'duration {4:g} s'.format(self.name, len(self.events),
+                                          self.ncycles, self.period,
+                                          self.duration())]
+        for port, busy in sorted(self.busy.items()):
+            lines.append('  {0:s}: busy {1:.1f} s ({2:.3f} %), max delay '
+                         '{3:.3f} s'.format(port, busy,
+                                            100*busy/self.duration(),
+                                            self.max_delay.get(port, 0.0)))
+        return '\n'.join(lines)
+
+
+
+class RecipeRunner:
+    """Execute a `Timeline`. `log(line)` gets the errors and the cycle
+    reports, `log_event(event, record)` (optional) every event when done."""
+    def __init__(self, timeline, log = print, log_event = None):
+        self.timeline = timeline
+        self.log = log
+        self.log_event = log_event
+        self.workers = {} # port -> DeviceWorker
+        self.devs = {} # device name -> driver object
+        self.readiness = None # devcomms.startup.Readiness of open()
+        self.dispatch = [] # per event: (worker, bound method, args)
+        self.records = [] # per event: [planned, actual, done, error]
+        self.lock = threading.Lock()
+        self.sched = None
+        self.t0 = None
+        self.cycles = {}
+        self.pending = {} # cycle -> number of events not yet done
+        self.done = threading.Event()
+
+    def open(self, timeout = None):
+        """Open all devices (in their workers, all at the same time), and
+        bind the events. IOError if a device is not ready."""
+        # one device per port, except Aladdin pumps (one bus per port)
+        startup = Startup(self.timeline.devices, self.workers)
+        try:
+            self.devs = startup.run(timeout)
+        finally:
+            self.readiness = startup.readiness
+        self.dispatch = [(self.workers[self.timeline.port(ev.device)],
+                          getattr(self.devs[ev.device], ev.method), ev.args)
+                         for ev in self.timeline.events]
+
+    def start(self, t0 = None):
+        """Start the run at `clock()` time `t0` (default: now)"""
+        self.t0 = clock() if t0 is None else t0
+        self.records = [[None, None, None, None] for ev in self.timeline.events]
+        self.cycles = {} # cycle -> indices of its events
+        for i, ev in enumerate(self.timeline.events):
+            self.cycles.setdefault(ev.cycle, []).append(i)
+        self.pending = {cycle: len(ii) for cycle, ii in self.cycles.items()}
+        self.done.clear()
+        self.sched = EventScheduler('recipe')
+        if self.timeline.events:
+            self.sched.at(self.t0 + self.timeline.events[0].t, self._event, 0)
+        else:
+            self.done.set()
+
+    def _event(self, t, t_actual, i):
+        # scheduler thread: dispatch event i, plan event i+1
+        worker, func, args = self.dispatch[i]
+        self.records[i][0:2] = [t, t_actual]
+        fut = worker.submit(func, *args)
+        fut.add_done_callback(lambda fut: self._event_done(i, fut))
+        if i+1 < len(self.dispatch):
+            self.sched.at(self.t0 + self.timeline.events[i+1].t, self._event, i+1)
+
+    def _event_done(self, i, fut):
+        # worker thread
+        rec = self.records[i]
+        rec[2] = clock()
+        rec[3] = fut.exception()
+        ev = self.timeline.events[i]
+        if rec[3] is not None:
+            self.log('ERROR: {0:s} {1:s}{2!r}: {3!r}'.format(
+                ev.device, ev.method, ev.args, rec[3]))
+        with self.lock:
+            if self.log_event is not None:
+                self.log_event(ev, rec)
+            self.pending[ev.cycle] -= 1
+            if self.pending[ev.cycle] > 0:
+                return
+            del self.pending[ev.cycle]
+            # last event of the cycle done: report
+            self.log(self.cycle_report(ev.cycle))
+            if not self.pending:
+                self.done.set()
+
+    def cycle_report(self, cycle):
+        recs = [self.records[i] for i in self.cycles[cycle]
+                if self.records[i][2] is not None]
+        return 'cycle {0:d}: {1:d} commands, lateness max {2:.3f} ms, '\
+               'done max {3:.1f} ms, errors {4:d}'.format(
+                   cycle, len(recs),
+                   1e3*max(rec[1]-rec[0] for rec in recs),
+                   1e3*max(rec[2]-rec[0] for rec in recs),
+                   sum(rec[3] is not None for rec in recs))
+
+    def wait(self, timeout = None):
+        return self.done.wait(timeout)
+
+    def stop(self):
+        if self.sched is not None:
+            self.sched.stop()
+            self.sched = None
+
+    def close(self):
+        self.stop()
+        for name, dev in self.devs.items():
+            worker = self.workers[self.timeline.port(name)]
+            worker.call(dev.close)
+        for worker in self.workers.values():
+            worker.stop()
+        self.devs = {}
+        self.workers = {}
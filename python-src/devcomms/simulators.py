@@ -0,0 +1,454 @@
+"""
+Device simulators on pseudo-terminals (Linux/POSIX only)
+
+Each simulator opens a pseudo-terminal (pty) and speaks the wire protocol of
+the real device on it. The slave side of the pty (`sim.port`, e.g.
+'/dev/pts/3') can be opened with the normal `devcomms` drivers, exactly like
+a real serial port:
+
+    from devcomms.simulators import AladdinSim
+    from devcomms.aladdin import Aladdin
+
+    with AladdinSim(latency = 0.01, jitter = 0.005) as sim:
+        ala = Aladdin(sim.port)
+        print(ala.pump_cmd('01', 'VER'))
+
+Simulated devices:
+
+    AladdinSim      Aladdin syringe pump(s): STX/ETX frames, status letters
+    FSSSim          MOLTECH-FSS flow sensor: 'M!', 'R!', '?!', 'I!'
+    FLSHSim         MOLTECH-FLSH flashbox: '!', '.', '?', 'P...d', 'N...d', 'F...d'
+    VICITTLSim      MOLTECH-VICI-TTL: 'a', 'b', '?', '!' with firmware delays
+    VICIEUHASim     VICI EUHA valve (RS232): 'VR', 'AM', 'CP', 'GOA', 'GOB'
+
+All simulators take the same options for timing and fault injection:
+
+    latency         fixed delay before each reply (s)
+    jitter          additional uniformly distributed random delay (s)
+    line_time       include transmission time of the reply (10 bits/char)
+    pace_chars      send the reply character by character at the baudrate
+                    (otherwise in one chunk, like a USB-serial adapter)
+    drop_rate       probability that a reply is not sent at all
+    corrupt_rate    probability that one byte of a reply is corrupted
+    stall_rate      probability of an extra `stall_time` delay before a reply
+    seed            random seed (reproducible faults)
+
+The statistics (`sim.stats()`) count received commands, replies, and injected
+faults.
+
+For a CI box or manual testing, simulators can be started from the command
+line. They run until Ctrl-C:
+
+    python -m devcomms.simulators aladdin fss vici_ttl --latency 0.01 --drop 0.01
+"""
+
+import os
+import sys
+import pty
+import tty
+import math
+import random
+import select
+import threading
+from time import sleep, monotonic
+
+from .virtual import PumpModel
+
+
+
+class PtySimulator:
+    """Base class: serial device simulated behind a pseudo-terminal"""
+    baudrate = 9600
+    default_latency = 0.0
+
+    def __init__(self, latency = None, jitter = 0.0,
+                 line_time = True, pace_chars = False,
+                 drop_rate = 0.0, corrupt_rate = 0.0,
+                 stall_rate = 0.0, stall_time = 1.0,
+                 seed = None):
+        self.latency = self.default_latency if latency is None else latency
+        self.jitter = jitter
+        self.line_time = line_time
+        self.pace_chars = pace_chars
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.rng = random.Random(seed)
+
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        # keep our slave fd open, so that the master side keeps working
+        # when clients close and re-open the port
+        self.port = os.ttyname(self._slave)
+
+        self.ncmd = 0
+        self.nreply = 0
+        self.ndropped = 0
+        self.ncorrupted = 0
+        self.nstalled = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self._run,
+                                       name = type(self).__name__+' '+self.port,
+                                       daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while self.running:
+            r, _, _ = select.select([self.master], [], [], 0.05)
+            if r:
+                try:
+                    data = os.read(self.master, 1024)
+                except OSError:
+                    continue
+                self.on_data(data)
+            else:
+                self.on_idle()
+
+    # to be implemented by the device simulators
+    def on_data(self, data):
+        pass
+
+    def on_idle(self):
+        pass
+
+    def read_input(self, timeout = 0.0):
+        """Read what is available from the client (waits up to `timeout`)"""
+        r, _, _ = select.select([self.master], [], [], timeout)
+        if r:
+            try:
+                return os.read(self.master, 1024)
+            except OSError:
+                pass
+        return b''
+
+    def flush_input(self):
+        """Discard everything received (like the firmware RX flushes)"""
+        while self.read_input():
+            pass
+
+    def reply(self, data, delay = 0.0):
+        """Send reply, with latency, jitter, line time and faults"""
+        rng = self.rng
+        delay += self.latency + self.jitter * rng.random()
+        if self.stall_rate and rng.random() < self.stall_rate:
+            delay += self.stall_time
+            self.nstalled += 1
+        if self.drop_rate and rng.random() < self.drop_rate:
+            self.ndropped += 1
+            sleep(delay)
+            return
+        if self.corrupt_rate and rng.random() < self.corrupt_rate\
+                and len(data) > 0:
+            data = bytearray(data)
+            i = rng.randrange(len(data))
+            data[i] = (data[i] ^ (1 << rng.randrange(8))) or 0x80
+            data = bytes(data)
+            self.ncorrupted += 1
+        chartime = 10.0 / self.baudrate
+        if self.pace_chars:
+            sleep(delay)
+            for c in data:
+                os.write(self.master, bytes([c]))
+                sleep(chartime)
+        else:
+            if self.line_time:
+                delay += chartime * len(data)
+            sleep(delay)
+            os.write(self.master, data)
+        self.nreply += 1
+
+    def stats(self):
+        return {'port': self.port,
+                'commands': self.ncmd,
+                'replies': self.nreply,
+                'dropped': self.ndropped,
+                'corrupted': self.ncorrupted,
+                'stalled': self.nstalled}
+
+
+
+class AladdinSim(PtySimulator):
+    """Aladdin syringe pump(s), networked on one port
+
+    Commands are '<address><command><argument>\\r', replies are
+    STX <address><status><data> ETX. Only pumps in `pump_ids` reply."""
+    default_latency = 0.01
+
+    def __init__(self, pump_ids = ('01', '02'), **kwargs):
+        super().__init__(**kwargs)
+        self.pumps = {pid: PumpModel() for pid in pump_ids}
+        self.rxbuf = b''
+
+    def on_data(self, data):
+        self.rxbuf += data
+        while b'\r' in self.rxbuf:
+            line, self.rxbuf = self.rxbuf.split(b'\r', 1)
+            self.ncmd += 1
+            self.handle(line.decode('ascii', errors = 'replace').strip())
+
+    def handle(self, line):
+        i = 0
+        while i < min(2, len(line)) and line[i].isdigit():
+            i += 1
+        pid = '{0:02d}'.format(int(line[:i])) if i > 0\
+            else next(iter(self.pumps))
+        pump = self.pumps.get(pid)
+        if pump is None:
+            return # no pump at this address: no reply
+        data = pump.execute(line[i:])
+        self.reply(b'\x02' + (pid + pump.status + data).encode('ascii')
+                   + b'\x03')
+
+
+
+class FSSSim(PtySimulator):
+    """MOLTECH-FSS flow sensor module (firmware v2.2)
+
+    `flow` is a function of time (in s) returning the flow rate (nl/min)."""
+    default_latency = 0.003 # I2C readout
+
+    def __init__(self, name = 'MOLTECH flow sensor 99 (simulator)',
+                 flow = None, scale_factor = 4, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.scale_factor = scale_factor
+        if flow is None:
+            flow = lambda t: 250. + 50.*math.sin(2*math.pi*t/60.)
+        self.flow = flow
+        self.t0 = monotonic()
+        self.rxbuf = b''
+        self.t_rx = None
+
+    def info(self):
+        return ('\r\n-------------------------\r\n'
+                'Scale factor: {0:d}\r\n'
+                'Units: nl/min\r\n'
+                'Units code: 2115\r\n'
+                'Firmware version: 2.2\r\n'
+                '-------------------------\r\n!').format(self.scale_factor)
+
+    def on_data(self, data):
+        self.rxbuf += data
+        self.t_rx = monotonic()
+        while b'!' in self.rxbuf:
+            cmd, self.rxbuf = self.rxbuf.split(b'!', 1)
+            self.handle(cmd)
+
+    def on_idle(self):
+        # firmware serial timeout (1000 ms): handle incomplete command
+        if self.rxbuf and (monotonic() - self.t_rx) > 1.0:
+            cmd, self.rxbuf = self.rxbuf, b''
+            self.handle(cmd)
+
+    def handle(self, cmd):
+        self.ncmd += 1
+        c = cmd[:1]
+        if c == b'M' or c == b'R':
+            raw = round(self.flow(monotonic() - self.t0) * self.scale_factor)
+            raw = max(-32768, min(32767, raw))
+            if c == b'R':
+                rep = '{0:d}!'.format(raw)
+            else:
+                rep = '{0:.2f}!'.format(raw / self.scale_factor)
+        elif c == b'I':
+            rep = self.info()
+        elif c == b'?':
+            rep = self.name + '!'
+        else:
+            rep = '?!'
+        self.reply(rep.encode('ascii'))
+        sleep(0.020) # firmware loop delay
+
+
+
+class FLSHSim(PtySimulator):
+    """MOLTECH-FLSH flashbox (firmware v1.0)"""
+    baudrate = 19200
+    FLASHING, WAITING, ERROR = 0, 1, 2
+    STATECHR = '!.E'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.state = self.FLASHING
+        self.cnt_period = 160000
+        self.cnt_on = 0
+        self.cnt_off = 16000
+        self.rxbuf = b''
+
+    def on_data(self, data):
+        self.rxbuf += data
+        while self.rxbuf:
+            c = self.rxbuf[:1]
+            if c in b'PNF':
+                # wait for complete decimal number, terminated by 'd'
+                i = 1
+                while i < len(self.rxbuf) and self.rxbuf[i:i+1].isdigit():
+                    i += 1
+                if i == len(self.rxbuf):
+                    return # incomplete
+                digits = self.rxbuf[1:i]
+                valid = self.rxbuf[i:i+1] == b'd' and 0 < len(digits) <= 10
+                self.rxbuf = self.rxbuf[i+1:]
+                self.ncmd += 1
+                value = int(digits) if valid else -1
+                if c == b'P' and value > 0:
+                    self.cnt_period = value
+                elif c == b'N' and value >= 0:
+                    self.cnt_on = value
+                elif c == b'F' and value >= 0:
+                    self.cnt_off = value
+                else:
+                    self.state = self.ERROR
+                continue
+            self.rxbuf = self.rxbuf[1:]
+            self.ncmd += 1
+            if c == b'!':
+                self.state = self.FLASHING
+            elif c == b'.':
+                self.state = self.WAITING
+            elif c == b'?':
+                self.reply(self.STATECHR[self.state].encode('ascii'))
+            else:
+                self.state = self.ERROR
+
+
+
+class VICITTLSim(PtySimulator):
+    """MOLTECH-VICI-TTL control box (firmware v260213a)
+
+    Single-character commands. As in the firmware, only the first character
+    received is executed; everything that arrives while the firmware is busy
+    (valve pulse, valve delay, loop delay) is discarded."""
+    PULSEDLY = 0.100
+    VALVEDLY = 0.300
+    LOOPDLY = 0.100
+    HELLO = b'Hello, this is MOLTECH-VICI-TTL control v260213a!'
+
+    def __init__(self, position = 'B', **kwargs):
+        super().__init__(**kwargs)
+        self.position = position
+
+    def on_data(self, data):
+        c = data[:1]
+        self.ncmd += 1
+        if c == b'a' or c == b'b':
+            self.position = 'A' if c == b'a' else 'B'
+            self.reply(self.position.encode('ascii'),
+                       delay = self.PULSEDLY + self.VALVEDLY)
+        elif c == b'?':
+            self.reply(self.position.encode('ascii'))
+        elif c == b'!':
+            self.reply(self.HELLO)
+        sleep(self.LOOPDLY)
+        self.flush_input()
+
+
+
+class VICIEUHASim(PtySimulator):
+    """VICI EUHA valve actuator (RS232), two-position mode
+
+    Commands are terminated by CR (LF is ignored), replies by CR."""
+    default_latency = 0.005
+    MOVETIME = 0.15
+
+    def __init__(self, position = 'B', **kwargs):
+        super().__init__(**kwargs)
+        self.position = position
+        self.rxbuf = b''
+
+    def on_data(self, data):
+        self.rxbuf += data.replace(b'\n', b'')
+        while b'\r' in self.rxbuf:
+            line, self.rxbuf = self.rxbuf.split(b'\r', 1)
+            self.ncmd += 1
+            self.handle(line.decode('ascii', errors = 'replace').strip())
+
+    def handle(self, cmd):
+        if cmd == 'VR':
+            self.reply(b'MUA_MAIN_ST_2.45\r')
+        elif cmd in ['VR1', 'VR2']:
+            self.reply(b'UA_SIM_1.0\r')
+        elif cmd == 'AM':
+            self.reply(b'AM1\r')
+        elif cmd == 'CP':
+            self.reply(b'CP' + self.position.encode('ascii') + b'\r')
+        elif cmd in ['GOA', 'GOB']:
+            sleep(self.MOVETIME) # valve busy, no reply
+            self.position = cmd[-1]
+        elif cmd == '/?':
+            self.reply(b'AM CP GO VR\r')
+
+
+
+SIMULATORS = {'aladdin': AladdinSim,
+              'fss': FSSSim,
+              'flsh': FLSHSim,
+              'vici_ttl': VICITTLSim,
+              'vici_euha': VICIEUHASim}
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description = 'Run devcomms device simulators on pseudo-terminals')
+    parser.add_argument('devices', nargs = '+', choices = list(SIMULATORS))
+    parser.add_argument('--latency', type = float, default = None)
+    parser.add_argument('--jitter', type = float, default = 0.0)
+    parser.add_argument('--drop', type = float, default = 0.0)
+    parser.add_argument('--corrupt', type = float, default = 0.0)
+    parser.add_argument('--stall', type = float, default = 0.0)
+    parser.add_argument('--stall-time', type = float, default = 1.0)
+    parser.add_argument('--pace-chars', action = 'store_true')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--link', default = None,
+                        help = 'directory for symlinks <device>N -> pty')
+    args = parser.parse_args()
+
+    sims = []
+    for i, dev in enumerate(args.devices):
+        sim = SIMULATORS[dev](latency = args.latency, jitter = args.jitter,
+                              drop_rate = args.drop,
+                              corrupt_rate = args.corrupt,
+                              stall_rate = args.stall,
+                              stall_time = args.stall_time,
+                              pace_chars = args.pace_chars,
+                              seed = args.seed).start()
+        sims.append(sim)
+        print(dev, sim.port)
+        if args.link is not None:
+            link = os.path.join(args.link, dev + str(i))
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(sim.port, link)
+            print('    ', link)
+    sys.stdout.flush()
+    try:
+        while True:
+            sleep(10.)
+    except KeyboardInterrupt:
+        pass
+    for sim in sims:
+        print(sim.stats())
+        sim.stop()
@@ -0,0 +1,303 @@
+"""
+Concurrent opening of the devices of a rig, with a readiness timeline
+
+Opening a device is mostly waiting: MOLTECH_FLSH and VICI_TTL wait 2 s for
+their controller to start after the port is opened, MOLTECH_FSS makes three
+round trips, VICI_EUHA checks its configuration. Opened one after the other,
+a rig takes the sum of these times to start. `Startup` opens all devices at
+the same time, one `DeviceWorker` per serial port, and checks that each one
+answers (handshake), so that the rig is ready when its slowest device is:
+
+    devices = {'pump':  {'kind': 'aladdin', 'port': 'COM4', 'id': '01'},
+               'valve': {'kind': 'vici_ttl', 'port': 'COM5'},
+               'flash': {'kind': 'flsh', 'port': 'COM6'},
+               'flow':  {'kind': 'fss', 'port': 'COM7'}}
+    startup = Startup(devices)
+    devs = startup.run(timeout = 10.) # {name: device}
+    print(startup.readiness.report())
+    ...
+    startup.close() # close the devices, stop the workers
+
+The devices are described as in recipes (devcomms.recipe). Devices on the
+same port (Aladdin pumps on one bus) are opened one after the other by the
+worker of that port, in order. Each device belongs to the worker of its
+port (`startup.workers`): further commands go through it, as in
+`RecipeRunner`, which opens the devices of a recipe with a `Startup`.
+
+`run()` waits for all devices. If one fails, or is not ready within
+`timeout` seconds, the devices that were opened are closed, and an IOError
+lists the failures (the readiness timeline has all devices). Handshake per
+kind, after opening:
+
+    aladdin     'VER' to the pump
+    vici_ttl,
+    vici_euha   position query
+    flsh        status query
+    fss         sensor name (received while opening)
+
+`Readiness` records per device, in `clock()` time, when opening started
+(after the devices before it on the same port), when the port was open, and
+when the device answered (or the error). `report()` shows the timeline, with
+the time it would have taken one device after the other:
+
+    device  kind      port    start   open  ready (s)
+    valve   vici_ttl  COM5    0.000  2.004  2.012  |#######################|
+    pump    aladdin   COM4    0.000  0.012  0.051  |#                      |
+    flow    fss       COM7    0.000  0.338  0.338  |####                   |
+    ready in 2.012 s (2.401 s one after the other)
+
+    python -m devcomms.startup recipe.json      (devices of a recipe)
+"""
+
+from concurrent.futures import TimeoutError
+
+from .timing import clock
+from .worker import DeviceWorker
+
+
+BAR_WIDTH = 40 # characters, for the slowest device
+
+
+
+def open_device(dev):
+    """Driver object for the device description `dev` (kind, port)"""
+    kind = dev['kind']
+    if kind == 'aladdin':
+        from .aladdin_bus import AladdinBus
+        return AladdinBus.attach(dev['port'])
+    elif kind == 'vici_ttl':
+        from .vici_ttl import VICI_TTL
+        return VICI_TTL(dev['port'])
+    elif kind == 'vici_euha':
+        from .vici_euha import VICI_EUHA
+        return VICI_EUHA(dev['port'])
+    elif kind == 'flsh':
+        from .moltech_flsh import MOLTECH_FLSH
+        return MOLTECH_FLSH(dev['port'])
+    elif kind == 'fss':
+        from .moltech_fss import MOLTECH_FSS
+        return MOLTECH_FSS(dev['port'])
+    raise ValueError('unknown device kind: '+str(kind))
+
+
+def handshake(dev, device):
+    """Check that the opened `device` answers (raises IOError if not)"""
+    kind = dev['kind']
+    if kind == 'aladdin':
+        status, reply = device.pump_cmd(dev.get('id', '00'), 'VER')
+        ok = reply is not None
+    elif kind in ['vici_ttl', 'vici_euha']:
+        ok = device.get_pos() is not None
+    elif kind == 'flsh':
+        ok = device.status_OK()
+    elif kind == 'fss':
+        ok = device.name is not None
+    else:
+        ok = True
+    if not ok:
+        raise IOError('{0:s} on {1:s}: no valid reply'.format(kind,
+                                                              dev['port']))
+
+
+
+class Readiness:
+    """Readiness timeline of a set of devices (`clock()` times)"""
+    def __init__(self, t0 = None):
+        self.t0 = clock() if t0 is None else t0
+        # name -> [kind, port, t_start, t_open, t_ready, error]; each entry
+        # is updated by one thread at a time (the worker of its port)
+        self.entries = {}
+
+    def add(self, name, kind, port):
+        self.entries[name] = [kind, port, None, None, None, None]
+
+    def start(self, name):
+        self.entries[name][2] = clock()
+
+    def opened(self, name):
+        self.entries[name][3] = clock()
+
+    def ready(self, name):
+        self.entries[name][4] = clock()
+
+    def failed(self, name, error):
+        self.entries[name][5] = error
+
+    def pending(self):
+        """Names of the devices neither ready nor failed"""
+        return [name for name, e in self.entries.items()
+                if (e[4] is None) and (e[5] is None)]
+
+    def failures(self):
+        return {name: e[5] for name, e in self.entries.items()
+                if e[5] is not None}
+
+    def ready_time(self):
+        """Time from t0 until the last device was ready (s), or None"""
+        t = [e[4] for e in self.entries.values()]
+        if (not t) or (None in t):
+            return None
+        return max(t) - self.t0
+
+    def serial_time(self):
+        """Sum of the opening times of the ready devices (s): the time
+        they would have taken one after the other"""
+        return sum(e[4] - e[2] for e in self.entries.values()
+                   if e[4] is not None)
+
+    def as_dict(self):
+        def rel(t):
+            return None if t is None else t - self.t0
+        return {name: {'kind': kind, 'port': port, 'start_s': rel(t_start),
+                       'open_s': rel(t_open), 'ready_s': rel(t_ready),
+                       'error': None if error is None else repr(error)}
+                for name, (kind, port, t_start, t_open, t_ready, error)
+                in self.entries.items()}
+
+    def report(self):
+        tmax = max([e[4] - self.t0 for e in self.entries.values()
+                    if e[4] is not None] + [1e-3])
+        def col(t):
+            return int(round(BAR_WIDTH * (t - self.t0) / tmax))
+        def sec(t):
+            return '   -  ' if t is None else '{0:6.3f}'.format(t - self.t0)
+        wname = max([len(name) for name in self.entries] + [6])
+        wport = max([len(e[1]) for e in self.entries.values()] + [4])
+        lines = ['{0:{w}s}  {1:9s} {2:{wp}s}  start   open  ready (s)'.format(
+            'device', 'kind', 'port', w = wname, wp = wport)]
+        for name, (kind, port, t_start, t_open, t_ready, error)\
+                in sorted(self.entries.items(), key = lambda item:
+                          (item[1][4] is None, item[1][4] or 0.)):
+            line = '{0:{w}s}  {1:9s} {2:{wp}s} {3:s} {4:s} '.format(
+                name, kind, port, sec(t_start), sec(t_open),
+                w = wname, wp = wport)
+            if error is not None:
+                line += ' FAILED: '+repr(error)
+            elif t_ready is None:
+                line += ' not ready'
+            else:
+                a, b = col(t_start), max(col(t_ready), col(t_start) + 1)
+                line += sec(t_ready) + '  |' + ' '*a + '#'*(b - a)\
+                        + ' '*(BAR_WIDTH - b) + '|'
+            lines.append(line)
+        t_ready = self.ready_time()
+        if t_ready is None:
+            lines.append('not ready: '+', '.join(sorted(
+                set(self.pending()) | set(self.failures()))))
+        else:
+            lines.append('ready in {0:.3f} s ({1:.3f} s one after the '
+                         'other)'.format(t_ready, self.serial_time()))
+        return '\n'.join(lines)
+
+
+
+class Startup:
+    """Open and check the devices `devices` ({name: description}) all at
+    the same time, one DeviceWorker per port (`workers`: existing workers
+    to use, port -> DeviceWorker, completed with new ones)"""
+    def __init__(self, devices, workers = None):
+        self.devices = devices
+        self.workers = {} if workers is None else workers
+        self.devs = {} # name -> driver object, when ready
+        self.readiness = None
+
+    def _open(self, name, dev):
+        # executed by the worker of the port; the device, or None (error
+        # in the readiness timeline)
+        self.readiness.start(name)
+        try:
+            device = open_device(dev)
+            self.readiness.opened(name)
+            try:
+                handshake(dev, device)
+            except Exception:
+                device.close()
+                raise
+        except Exception as ex:
+            self.readiness.failed(name, ex)
+            return None
+        self.readiness.ready(name)
+        return device
+
+    def run(self, timeout = None):
+        """Open all devices, wait until they are ready. Returns the devices
+        ({name: driver object}); IOError if one of them failed."""
+        self.readiness = Readiness()
+        futures = {}
+        for name, dev in self.devices.items():
+            worker = self.workers.get(dev['port'])
+            if worker is None:
+                worker = DeviceWorker(dev['port'])
+                self.workers[dev['port']] = worker
+            self.readiness.add(name, dev['kind'], dev['port'])
+            futures[name] = worker.submit(self._open, name, dev)
+        deadline = None if timeout is None else self.readiness.t0 + timeout
+        late = []
+        for name, fut in futures.items():
+            try:
+                device = fut.result(None if deadline is None
+                                    else max(0., deadline - clock()))
+            except TimeoutError:
+                late.append(name)
+                continue
+            if device is not None:
+                self.devs[name] = device
+        errors = ['{0:s} ({1!r})'.format(name, ex)
+                  for name, ex in self.readiness.failures().items()]
+        errors += ['{0:s} (not ready after {1:g} s)'.format(name, timeout)
+                   for name in late]
+        if errors:
+            for name in late:
+                # close it when (if) it opens after all
+                futures[name].add_done_callback(_close_result)
+            self.close_devices()
+            raise IOError('devices not ready: '+', '.join(errors))
+        return dict(self.devs)
+
+    def close_devices(self):
+        for name, device in self.devs.items():
+            worker = self.workers[self.devices[name]['port']]
+            try:
+                worker.call(device.close)
+            except Exception as ex:
+                print('{0:s}: {1!r} when closing'.format(name, ex))
+        self.devs = {}
+
+    def close(self):
+        """Close the devices and stop the workers"""
+        self.close_devices()
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers = {}
+
+
+def _close_result(fut):
+    if (not fut.cancelled()) and (fut.result() is not None):
+        fut.result().close()
+
+
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(
+        description = 'Open the devices of a recipe (all at the same time) '
+                      'and show their readiness timeline')
+    parser.add_argument('recipe', help = 'recipe file (.json), or a file '
+                                         'with only "devices"')
+    parser.add_argument('--timeout', type = float, default = 10.)
+    args = parser.parse_args()
+
+    with open(args.recipe, encoding = 'utf-8') as f:
+        devices = json.load(f)['devices']
+    startup = Startup(devices)
+    try:
+        startup.run(args.timeout)
+        ok = True
+    except IOError as ex:
+        print(ex)
+        ok = False
+    print(startup.readiness.report())
+    startup.close()
+    sys.exit(0 if ok else 1)
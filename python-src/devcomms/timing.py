@@ -0,0 +1,306 @@
+"""
+Transaction timestamps and latency statistics for the devcomms drivers
+
+All drivers timestamp their transactions with `time.perf_counter_ns()`:
+`t_send_ns` just before the command is written, `t_recv_ns` just after the
+reply has been received (attributes of the driver object, for the last
+transaction). perf_counter is monotonic and has (sub-)microsecond resolution,
+but has an arbitrary origin. `ANCHOR` ties it to wall clock time: both clocks
+are read once, at import, and `wall_time_ns()` converts a perf_counter_ns
+value to wall clock time (seconds since the epoch). Later changes of the
+system clock (NTP, daylight saving) do not affect the timestamps of a
+session.
+
+Programs that schedule events should use `clock()` (perf_counter, in
+seconds) rather than `time.time()`, `sleep()` rather than `time.sleep()`,
+and `wall_time()` for display and logging. `clock()` and `sleep()` use the
+time source set with `set_clock()`: real time by default, or the simulated
+time of a `devcomms.virtual.VirtualClock`, so that a program can be run
+faster than real time (against device models).
+
+Each driver also keeps running latency statistics (`LatencyStats`, in its
+`latency` attribute), per command:
+
+    ala = Aladdin('COM4')
+    ...
+    print(ala.latency.report())
+    print(devcomms.timing.report()) # all devices
+
+`DeadlineSampler` runs a sampling loop on absolute deadlines (no drift).
+`EventScheduler` executes events at planned `clock()` times, in a thread.
+"""
+
+import heapq
+import threading
+import weakref
+from collections import deque
+import time
+from time import perf_counter, perf_counter_ns, time_ns
+
+
+# (perf_counter_ns, time_ns), read at the same moment, once per session
+ANCHOR = (perf_counter_ns(), time_ns())
+
+# time source of clock() and sleep(), see set_clock()
+_now = perf_counter
+_sleep = time.sleep
+
+
+def clock():
+    """Monotonic high-resolution clock (s) for scheduling (perf_counter)"""
+    return _now()
+
+
+def sleep(dt):
+    """Sleep `dt` seconds (of the time source of `clock()`)"""
+    _sleep(dt)
+
+
+def set_clock(source = None):
+    """Use the time of `source` (with `now()` and `sleep(dt)` methods, e.g.
+    a `devcomms.virtual.VirtualClock`) for `clock()` and `sleep()`.
+    `set_clock()` returns to real time."""
+    global _now, _sleep
+    if source is None:
+        _now, _sleep = perf_counter, time.sleep
+    else:
+        _now, _sleep = source.now, source.sleep
+
+
+def wall_time_ns(t_ns):
+    """Wall clock time (s since epoch) of perf_counter_ns value `t_ns`"""
+    return (ANCHOR[1] + (t_ns - ANCHOR[0])) * 1e-9
+
+
+def wall_time(t):
+    """Wall clock time (s since epoch) of `clock()` value `t`"""
+    return (ANCHOR[1] - ANCHOR[0]) * 1e-9 + t
+
+
+def command_key(cmd):
+    """Command name for the statistics: '01RAT1.5UM' -> 'RAT', 'M!' -> 'M'
+
+    Leading digits (pump address) are skipped, then the letters are taken,
+    or else the first character."""
+    if isinstance(cmd, bytes):
+        cmd = cmd.decode('ascii', 'replace')
+    cmd = cmd.lstrip('0123456789 ')
+    n = 0
+    while n < len(cmd) and cmd[n].isalpha():
+        n += 1
+    return cmd[:n] if n > 0 else cmd[:1]
+
+
+
+_all_stats = weakref.WeakSet()
+
+
+class LatencyStats:
+    """Running statistics of the transaction latencies of one device
+
+    Counts and minimum/maximum are over the whole session, median and p99
+    over the last `window` transactions of each command."""
+    def __init__(self, device, window = 1000):
+        self.device = device
+        self.window = window
+        self.lock = threading.Lock()
+        self.cmds = {} # command key -> [n, min_ns, max_ns, deque of latencies]
+        _all_stats.add(self)
+
+    def record(self, cmd, t_send_ns, t_recv_ns):
+        key = command_key(cmd)
+        dt = t_recv_ns - t_send_ns
+        with self.lock:
+            entry = self.cmds.get(key)
+            if entry is None:
+                entry = [0, dt, dt, deque(maxlen = self.window)]
+                self.cmds[key] = entry
+            entry[0] += 1
+            entry[1] = min(entry[1], dt)
+            entry[2] = max(entry[2], dt)
+            entry[3].append(dt)
+
+    def summary(self):
+        """{command: {'n', 'min_ms', 'median_ms', 'p99_ms', 'max_ms'}}"""
+        with self.lock:
+            items = [(key, entry[0], entry[1], entry[2], sorted(entry[3]))
+                     for key, entry in self.cmds.items()]
+        rep = {}
+        for key, n, dtmin, dtmax, dts in items:
+            m = len(dts)
+            median = dts[m//2] if m % 2 else (dts[m//2-1] + dts[m//2]) / 2
+            rep[key] = {'n': n,
+                        'min_ms': dtmin * 1e-6,
+                        'median_ms': median * 1e-6,
+                        'p99_ms': dts[min(m-1, int(0.99*m))] * 1e-6,
+                        'max_ms': dtmax * 1e-6}
+        return rep
+
+    def report(self):
+        lines = [self.device]
+        for key, s in sorted(self.summary().items()):
+            lines.append('    {0:6s} n={1:<7d} min {2:8.2f}  median {3:8.2f}'
+                         '  p99 {4:8.2f}  max {5:8.2f} ms'\
+                         .format(key, s['n'], s['min_ms'], s['median_ms'],
+                                 s['p99_ms'], s['max_ms']))
+        return '\n'.join(lines)
+
+
+
+def all_stats():
+    """LatencyStats of all devices (of this process)"""
+    return sorted(_all_stats, key = lambda s: s.device)
+
+
+def report():
+    """Latency report of all devices that had transactions (string)"""
+    return '\n'.join(s.report() for s in all_stats() if s.cmds)
+
+
+
+class DeadlineSampler:
+    """Sampling slots on a uniform grid of absolute deadlines
+
+        for k, t_slot, jitter in DeadlineSampler(1.0, nslots = 100):
+            ... take sample k ...
+
+    Slot k starts at t0 + k*period (`clock()` time). The loop sleeps until
+    the start of each slot, so that the time taken by the sampling itself
+    does not accumulate (no drift). `jitter` is the lateness (s) of the
+    actual start of the slot. When a slot can not be started before the
+    next one is due, it is not executed but yielded immediately with
+    `jitter = None` (missed slot), so that the caller can flag it.
+
+    The last `spin` seconds before a deadline are busy-waited, since
+    `sleep()` may wake up late by a few ms on some systems."""
+    def __init__(self, period, nslots = None, t0 = None, spin = 0.001,
+                 window = 1000):
+        self.period = period
+        self.nslots = nslots
+        self.t0 = clock() if t0 is None else t0
+        self.spin = spin
+        self.nslot = 0 # slots executed
+        self.nmissed = 0 # slots missed
+        self.jitter_max = 0.0
+        self.jitter_sum = 0.0
+        self.jitters = deque(maxlen = window)
+
+    def wait_until(self, t):
+        dt = t - clock() - self.spin
+        if dt > 0:
+            sleep(dt)
+        while clock() < t:
+            pass
+
+    def __iter__(self):
+        k = 0
+        while (self.nslots is None) or (k < self.nslots):
+            t_slot = self.t0 + k*self.period
+            if clock() >= t_slot + self.period:
+                # too late: skip slot, do not shift the grid
+                self.nmissed += 1
+                yield k, t_slot, None
+            else:
+                self.wait_until(t_slot)
+                jitter = clock() - t_slot
+                self.nslot += 1
+                self.jitter_max = max(self.jitter_max, jitter)
+                self.jitter_sum += jitter
+                self.jitters.append(jitter)
+                yield k, t_slot, jitter
+            k += 1
+
+    def stats(self):
+        """Scheduling report (dict); p99 over the last `window` slots"""
+        js = sorted(self.jitters)
+        m = len(js)
+        return {'slots': self.nslot,
+                'missed': self.nmissed,
+                'jitter_mean_ms': 1e3 * self.jitter_sum / max(1, self.nslot),
+                'jitter_p99_ms': 1e3 * js[min(m-1, int(0.99*m))] if m else 0.0,
+                'jitter_max_ms': 1e3 * self.jitter_max}
+
+
+
+class EventScheduler:
+    """Thread executing functions at planned `clock()` times
+
+        sched = EventScheduler('program')
+        sched.at(t, func, arg1, ...) # calls func(t, t_actual, arg1, ...)
+        ...
+        sched.cancel() # forget all planned events
+        sched.stop()
+
+    The functions are executed in the scheduler thread, one at a time, in
+    order of planned time. They should be short (e.g. queue commands to a
+    DeviceWorker, see devcomms.worker) and may plan further events; to
+    avoid drift, plan relative to the planned time `t`, not to `t_actual`.
+    The thread sleeps until `spin` seconds before an event, and busy-waits
+    the rest (as DeadlineSampler)."""
+    def __init__(self, name, spin = 0.002):
+        self.name = name
+        self.spin = spin
+        self.events = [] # heap of (t, seq, func, args)
+        self.seq = 0
+        self.generation = 0 # incremented by cancel()
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target = self._run,
+                                       name = 'EventScheduler '+name,
+                                       daemon = True)
+        self.thread.start()
+
+    def at(self, t, func, *args):
+        """Execute `func(t, t_actual, *args)` at `clock()` time `t`"""
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.events, (t, self.seq, func, args))
+            self.cond.notify()
+
+    def cancel(self):
+        """Forget all planned events (an event being executed completes)"""
+        with self.cond:
+            self.events = []
+            self.generation += 1
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return len(self.events)
+
+    def stop(self, timeout = None):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+    def _next(self):
+        # wait for the next event, until `spin` before its time
+        with self.cond:
+            while True:
+                if self.stopping:
+                    return None
+                if self.events:
+                    dt = self.events[0][0] - clock() - self.spin
+                    if dt <= 0:
+                        return heapq.heappop(self.events), self.generation
+                    self.cond.wait(dt)
+                else:
+                    self.cond.wait()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            (t, _, func, args), generation = item
+            while clock() < t:
+                pass
+            t_actual = clock()
+            with self.cond:
+                if (generation != self.generation) or self.stopping:
+                    continue # cancelled in the meantime
+            try:
+                func(t, t_actual, *args)
+            except Exception as ex:
+                print('{0:s} scheduler: {1!r} in {2!r}'.format(self.name, ex, func))
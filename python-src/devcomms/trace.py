@@ -0,0 +1,282 @@
+"""
+Binary trace of all serial traffic of the devcomms drivers
+
+Opt-in, for post-mortem analysis of long runs. When enabled, every `write`
+and `read` on the serial ports of the drivers is recorded as a fixed-size
+binary record in a memory-mapped ring file (the oldest records are
+overwritten when the file is full). Recording costs a few microseconds per
+call; nothing is recorded (and nothing costs anything) when not enabled.
+
+Enable before opening the devices:
+
+    from devcomms import trace
+    trace.enable('../local/trace.bin')
+
+or set the environment variable DEVCOMMS_TRACE to the trace file name
+('{pid}' in the name is replaced by the process ID). Decode, filter and
+analyze the trace with
+
+    python -m devcomms.trace trace.bin                  all records
+    python -m devcomms.trace trace.bin --device COM4 --since 3600 --until 3660
+    python -m devcomms.trace trace.bin --grep GLITCH --tail 50
+    python -m devcomms.trace trace.bin --latency        latency per command
+
+File layout: a 4096-byte header (magic, record size, capacity, number of
+records written, time anchor (perf_counter_ns, time_ns), device names as
+JSON), followed by `capacity` records of 64 bytes:
+
+    int64 t_ns (perf_counter_ns), uint32 seq, uint16 device, uint8 flags
+    (bit 0: read, bit 1: continuation), uint8 n, 48 bytes of data
+
+Data longer than 48 bytes is split over several records.
+"""
+
+import os
+import mmap
+import json
+import struct
+import threading
+from time import perf_counter_ns
+
+from .timing import ANCHOR, command_key
+
+
+MAGIC = b'DCTRACE1'
+HEADER_SIZE = 4096
+HEADER = struct.Struct('<8sIIQqq')
+RECORD = struct.Struct('<qIHBB48s')
+DATA_SIZE = 48
+FLAG_READ = 1
+FLAG_CONT = 2
+
+_tracer = None
+
+
+
+class Tracer:
+    def __init__(self, path, capacity = 1000000):
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.devices = []
+        size = HEADER_SIZE + capacity * RECORD.size
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        self.f = open(path, 'r+b')
+        self.mm = mmap.mmap(self.f.fileno(), size)
+        self.count = 0
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, RECORD.size, self.capacity,
+                         self.count, ANCHOR[0], ANCHOR[1])
+        names = json.dumps(self.devices).encode('utf-8')
+        assert HEADER.size + 4 + len(names) <= HEADER_SIZE, 'too many devices'
+        struct.pack_into('<I', self.mm, HEADER.size, len(names))
+        self.mm[HEADER.size+4:HEADER.size+4+len(names)] = names
+
+    def register(self, name):
+        with self.lock:
+            self.devices.append(name)
+            self._write_header()
+            return len(self.devices) - 1
+
+    def record(self, dev, flags, t_ns, data):
+        with self.lock:
+            for i in range(0, max(len(data), 1), DATA_SIZE):
+                chunk = data[i:i+DATA_SIZE]
+                offset = HEADER_SIZE + (self.count % self.capacity) * RECORD.size
+                RECORD.pack_into(self.mm, offset, t_ns, self.count & 0xffffffff,
+                                 dev, flags | (FLAG_CONT if i else 0),
+                                 len(chunk), chunk)
+                self.count += 1
+            # number of records written, for the reader
+            struct.pack_into('<Q', self.mm, 16, self.count)
+
+    def close(self):
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.f.close()
+
+
+
+def enable(path, capacity = 1000000):
+    """Start tracing to `path` (devices opened from now on)"""
+    global _tracer
+    path = path.replace('{pid}', str(os.getpid()))
+    _tracer = Tracer(path, capacity)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def attach(ser, name):
+    """Record the reads and writes of serial port object `ser`, if enabled
+
+    The `read` and `write` methods of the object itself are replaced, so
+    that the higher-level methods (read_until, ...) are traced as well."""
+    if _tracer is None:
+        return
+    tracer = _tracer
+    dev = tracer.register(name)
+    raw_read = ser.read
+    raw_write = ser.write
+
+    def read(size = 1):
+        data = raw_read(size)
+        if data:
+            tracer.record(dev, FLAG_READ, perf_counter_ns(), bytes(data))
+        return data
+
+    def write(data):
+        tracer.record(dev, 0, perf_counter_ns(), bytes(data))
+        return raw_write(data)
+
+    ser.read = read
+    ser.write = write
+
+
+if os.environ.get('DEVCOMMS_TRACE') and (__name__ != '__main__'):
+    enable(os.environ['DEVCOMMS_TRACE'])
+
+
+
+####
+# Reading and analysis
+
+def load(path):
+    """Read a trace file: (devices, anchor, records oldest first)
+
+    Each record is (t_ns, device number, is_read, data); continuation
+    records are merged."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        magic, recsize, capacity, count, anchor_perf, anchor_wall = \
+            HEADER.unpack_from(header, 0)
+        assert magic == MAGIC, 'not a devcomms trace file'
+        assert recsize == RECORD.size, 'unsupported record size'
+        nnames, = struct.unpack_from('<I', header, HEADER.size)
+        devices = json.loads(header[HEADER.size+4:HEADER.size+4+nnames])
+        body = f.read(capacity * RECORD.size)
+    n = min(count, capacity)
+    records = []
+    for i in range(count - n, count):
+        offset = (i % capacity) * RECORD.size
+        t_ns, seq, dev, flags, nb, data = RECORD.unpack_from(body, offset)
+        data = data[:nb]
+        if (flags & FLAG_CONT) and records and (records[-1][1] == dev):
+            records[-1][3] += data
+        elif not (flags & FLAG_CONT):
+            records.append([t_ns, dev, bool(flags & FLAG_READ), data])
+    return devices, (anchor_perf, anchor_wall), records
+
+
+def transactions(records):
+    """Group records into (device, t_send_ns, t_reply_ns, sent, reply)
+
+    A transaction is a write, and the reads that follow it (until the next
+    write to the same device); t_reply_ns is the time of the last read
+    (None if no reply)."""
+    current = {}
+    result = []
+    for t_ns, dev, is_read, data in records:
+        if not is_read:
+            if dev in current:
+                result.append((dev,) + tuple(current[dev]))
+            current[dev] = [t_ns, None, data, b'']
+        elif dev in current:
+            current[dev][1] = t_ns
+            current[dev][3] += data
+    for dev, tr in current.items():
+        result.append((dev,) + tuple(tr))
+    result.sort(key = lambda tr: tr[1])
+    return result
+
+
+def latency_report(devices, records):
+    import numpy as np
+    lat = {}
+    for dev, t_send, t_reply, sent, reply in transactions(records):
+        if t_reply is None:
+            continue
+        key = (devices[dev], command_key(sent))
+        lat.setdefault(key, []).append((t_reply - t_send) * 1e-6)
+    lines = []
+    for (devname, cmd), dts in sorted(lat.items()):
+        dts = np.array(dts)
+        lines.append('{0:30s} {1:6s} n={2:<7d} min {3:8.2f}  median {4:8.2f}'
+                     '  p99 {5:8.2f}  max {6:8.2f} ms'\
+                     .format(devname, cmd, len(dts), dts.min(),
+                             np.median(dts), np.percentile(dts, 99),
+                             dts.max()))
+    return '\n'.join(lines)
+
+
+def merge_reads(records):
+    """Merge consecutive reads of the same device (e.g. byte-by-byte reads
+    of read_until) into one record, with the time of the first read"""
+    merged = []
+    for rec in records:
+        if rec[2] and merged and merged[-1][2] and (merged[-1][1] == rec[1]):
+            merged[-1] = merged[-1][:3] + [merged[-1][3] + rec[3]]
+        else:
+            merged.append(list(rec))
+    return merged
+
+
+def main(argv = None):
+    import argparse
+    from datetime import datetime
+    parser = argparse.ArgumentParser(prog = 'python -m devcomms.trace',
+                                     description = 'Decode a devcomms trace')
+    parser.add_argument('file')
+    parser.add_argument('--device', help = 'only devices whose name contains this')
+    parser.add_argument('--since', type = float,
+                        help = 'start time (s from start of the trace)')
+    parser.add_argument('--until', type = float,
+                        help = 'end time (s from start of the trace)')
+    parser.add_argument('--grep', help = 'only records containing this text')
+    parser.add_argument('--tail', type = int, help = 'only the last N records')
+    parser.add_argument('--latency', action = 'store_true',
+                        help = 'latency statistics per device and command')
+    parser.add_argument('--raw', action = 'store_true',
+                        help = 'one line per read call (no merging of reads)')
+    args = parser.parse_args(argv)
+
+    devices, (anchor_perf, anchor_wall), records = load(args.file)
+    if not records:
+        print('empty trace')
+        return
+    t0 = records[0][0]
+    if args.device is not None:
+        records = [r for r in records if args.device in devices[r[1]]]
+    if args.since is not None:
+        records = [r for r in records if (r[0]-t0)*1e-9 >= args.since]
+    if args.until is not None:
+        records = [r for r in records if (r[0]-t0)*1e-9 <= args.until]
+    if args.latency:
+        print(latency_report(devices, records))
+        return
+    if not args.raw:
+        records = merge_reads(records)
+    if args.grep is not None:
+        pattern = args.grep.encode('latin-1')
+        records = [r for r in records if pattern in r[3]]
+    if args.tail is not None:
+        records = records[-args.tail:]
+    for t_ns, dev, is_read, data in records:
+        wall = datetime.fromtimestamp((anchor_wall + t_ns - anchor_perf)*1e-9)
+        print('{0:s} {1:12.6f} {2:24s} {3:s} {4!r}'\
+              .format(wall.isoformat(timespec = 'microseconds'),
+                      (t_ns-t0)*1e-9, devices[dev],
+                      '<' if is_read else '>', data))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,18 @@ This  is the VICI EUHA control module, easy to import and use, much like `aladdi
 
 A child class 'Newserial' is created from 'Serial' (pyserial) to facilitate communications with the VICI EUHA interface, in particular handling ASCII conversion and CRLF handling.
 
+By default (`fast=True`), replies are read with `Newserial.readreply`, which returns as soon as the CR/LF-terminated reply is complete (deadline: serial timeout), instead of with the fixed pauses of `ultrawrite`/`ultraread`. Commands without reply (GOA, GOB) are followed by a PAUSE for the valve to move; in fast mode, `set_pos` then polls the position (CP) until the valve reports the new one (deadline: MOVE_TIMEOUT), so that the next command is not sent while the valve is still busy, and its reply is not mixed up with a late one.
+
 """
-from time import sleep
+import asyncio
+from time import sleep, monotonic, perf_counter_ns
 import serial
 from serial import Serial
 
+from .aioserial import AsyncSerial
+from .timing import LatencyStats
+from . import trace
+
 
 
 class Newserial(Serial):
@@ -18,6 +25,7 @@ class Newserial(Serial):
         super().__init__(*args, **kwargs)
         self.PAUSE = 0.1  # should this be fine-tuned? 0.05 too short for valve change, 0.1 seems OK
         self.LPAUSE = 0.5
+        self.MOVE_TIMEOUT = 2.0 # fast mode: deadline for the position check after a move
         
     def ultraflush(self):
         # RESET and check if things are quiet
@@ -42,18 +50,43 @@ class Newserial(Serial):
             sleep(self.PAUSE) # give it some time to cough up the full reply
         return rcd.decode('ascii')
 
+    def readreply(self):
+        """Read a reply terminated by CR and/or LF, without fixed pauses.
+
+        Returns as soon as the terminator has been received (including any
+        characters already waiting, e.g. LF after CR), or what has been
+        received when the deadline (serial timeout) has passed."""
+        deadline = monotonic() + self.timeout
+        rcd = bytearray()
+        while True:
+            nwait = self.in_waiting
+            rcd += self.read(nwait if nwait > 0 else 1)
+            if rcd.endswith((b'\r', b'\n')) and rcd.strip(b'\r\n'):
+                break
+            if monotonic() >= deadline:
+                break
+        rcd += self.read(self.in_waiting)
+        return rcd.decode('ascii')
+
 
 
 class VICI_EUHA:
-    def __init__(self, port_str):
+    def __init__(self, port_str, fast = True):
         self.port_str = port_str
         self.ser_timeout = 1.0
+        self.fast = fast # terminator-driven reads (otherwise ultraread)
+        self.t_ready = 0.0 # time at which valve accepts next command
+        # timestamps (perf_counter_ns) of the last transaction, see timing.py
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('VICI_EUHA '+port_str)
         self.ser = Newserial(port=self.port_str,
                     baudrate=9600,
                     bytesize=serial.EIGHTBITS,
                     parity=serial.PARITY_NONE,
                     stopbits=serial.STOPBITS_ONE,
                     timeout=self.ser_timeout)
+        trace.attach(self.ser, 'VICI_EUHA '+port_str) # if tracing enabled
         self.ser.ultraflush()
         
         # check communications by sending a command and checking expected
@@ -79,9 +112,31 @@ class VICI_EUHA:
             raise Exception('EUHA valve configuration error! DANGER! (should be AM1)')
 
     
-    def sendrecv(self, send_str):
-        self.ser.ultrawrite(send_str)
-        self.lastreply = self.ser.ultraread()
+    def sendrecv(self, send_str, reply = True):
+        # `reply` = False for commands that do not give a reply (GOA, GOB)
+        if not self.fast:
+            self.t_send_ns = perf_counter_ns()
+            self.ser.ultrawrite(send_str)
+            self.lastreply = self.ser.ultraread()
+            self.t_recv_ns = perf_counter_ns()
+            if self.lastreply:
+                self.latency.record(send_str, self.t_send_ns, self.t_recv_ns)
+            return self.lastreply.strip()
+        dt = self.t_ready - monotonic()
+        if dt > 0:
+            sleep(dt) # previous command (valve move) still executing
+        self.ser.reset_input_buffer()
+        self.t_send_ns = perf_counter_ns()
+        self.ser.write(bytes(send_str, encoding='ascii')+b'\r\n')
+        if reply:
+            self.lastreply = self.ser.readreply()
+            self.t_recv_ns = perf_counter_ns()
+            if self.lastreply:
+                self.latency.record(send_str, self.t_send_ns, self.t_recv_ns)
+        else:
+            self.lastreply = ''
+            # give it some time to execute the command
+            self.t_ready = monotonic() + self.ser.PAUSE
         return self.lastreply.strip()
 
         
@@ -138,13 +193,161 @@ class VICI_EUHA:
             cmd_str = 'GOA'
         else:
             raise ValueError('Unknown EUHA position.')
-        self.sendrecv(cmd_str)
+        self.sendrecv(cmd_str, reply = False)
+        if self.fast:
+            self.confirm_pos(pos)
+
+    def confirm_pos(self, pos):
+        # poll CP until the valve is at `pos` (move done); False on deadline
+        deadline = monotonic() + self.ser.MOVE_TIMEOUT
+        while self.get_pos() != pos:
+            if monotonic() >= deadline:
+                print('EUHA GLITCH! valve did not confirm position', pos)
+                return False
+            self.t_ready = monotonic() + self.ser.PAUSE
+        self.t_ready = 0.0 # move done
+        return True
 
         
     def close(self):
         self.ser.close()
 
 
+
+class AsyncVICI_EUHA:
+    """asyncio version of VICI_EUHA, with the same command semantics
+
+        valve = await AsyncVICI_EUHA.open(port_str)
+        await valve.set_pos('A')
+    """
+    def __init__(self, port_str):
+        self.port_str = port_str
+        self.ser_timeout = 1.0
+        self.PAUSE = 0.1 # same as Newserial
+        self.LPAUSE = 0.5
+        self.MOVE_TIMEOUT = 2.0
+        self.t_ready = 0.0 # time at which valve accepts next command
+        self.ser = AsyncSerial(self.port_str,
+                               baudrate=9600,
+                               bytesize=serial.EIGHTBITS,
+                               parity=serial.PARITY_NONE,
+                               stopbits=serial.STOPBITS_ONE,
+                               timeout=self.ser_timeout,
+                               trace_name='AsyncVICI_EUHA '+port_str)
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('AsyncVICI_EUHA '+port_str)
+
+    @classmethod
+    async def open(cls, port_str):
+        valve = cls(port_str)
+        try:
+            await valve.initialize()
+        except:
+            valve.close()
+            raise
+        return valve
+
+    async def initialize(self):
+        await self.ultraflush()
+        VRresponse = await self.sendrecv('VR')
+        if not(VRresponse[:16]=='MUA_MAIN_ST_2.45'):
+            print('Got unexpected VICI_EUHA device response:')
+            print(repr(self.lastreply))
+            raise Exception('After opening serial comms: unexpected (or empty) device response')
+        if not(await self.sendrecv('AM')=='AM1'):
+            # Valve not well configured DANGER!
+            raise Exception('EUHA valve configuration error! DANGER! (should be AM1)')
+
+    async def ultraflush(self):
+        # RESET and check if things are quiet
+        await asyncio.sleep(self.LPAUSE)
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+        await asyncio.sleep(self.LPAUSE)
+        assert self.ser.in_waiting == 0, "PORT NOT QUIESCENT"
+
+    async def ultrawrite(self, wstr):
+        await self.ser.write(bytes(wstr, encoding='ascii')+b'\r\n')
+        await asyncio.sleep(self.PAUSE) # give it some time to execute the command
+
+    async def ultraread(self):
+        rcd = bytes()
+        while self.ser.in_waiting > 0:
+            rcd += self.ser.read_waiting()
+            await asyncio.sleep(self.PAUSE) # give it some time to cough up the full reply
+        return rcd.decode('ascii')
+
+    async def readreply(self):
+        # as Newserial.readreply: CR/LF terminated reply, deadline = timeout
+        deadline = asyncio.get_running_loop().time() + self.ser_timeout
+        rcd = bytearray()
+        while True:
+            rcd += self.ser.read_waiting()
+            if rcd.endswith((b'\r', b'\n')) and rcd.strip(b'\r\n'):
+                break
+            if not await self.ser.wait_data(deadline):
+                break
+        rcd += self.ser.read_waiting()
+        return rcd.decode('ascii')
+
+    async def sendrecv(self, send_str, reply = True):
+        # `reply` = False for commands that do not give a reply (GOA, GOB)
+        async with self.lock:
+            dt = self.t_ready - monotonic()
+            if dt > 0:
+                await asyncio.sleep(dt) # previous command still executing
+            self.ser.reset_input_buffer()
+            self.t_send_ns = perf_counter_ns()
+            await self.ser.write(bytes(send_str, encoding='ascii')+b'\r\n')
+            if reply:
+                self.lastreply = await self.readreply()
+                self.t_recv_ns = perf_counter_ns()
+                if self.lastreply:
+                    self.latency.record(send_str, self.t_send_ns,
+                                        self.t_recv_ns)
+            else:
+                self.lastreply = ''
+                self.t_ready = monotonic() + self.PAUSE
+        return self.lastreply.strip()
+
+    async def get_pos(self):
+        pos_str = await self.sendrecv('CP')
+        if pos_str=='CPB':
+            pos = 'B'
+        elif pos_str=='CPA':
+            pos = 'A'
+        else:
+            print('EUHA GLITCH! did not receive valid answer to CP...')
+            pos = None
+        return pos
+
+    async def set_pos(self, pos):
+        if pos == 'B':
+            cmd_str = 'GOB'
+        elif pos == 'A':
+            cmd_str = 'GOA'
+        else:
+            raise ValueError('Unknown EUHA position.')
+        await self.sendrecv(cmd_str, reply = False)
+        await self.confirm_pos(pos)
+
+    async def confirm_pos(self, pos):
+        # as VICI_EUHA.confirm_pos
+        deadline = monotonic() + self.MOVE_TIMEOUT
+        while await self.get_pos() != pos:
+            if monotonic() >= deadline:
+                print('EUHA GLITCH! valve did not confirm position', pos)
+                return False
+            self.t_ready = monotonic() + self.PAUSE
+        self.t_ready = 0.0 # move done
+        return True
+
+    def close(self):
+        self.ser.close()
+
+
 if __name__=='__main__':
     
     print('module self test.')
@@ -12,7 +12,14 @@ the hardcoded timings and device '!' identification string in VICI_TTL.init()
 
 If the MOLTECH-VICI-TTL device receives a command before finishing the pause
 specified in the firmware, the command will be ignored and a reply will not
-be sent.
+be sent. Therefore, VICI_TTL keeps track of the time at which the firmware
+will accept the next command (`t_ready`), and only waits (before sending)
+for the time that remains. `calibrate()` measures the minimal safe spacing
+between a reply and the next command on the actual device (or simulator).
+
+At start, the port is left alone for LPAUSE (0.5 s) before and after the
+input is flushed, as needed for some Arduino boards. For a board on which a
+shorter pause has been tested, pass it as `quiettime` (e.g. 0.1 s).
 
 The code is somewhat messy; it could be refactored. The frequent use of 
 `assert` is perhaps not elegant, but it is efficient in this case as we are
@@ -27,24 +34,39 @@ TODO: - see TODOs in code comments
         it.
 """
 
-from time import sleep
+import asyncio
+from time import sleep, monotonic, perf_counter_ns
 import serial
 from serial import Serial
 
+from .aioserial import AsyncSerial
+from .timing import LatencyStats
+from . import trace
+
 class VICI_TTL:
-    def __init__(self, port_str):
+    def __init__(self, port_str, calibrate = False, quiettime = None):
         
         #####
         # Here are the communication timings.
         # They should be carefully tuned to fit with the delays
         # specified in the 'VICI_TTL_firmware.ino' Arduino firmware.
-        # Hardcoded for now, need to be manually changed. A shared
-        # config-file would be overkill.
+        # Hardcoded for now, need to be manually changed (or measured with
+        # `calibrate`). A shared config-file would be overkill.
+        self.BOOTTIME = 1.0 # Needed for some Arduino boards to wake up...
+                            # Tweak this if initialization problem.
         self.LPAUSE = 0.5 # "long" pause (in seconds)
-        self.PAUSE = 0.12  # pause (in seconds)
+        # pause before and after the flush (port should stay quiet): LPAUSE,
+        # or a shorter `quiettime` tested on the board (opt-in)
+        self.QUIETTIME = self.LPAUSE if quiettime is None else quiettime
+        self.PAUSE = 0.12  # minimal time between reply and next command
+                           # (firmware LOOPDLY plus margin, in seconds)
         self.ser_timeout = 2.0 # give enough time for Arduino to reply!!
 
         self.port_str = port_str
+        # timestamps (perf_counter_ns) of the last transaction, see timing.py
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('VICI_TTL '+port_str)
 
         #####
         # Open serial port
@@ -54,15 +76,16 @@ class VICI_TTL:
                     parity=serial.PARITY_NONE,
                     stopbits=serial.STOPBITS_ONE,
                     timeout=self.ser_timeout)
-        sleep(1.0) # Needed for some Arduino boards to wake up...
-                   # Tweak this if initialization problem.
+        trace.attach(self.ser, 'VICI_TTL '+port_str) # if tracing enabled
+        # opening the port resets the Arduino: wait until it has booted
+        self.t_ready = monotonic() + self.BOOTTIME
+        self.wait_ready()
                 
-                
-        # Serial comms: wait , flush, wait, and check if things are quiet
-        sleep(self.LPAUSE) # just a pause
+        # Serial comms: wait, flush, wait, and check if things are quiet
+        sleep(self.QUIETTIME) # just a pause
         self.ser.reset_input_buffer()
         self.ser.reset_output_buffer()
-        sleep(self.LPAUSE)
+        sleep(self.QUIETTIME)
         assert self.ser.in_waiting == 0, "PORT NOT QUIESCENT"
         assert self.ser.out_waiting == 0, "PORT NOT QUIESCENT"
         
@@ -72,13 +95,17 @@ class VICI_TTL:
         # check communications by sending a command and checking expected
         # response
         self.ser.write(b'!')
-        reply = self.ser.read_until('!')
+        reply = self.ser.read_until(b'!')
+        self.t_ready = monotonic() + self.PAUSE
         if reply==b'Hello, this is MOLTECH-VICI-TTL control v260213a (dummy firmware)!':
             print('WARNING! Running dummy firmware. Valve actuator inactive.')
         elif not reply==b'Hello, this is MOLTECH-VICI-TTL control v260213a!':
             self.ser.close()
             print('reply = ', reply)
             raise IOError('VICI TTL control not communicating cleanly. Check device!')
+
+        if calibrate:
+            self.calibrate()
             
         # The following check can not be done via VICI_TTL
         # MAKE SURE YOURSELF THAT THE VALVE HAS BEEN PROPERLY CONFIGURED!
@@ -91,21 +118,72 @@ class VICI_TTL:
     
     def sendrecv(self, send_str):
         
-        # TO DO: ADD LOGGING 
-        #        (list of sends and list of replies, with time-stamps,
-        #        these lists may be saved for additional experiment timing
-        #        info)
+        # Time-stamped log of sends and replies: see devcomms.trace
+        # (opt-in), and t_send_ns/t_recv_ns/latency (devcomms.timing)
         
         assert len(send_str)==1, 'Only single-character commands!'
         
+        # GIVE TIME to arduino firmware to recover from previous command!
+        self.wait_ready()
         # empty read buffer before sending anything, making sure that
         # the reply read is indeed the answer to the command.
         self.ser.reset_input_buffer()
+        self.t_send_ns = perf_counter_ns()
         self.ser.write(send_str)
         self.lastreply = self.ser.read(size=1)
-        sleep(self.PAUSE) # GIVE TIME to arduino firmware to recover!
+        self.t_recv_ns = perf_counter_ns()
+        if self.lastreply:
+            self.latency.record(send_str, self.t_send_ns, self.t_recv_ns)
+        # the firmware accepts the next command once its loop delay, which
+        # starts when the reply is sent, has passed
+        self.t_ready = monotonic() + self.PAUSE
         return self.lastreply
 
+
+    def wait_ready(self):
+        """Wait only the time remaining until the firmware accepts commands"""
+        dt = self.t_ready - monotonic()
+        if dt > 0:
+            sleep(dt)
+
+
+    def calibrate(self, ntrials = 5, tmax = 0.3, resolution = 0.005,
+                  margin = 0.02):
+        """Measure the minimal safe spacing between reply and next command.
+
+        Pairs of '?' (status) commands are sent with decreasing spacing
+        (bisection between 0 and `tmax`). A spacing is safe if the second
+        command of all `ntrials` pairs gets its reply. The valve does not
+        move. PAUSE is set to the smallest safe spacing plus `margin`.
+
+        Returns the measured smallest safe spacing (in seconds)."""
+        ser_timeout = self.ser.timeout
+        self.ser.timeout = 0.5 # missing replies are expected, don't wait long
+        def safe(spacing):
+            for i in range(ntrials):
+                self.t_ready = monotonic() + tmax # 1st command: long spacing
+                if self.sendrecv(b'?') not in [b'A', b'B']:
+                    return False
+                self.t_ready = monotonic() + spacing
+                if self.sendrecv(b'?') not in [b'A', b'B']:
+                    return False
+            return True
+        try:
+            lo, hi = 0.0, tmax
+            if not safe(hi):
+                raise IOError('VICI TTL calibration: no reliable replies')
+            while hi - lo > resolution:
+                mid = 0.5*(lo + hi)
+                if safe(mid):
+                    hi = mid
+                else:
+                    lo = mid
+        finally:
+            self.ser.timeout = ser_timeout
+            self.t_ready = monotonic() + tmax
+        self.PAUSE = hi + margin
+        return hi
+
         
     def get_pos(self):
         reply = self.sendrecv(b'?')
@@ -139,6 +217,115 @@ class VICI_TTL:
 
 
 
+class AsyncVICI_TTL:
+    """asyncio version of VICI_TTL, with the same command semantics
+
+        valve = await AsyncVICI_TTL.open(port_str)
+        await valve.set_pos('A')
+    """
+    def __init__(self, port_str, quiettime = None):
+        # communication timings, see VICI_TTL
+        self.BOOTTIME = 1.0
+        self.LPAUSE = 0.5
+        self.QUIETTIME = self.LPAUSE if quiettime is None else quiettime
+        self.PAUSE = 0.12  # minimal time between reply and next command
+        self.ser_timeout = 2.0 # give enough time for Arduino to reply!!
+        self.t_ready = 0.0
+
+        self.port_str = port_str
+        self.ser = AsyncSerial(self.port_str,
+                               baudrate=9600,
+                               bytesize=serial.EIGHTBITS,
+                               parity=serial.PARITY_NONE,
+                               stopbits=serial.STOPBITS_ONE,
+                               timeout=self.ser_timeout,
+                               trace_name='AsyncVICI_TTL '+port_str)
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.t_send_ns = None
+        self.t_recv_ns = None
+        self.latency = LatencyStats('AsyncVICI_TTL '+port_str)
+
+    @classmethod
+    async def open(cls, port_str, quiettime = None):
+        valve = cls(port_str, quiettime)
+        try:
+            await valve.initialize()
+        except:
+            valve.close()
+            raise
+        return valve
+
+    async def initialize(self):
+        # opening the port resets the Arduino: wait until it has booted
+        self.t_ready = monotonic() + self.BOOTTIME
+        await self.wait_ready()
+
+        # Serial comms: wait, flush, wait, and check if things are quiet
+        await asyncio.sleep(self.QUIETTIME)
+        self.ser.reset_input_buffer()
+        self.ser.reset_output_buffer()
+        await asyncio.sleep(self.QUIETTIME)
+        assert self.ser.in_waiting == 0, "PORT NOT QUIESCENT"
+
+        # Initial communication with MOLTECH-VICI-TTL device
+        await self.ser.write(b'!')
+        reply = await self.ser.read_until(b'!')
+        self.t_ready = monotonic() + self.PAUSE
+        if reply==b'Hello, this is MOLTECH-VICI-TTL control v260213a (dummy firmware)!':
+            print('WARNING! Running dummy firmware. Valve actuator inactive.')
+        elif not reply==b'Hello, this is MOLTECH-VICI-TTL control v260213a!':
+            print('reply = ', reply)
+            raise IOError('VICI TTL control not communicating cleanly. Check device!')
+
+    async def sendrecv(self, send_str):
+        assert len(send_str)==1, 'Only single-character commands!'
+        async with self.lock:
+            await self.wait_ready() # GIVE TIME to arduino firmware to recover!
+            # empty read buffer before sending anything
+            self.ser.reset_input_buffer()
+            self.t_send_ns = perf_counter_ns()
+            await self.ser.write(send_str)
+            self.lastreply = await self.ser.read(1)
+            self.t_recv_ns = perf_counter_ns()
+            if self.lastreply:
+                self.latency.record(send_str, self.t_send_ns, self.t_recv_ns)
+            self.t_ready = monotonic() + self.PAUSE
+        return self.lastreply
+
+    async def wait_ready(self):
+        dt = self.t_ready - monotonic()
+        if dt > 0:
+            await asyncio.sleep(dt)
+
+    async def get_pos(self):
+        reply = await self.sendrecv(b'?')
+        if reply == b'B':
+            pos = 'B'
+        elif reply== b'A':
+            pos = 'A'
+        else:
+            print("VICI-TTL GLITCH! did not receive valid answer to '?'...")
+            pos = None
+        return pos
+
+    async def set_pos(self, pos):
+        if pos == 'B':
+            cmdstr = b'b'
+            chkstr = b'B'
+        elif pos == 'A':
+            cmdstr = b'a'
+            chkstr = b'A'
+        else:
+            raise ValueError('Unknown VICI-TTL position.')
+        reply = await self.sendrecv(cmdstr)
+        if reply != chkstr:
+            print('VICI-TTL GLITCH! bad valve reply: ', reply)
+
+    def close(self):
+        self.ser.close()
+
+
+
 if __name__=='__main__':
     
     print('module self test.')
@@ -147,6 +334,10 @@ if __name__=='__main__':
     immobile = False # if false will physically actuate the valve
     
     euha = VICI_TTL(comport)
+
+    print('calibrating command spacing...')
+    print('minimal safe spacing = {0:.3f} s'.format(euha.calibrate()))
+    print('PAUSE = {0:.3f} s'.format(euha.PAUSE))
     
     initialpos = euha.get_pos()
     print('initial position =', initialpos)
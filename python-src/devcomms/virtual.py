@@ -0,0 +1,408 @@
+"""
+Virtual time: run programs faster than real time, against device models
+
+`devcomms.timing.clock()` and `sleep()` use the time source set with
+`timing.set_clock()`. With a `VirtualClock`, time only advances when the
+clock jumps to its next event, or when somebody sleeps, so that a program
+of several days is replayed in seconds:
+
+    vclock = VirtualClock()
+    timing.set_clock(vclock)
+    sched = VirtualScheduler('program', vclock) # as EventScheduler
+    worker = InlineWorker('Aladdin', vclock)    # as DeviceWorker
+    ala = AladdinModel('COM4', ['01'])          # as Aladdin
+    worker.set_poll(lambda: ala.pump_cmd('01', 'DIS'), 1.0)
+    sched.at(vclock.now() + 60., start, ...)
+    vclock.run(until = vclock.now() + 86400., after = check)
+    timing.set_clock() # back to real time
+
+Everything runs in the thread that calls `vclock.run()`, one event at a
+time, in order of planned time. `InlineWorker` executes a command as soon
+as it is submitted, and its polls are events of the clock. Commands take no
+(virtual) time, unless they sleep.
+
+Device models (no serial port, state follows `clock()`):
+
+    AladdinModel    Aladdin pump(s) on one port (as Aladdin, AladdinBus)
+    ValveModel      two-position valve (as VICI_TTL, VICI_EUHA)
+
+The pty simulators (devcomms.simulators) use the same pump model.
+"""
+
+import heapq
+from collections import deque
+from concurrent.futures import Future
+from time import perf_counter
+
+from .timing import clock, sleep
+from .worker import Snapshot
+
+
+
+class VirtualClock:
+    """Simulated time, with the events of all virtual schedulers and workers
+
+    Starts at `t0` (default: the current perf_counter time, so that
+    `timing.wall_time()` gives times from now on)."""
+    def __init__(self, t0 = None):
+        self.t = perf_counter() if t0 is None else t0
+        self.events = [] # heap of (t, seq, func, args)
+        self.seq = 0
+        self.nevent = 0
+        self.halted = False
+
+    def now(self):
+        return self.t
+
+    def sleep(self, dt):
+        if dt > 0:
+            self.t += dt
+
+    def at(self, t, func, *args):
+        """Call `func(t, t_actual, *args)` at virtual time `t`"""
+        self.seq += 1
+        heapq.heappush(self.events, (t, self.seq, func, args))
+
+    def halt(self):
+        """End `run()` after the current event"""
+        self.halted = True
+
+    def run(self, until = None, after = None):
+        """Execute the events in order of time, until there are none left,
+        the next one is after `until`, or `halt()` is called. `after()` is
+        called after each event (e.g. the idle function of a GUI). Returns
+        the number of events executed."""
+        self.halted = False
+        n = 0
+        while self.events and not self.halted:
+            t, _, func, args = self.events[0]
+            if (until is not None) and (t > until):
+                break
+            heapq.heappop(self.events)
+            if t > self.t:
+                self.t = t
+            try:
+                func(t, self.t, *args)
+            except Exception as ex:
+                print('virtual clock: {0!r} in {1!r}'.format(ex, func))
+            n += 1
+            if after is not None:
+                after()
+        if (until is not None) and not self.halted and (self.t < until):
+            self.t = until
+        self.nevent += n
+        return n
+
+
+
+class VirtualScheduler:
+    """`timing.EventScheduler` in virtual time (events run by `vclock.run()`)"""
+    def __init__(self, name, vclock):
+        self.name = name
+        self.vclock = vclock
+        self.generation = 0 # incremented by cancel()
+        self.npending = 0
+
+    def at(self, t, func, *args):
+        """Execute `func(t, t_actual, *args)` at `clock()` time `t`"""
+        self.npending += 1
+        self.vclock.at(t, self._event, self.generation, func, args)
+
+    def _event(self, t, t_actual, generation, func, args):
+        if generation != self.generation:
+            return # cancelled
+        self.npending -= 1
+        func(t, t_actual, *args)
+
+    def cancel(self):
+        """Forget all planned events"""
+        self.generation += 1
+        self.npending = 0
+
+    def pending(self):
+        return self.npending
+
+    def stop(self, timeout = None):
+        self.cancel()
+
+
+
+class InlineWorker:
+    """`worker.DeviceWorker` in virtual time
+
+    Commands are executed immediately by `submit()`, in the calling thread.
+    Polls are events of the virtual clock."""
+    def __init__(self, name, vclock):
+        self.name = name
+        self.vclock = vclock
+        self.done = deque() # finished commands with a callback
+        self.poll_func = None
+        self.poll_period = None
+        self.poll_generation = 0
+        self.state = None # last Snapshot
+        # statistics
+        self.ncmd = 0
+        self.npoll = 0
+        self.nmissed = 0
+        self.t_busy = 0.0
+
+    def submit(self, func, *args, callback = None):
+        """Execute `func(*args)`. Returns a (done) Future."""
+        fut = Future()
+        fut.set_running_or_notify_cancel()
+        t0 = clock()
+        try:
+            fut.set_result(func(*args))
+        except Exception as ex:
+            fut.set_exception(ex)
+        self.t_busy += clock() - t0
+        self.ncmd += 1
+        if callback is not None:
+            self.done.append((fut, callback))
+        elif fut.exception() is not None:
+            print('{0:s} worker: {1!r} in {2!r}'.format(
+                self.name, fut.exception(), func))
+        return fut
+
+    def call(self, func, *args, timeout = None):
+        return self.submit(func, *args).result()
+
+    def set_poll(self, func, period):
+        self.poll_func = func
+        self.poll_period = period
+        self.poll_generation += 1
+        self.vclock.at(clock(), self._poll, self.poll_generation)
+
+    def clear_poll(self):
+        self.poll_func = None
+        self.poll_generation += 1
+        self.state = None
+
+    def pending(self):
+        return 0
+
+    def process_done(self):
+        n = 0
+        while self.done:
+            fut, callback = self.done.popleft()
+            callback(fut)
+            n += 1
+        return n
+
+    def stop(self, timeout = None):
+        self.clear_poll()
+
+    def _poll(self, t, t_actual, generation):
+        if generation != self.poll_generation:
+            return # cleared or replaced
+        t0 = clock()
+        try:
+            result, error = self.poll_func(), None
+        except Exception as ex:
+            result, error = None, ex
+        t1 = clock()
+        self.t_busy += t1 - t0
+        self.npoll += 1
+        if generation == self.poll_generation:
+            self.state = Snapshot(t1, self.npoll, result, error, t_actual - t)
+        # keep rhythm, do not execute missed polls
+        t_next = t + self.poll_period
+        while t_next <= t1:
+            t_next += self.poll_period
+            self.nmissed += 1
+        self.vclock.at(t_next, self._poll, generation)
+
+
+
+def _fmt(x):
+    # Aladdin style number: at most 4 significant digits, no exponent
+    if x < 10.:
+        return '{0:.3f}'.format(x)
+    elif x < 100.:
+        return '{0:.2f}'.format(x)
+    elif x < 1000.:
+        return '{0:.1f}'.format(x)
+    else:
+        return '{0:d}'.format(round(x))
+
+
+
+class PumpModel:
+    """State of one simulated Aladdin pump, volumes follow `clock()`"""
+    # rate unit conversion to µl/min
+    RATE_UNITS = {'UM': 1.0, 'MM': 1000.0, 'UH': 1/60., 'MH': 1000/60.}
+
+    def __init__(self):
+        self.status = 'S'
+        self.dia = 20.10
+        self.rate = 1.0
+        self.rate_units = 'UM'
+        self.direction = 'INF'
+        self.vol = 0.0 # target volume (0 = no limit), in vol_units
+        self.vinf = 0.0
+        self.vwdr = 0.0
+        self.pf = 0
+        self.phase = 1
+        self.fun = {} # program: function per phase
+        self.t_last = clock()
+
+    def vol_units(self):
+        # small syringes in µl, large syringes in ml
+        return 'UL' if self.dia <= 14.0 else 'ML'
+
+    def execute(self, body):
+        """Execute command `body` (without address), e.g. 'RAT1.5UM'.
+        Returns the reply data string."""
+        body = body.upper()
+        j = 0
+        while j < len(body) and body[j].isalpha():
+            j += 1
+        cmd, arg = body[:j], body[j:]
+        # commands that take letters as argument
+        for prefix in ['DIR', 'CLD', 'FUN']:
+            if cmd.startswith(prefix) and len(cmd) > len(prefix):
+                cmd, arg = prefix, cmd[len(prefix):] + arg
+        self.update()
+        try:
+            return self.command(cmd, arg)
+        except ValueError:
+            return '?OOR'
+
+    def update(self):
+        t = clock()
+        dt = t - self.t_last
+        self.t_last = t
+        if self.status in ['I', 'W']:
+            dv = self.rate * self.RATE_UNITS[self.rate_units] * dt / 60.
+            if self.vol_units() == 'ML':
+                dv /= 1000.
+            if self.status == 'I':
+                self.vinf += dv
+                if self.vol > 0 and self.vinf >= self.vol:
+                    self.vinf = self.vol
+                    self.status = 'S' # target volume dispensed
+            else:
+                self.vwdr += dv
+                if self.vol > 0 and self.vwdr >= self.vol:
+                    self.vwdr = self.vol
+                    self.status = 'S'
+
+    def command(self, cmd, arg):
+        # returns reply data string
+        stopped = self.status in ['S', 'P']
+        if cmd == 'VER':
+            return 'NE1000V3.928'
+        elif cmd == 'RUN':
+            self.status = 'I' if self.direction == 'INF' else 'W'
+            return ''
+        elif cmd == 'STP':
+            self.status = 'P' if self.status in ['I', 'W'] else 'S'
+            return ''
+        elif cmd == 'DIS':
+            return 'I'+_fmt(self.vinf)+'W'+_fmt(self.vwdr)+self.vol_units()
+        elif cmd == 'DIA':
+            if not arg:
+                return _fmt(self.dia)
+            if not stopped:
+                return '?NA'
+            self.dia = float(arg)
+            return ''
+        elif cmd == 'RAT':
+            if not arg:
+                return _fmt(self.rate)+self.rate_units
+            units = arg[-2:] if arg[-2:] in self.RATE_UNITS else self.rate_units
+            value = arg[:-2] if arg[-2:] in self.RATE_UNITS else arg
+            self.rate = float(value)
+            self.rate_units = units
+            return ''
+        elif cmd == 'DIR':
+            if not arg:
+                return self.direction
+            if arg == 'REV':
+                arg = 'WDR' if self.direction == 'INF' else 'INF'
+            if arg not in ['INF', 'WDR']:
+                return '?'
+            self.direction = arg
+            if self.status in ['I', 'W']:
+                self.status = 'I' if arg == 'INF' else 'W'
+            return ''
+        elif cmd == 'VOL':
+            if not arg:
+                return _fmt(self.vol)+self.vol_units()
+            self.vol = float(arg)
+            return ''
+        elif cmd == 'CLD':
+            if arg == 'INF':
+                self.vinf = 0.0
+            elif arg == 'WDR':
+                self.vwdr = 0.0
+            else:
+                return '?'
+            return ''
+        elif cmd == 'PF':
+            if not arg:
+                return str(self.pf)
+            self.pf = int(arg)
+            return ''
+        elif cmd == 'PHN':
+            if not arg:
+                return '{0:02d}'.format(self.phase)
+            self.phase = int(arg)
+            return ''
+        elif cmd == 'FUN':
+            if not arg:
+                return self.fun.get(self.phase, 'RAT')
+            self.fun[self.phase] = arg
+            return ''
+        else:
+            return '?'
+
+
+
+class AladdinModel:
+    """Aladdin pump(s) on port `port_str`, with the interface of
+    `aladdin.Aladdin` (`pump_cmd`, `pump_cmds`, `close`)"""
+    def __init__(self, port_str, pump_ids = ('01',)):
+        self.port_str = port_str
+        self.pumps = {pid: PumpModel() for pid in pump_ids}
+        self.ncmd = 0
+
+    def pump_cmd(self, idstr, cmdstr):
+        self.ncmd += 1
+        pump = self.pumps.get(idstr)
+        if pump is None:
+            return (None, None) # no pump at this address: no reply
+        data = pump.execute(cmdstr)
+        return (pump.status, data)
+
+    def pump_cmds(self, idstr, cmdstrs, depth = 1):
+        return [self.pump_cmd(idstr, cmdstr) for cmdstr in cmdstrs]
+
+    def close(self):
+        pass
+
+
+
+class ValveModel:
+    """Two-position valve on port `port_str`, with the interface of
+    `vici_ttl.VICI_TTL` and `vici_euha.VICI_EUHA` (`set_pos`, `get_pos`,
+    `close`). A move takes `movetime` seconds (`timing.sleep()`)."""
+    def __init__(self, port_str, position = 'B', movetime = 0.0):
+        self.port_str = port_str
+        self.position = position
+        self.movetime = movetime
+        self.nmove = 0
+
+    def get_pos(self):
+        return self.position
+
+    def set_pos(self, pos):
+        if pos not in ['A', 'B']:
+            raise ValueError('valve position should be A or B')
+        if self.movetime > 0:
+            sleep(self.movetime)
+        self.position = pos
+        self.nmove += 1
+
+    def close(self):
+        pass
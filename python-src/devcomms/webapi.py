@@ -0,0 +1,309 @@
+"""
+Small JSON REST and WebSocket server (asyncio, standard library only)
+
+Serves the control API of a lab program (see FlowInjectPilot_service.py) to
+scripts and light clients, without browser and widgets:
+
+    api = WebAPI()
+    api.route('GET', '/pumps', list_pumps)           # handler(req) -> object
+    api.route('POST', '/pumps/{name}/start', start)  # req.params['name']
+    api.every(0.1, tick)                             # periodic function
+    api.on_stop(close_all)
+    ...
+    api.publish({'type': 'log', 'line': line}, topic = 'pump1')
+    ...
+    api.run('0.0.0.0', 9013)            # or: await api.serve('0.0.0.0', 9013)
+
+Handlers and periodic functions are plain functions, called one at a time
+in the event loop thread, so that they need no locks among themselves. A
+handler gets a `Request` (method, path, params from the route, query, and
+body: the parsed JSON, or None) and returns a JSON-serializable object
+(status 200), or a string (text/plain, e.g. Prometheus metrics). Errors are
+returned as {"error": "ValueError", "message": "..."} (as in the broker),
+with status 400 for ValueError, 404 for KeyError (unknown name) and unknown
+routes, and 500 for other exceptions.
+
+WebSocket clients connect to /ws, or /ws?topic=<topic> to receive only the
+messages of one topic (and those without topic). Each published object is
+sent as one JSON text message. `publish()` can be called from any thread,
+and costs nothing when there are no clients. A client that does not keep up
+(more than `max_queue` messages waiting) is disconnected. Messages from the
+clients are ignored (except ping and close).
+
+HTTP/1.1 with keep-alive; no chunked request bodies, no TLS (local network).
+"""
+
+import json
+import base64
+import struct
+import hashlib
+import asyncio
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_BODY = 1 << 20 # request bodies and WebSocket frames
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error'}
+
+
+
+class Request:
+    def __init__(self, method, path, params, query, body):
+        self.method = method
+        self.path = path
+        self.params = params # from the route pattern, e.g. {'name': 'pump1'}
+        self.query = query # {key: value} (last value of each key)
+        self.body = body # parsed JSON, or None
+
+    def get(self, key, default = None):
+        """Value from the body (if it is an object) or the query"""
+        if isinstance(self.body, dict) and key in self.body:
+            return self.body[key]
+        return self.query.get(key, default)
+
+
+
+def _ws_frame(payload, opcode = 0x1):
+    # unmasked, unfragmented frame (server to client)
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+async def _ws_read(reader):
+    # one frame: (opcode, payload)
+    b0, b1 = await reader.readexactly(2)
+    n = b1 & 0x7f
+    if n == 126:
+        n, = struct.unpack('!H', await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack('!Q', await reader.readexactly(8))
+    if n > MAX_BODY:
+        raise ValueError('WebSocket frame too large')
+    mask = await reader.readexactly(4) if b1 & 0x80 else None
+    data = await reader.readexactly(n)
+    if mask is not None:
+        data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return b0 & 0x0f, data
+
+
+
+class _WSClient:
+    def __init__(self, writer, topic, max_queue):
+        self.writer = writer
+        self.topic = topic
+        self.queue = asyncio.Queue(max_queue)
+
+
+
+class WebAPI:
+    def __init__(self, max_queue = 1000):
+        self.routes = [] # (method, pattern parts, handler)
+        self.periodic = [] # (period, func)
+        self.stoppers = []
+        self.clients = set() # _WSClient
+        self.max_queue = max_queue
+        self.loop = None
+        self.thread_id = None
+        self.nrequests = 0
+        self.npublished = 0
+
+    def route(self, method, pattern, handler):
+        """`handler(req)` for `method` requests on `pattern`, where parts
+        in braces ('/pumps/{name}') match any path part"""
+        self.routes.append((method, pattern.strip('/').split('/'), handler))
+
+    def every(self, period, func):
+        """Call `func()` every `period` seconds (fixed rhythm)"""
+        self.periodic.append((period, func))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._start_periodic, period, func)
+
+    def on_stop(self, func):
+        """Call `func()` when the server stops"""
+        self.stoppers.append(func)
+
+    def publish(self, obj, topic = None):
+        """Send `obj` to the WebSocket clients (of `topic`)"""
+        if not self.clients:
+            return
+        msg = _ws_frame(json.dumps(obj).encode('utf-8'))
+        if threading.get_ident() == self.thread_id:
+            self._publish(msg, topic)
+        else:
+            self.loop.call_soon_threadsafe(self._publish, msg, topic)
+
+    def _publish(self, msg, topic):
+        self.npublished += 1
+        for client in list(self.clients):
+            if (topic is None) or (client.topic is None)\
+                    or (client.topic == topic):
+                try:
+                    client.queue.put_nowait(msg)
+                except asyncio.QueueFull:
+                    # too slow: drop the client
+                    self.clients.discard(client)
+                    client.writer.close()
+
+    def dispatch(self, method, target, body):
+        """Handle a request, returns (status, content type, content)"""
+        self.nrequests += 1
+        url = urlsplit(target)
+        parts = url.path.strip('/').split('/')
+        handler, params, allowed = None, None, False
+        for m, pattern, h in self.routes:
+            if len(pattern) != len(parts):
+                continue
+            p = {}
+            for pp, part in zip(pattern, parts):
+                if pp.startswith('{') and pp.endswith('}'):
+                    p[pp[1:-1]] = part
+                elif pp != part:
+                    break
+            else:
+                allowed = True
+                if m == method:
+                    handler, params = h, p
+                    break
+        if handler is None:
+            status = 405 if allowed else 404
+            return self._error(status, 'KeyError',
+                               'no route: '+method+' '+url.path)
+        try:
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            data = json.loads(body) if body.strip() else None
+            result = handler(Request(method, url.path, params, query, data))
+        except KeyError as ex:
+            return self._error(404, 'KeyError', 'unknown: '+str(ex))
+        except ValueError as ex: # includes JSON errors
+            return self._error(400, type(ex).__name__, str(ex))
+        except Exception as ex:
+            return self._error(500, type(ex).__name__, str(ex))
+        if isinstance(result, str):
+            return 200, 'text/plain; charset=utf-8', result.encode('utf-8')
+        return 200, 'application/json', json.dumps(result).encode('utf-8')
+
+    def _error(self, status, name, message):
+        content = json.dumps({'error': name, 'message': message})
+        return status, 'application/json', content.encode('utf-8')
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if not h.strip():
+                        break
+                    key, _, value = h.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self._websocket(target, headers, reader, writer)
+                    return
+                n = int(headers.get('content-length', 0))
+                if n > MAX_BODY:
+                    status, ctype, content = self._error(413, 'ValueError',
+                                                         'body too large')
+                    keep = False
+                else:
+                    body = await reader.readexactly(n) if n else b''
+                    status, ctype, content = self.dispatch(method, target, body)
+                    keep = (version == 'HTTP/1.1') and\
+                        (headers.get('connection', '').lower() != 'close')
+                writer.write('HTTP/1.1 {0:d} {1:s}\r\n'
+                             'Content-Type: {2:s}\r\n'
+                             'Content-Length: {3:d}\r\n'
+                             'Connection: {4:s}\r\n\r\n'.format(
+                                 status, _REASONS.get(status, ''), ctype,
+                                 len(content), 'keep-alive' if keep else 'close')
+                             .encode('latin-1') + content)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass # client gone, or not speaking HTTP
+        finally:
+            writer.close()
+
+    async def _websocket(self, target, headers, reader, writer):
+        url = urlsplit(target)
+        if url.path.rstrip('/') != '/ws':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            return
+        key = headers.get('sec-websocket-key', '')
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID)\
+                                  .encode('ascii')).digest()).decode('ascii')
+        writer.write('HTTP/1.1 101 Switching Protocols\r\n'
+                     'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     'Sec-WebSocket-Accept: {0:s}\r\n\r\n'.format(accept)\
+                     .encode('latin-1'))
+        topic = parse_qs(url.query).get('topic', [None])[-1]
+        client = _WSClient(writer, topic, self.max_queue)
+        self.clients.add(client)
+        sender = asyncio.ensure_future(self._ws_send(client))
+        try:
+            while True:
+                opcode, data = await _ws_read(reader)
+                if opcode == 0x8: # close
+                    writer.write(_ws_frame(data[:2], 0x8))
+                    break
+                elif opcode == 0x9: # ping
+                    writer.write(_ws_frame(data, 0xA))
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+
+    async def _ws_send(self, client):
+        try:
+            while True:
+                msg = await client.queue.get()
+                client.writer.write(msg)
+                await client.writer.drain()
+        except ConnectionError:
+            self.clients.discard(client)
+
+    def _start_periodic(self, period, func):
+        loop = self.loop
+        t0 = loop.time()
+        def tick(k):
+            try:
+                func()
+            except Exception as ex:
+                print('webapi: {0!r} in {1!r}'.format(ex, func))
+            # keep rhythm, skip missed ticks
+            k = max(k + 1, int((loop.time() - t0) / period) + 1)
+            loop.call_at(t0 + k*period, tick, k)
+        loop.call_soon(tick, 0)
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        for period, func in self.periodic:
+            self._start_periodic(period, func)
+        server = await asyncio.start_server(self.handle_client, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for func in self.stoppers:
+                func()
+
+    def run(self, host, port):
+        """Serve until Ctrl-C"""
+        try:
+            asyncio.run(self.serve(host, port))
+        except KeyboardInterrupt:
+            pass
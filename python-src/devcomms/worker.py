@@ -0,0 +1,156 @@
+"""
+Worker thread per device, with a command queue and state snapshots
+
+A `DeviceWorker` executes all I/O of one device in its own thread, so that
+the program that controls the device (typically a GUI event loop) never
+waits for the device:
+
+    worker = DeviceWorker('EUHA')
+    worker.submit(open_valve, port, callback = on_open) # returns a Future
+    worker.set_poll(lambda: valve.get_pos(), 1.0)
+    ...
+    # in the GUI thread, e.g. in idle():
+    worker.process_done() # runs the callbacks of finished commands here
+    snap = worker.state # last poll result, never blocks
+    if snap is not None:
+        show(snap.result)
+
+Commands (any callable) are executed one at a time, in order of
+submission. The poll function is called every `period` seconds, on a fixed
+rhythm (missed polls are skipped, not made up), between commands. Its
+result is published as an immutable `Snapshot` in `worker.state` (replaced
+as a whole, so that reading it needs no lock).
+
+Callbacks are not run by the worker thread but by whoever calls
+`process_done()`, so that they can safely update the GUI. A callback gets
+the `Future` of the command (`fut.result()` raises the exception of the
+command, if any). Exceptions of commands without a callback are printed.
+"""
+
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
+from .timing import clock
+
+
+# t: clock() time of the poll, seq: poll number, result: return value of the
+# poll function (None on error), error: exception (or None),
+# lateness: start of the poll relative to its scheduled time (s)
+Snapshot = namedtuple('Snapshot', ['t', 'seq', 'result', 'error', 'lateness'])
+
+_STOP = object()
+
+
+
+class DeviceWorker:
+    def __init__(self, name):
+        self.name = name
+        self.jobs = queue.Queue()
+        self.done = queue.Queue() # finished commands with a callback
+        self.poll_func = None
+        self.poll_period = None
+        self.poll_next = 0.0
+        self.state = None # last Snapshot
+        # statistics
+        self.ncmd = 0
+        self.npoll = 0
+        self.nmissed = 0 # polls skipped because the worker was busy
+        self.t_busy = 0.0
+        self.thread = threading.Thread(target = self._run,
+                                       name = 'DeviceWorker '+name,
+                                       daemon = True)
+        self.thread.start()
+
+    def submit(self, func, *args, callback = None):
+        """Queue `func(*args)` for execution by the worker. Returns a Future."""
+        fut = Future()
+        self.jobs.put((fut, func, args, callback))
+        return fut
+
+    def call(self, func, *args, timeout = None):
+        """Execute `func(*args)` by the worker and wait for the result"""
+        return self.submit(func, *args).result(timeout)
+
+    def set_poll(self, func, period):
+        """Call `func()` every `period` seconds, result in `state`"""
+        self.poll_period = period
+        self.poll_next = clock()
+        self.poll_func = func
+        self.jobs.put(None) # wake up the worker
+
+    def clear_poll(self):
+        self.poll_func = None
+        self.state = None
+
+    def pending(self):
+        """Number of commands waiting in the queue"""
+        return self.jobs.qsize()
+
+    def process_done(self):
+        """Run the callbacks of finished commands (in the calling thread)"""
+        n = 0
+        while True:
+            try:
+                fut, callback = self.done.get_nowait()
+            except queue.Empty:
+                return n
+            callback(fut)
+            n += 1
+
+    def stop(self, timeout = None):
+        """Stop the worker after the commands already queued"""
+        self.jobs.put(_STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            func = self.poll_func
+            if func is None:
+                timeout = None
+            else:
+                timeout = max(0.0, self.poll_next - clock())
+            try:
+                item = self.jobs.get(timeout = timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                return
+            if item is not None:
+                fut, job, args, callback = item
+                t0 = clock()
+                if fut.set_running_or_notify_cancel():
+                    try:
+                        fut.set_result(job(*args))
+                    except Exception as ex:
+                        fut.set_exception(ex)
+                self.t_busy += clock() - t0
+                self.ncmd += 1
+                if callback is not None:
+                    self.done.put((fut, callback))
+                elif fut.exception() is not None:
+                    # nobody is going to look at the Future
+                    print('{0:s} worker: {1!r} in {2!r}'.format(
+                        self.name, fut.exception(), job))
+            func = self.poll_func
+            if (func is not None) and (clock() >= self.poll_next):
+                self._poll(func)
+
+    def _poll(self, func):
+        t0 = clock()
+        lateness = t0 - self.poll_next
+        try:
+            result, error = func(), None
+        except Exception as ex:
+            result, error = None, ex
+        t1 = clock()
+        self.t_busy += t1 - t0
+        self.npoll += 1
+        if func is self.poll_func: # not cleared in the meantime
+            self.state = Snapshot(t1, self.npoll, result, error, lateness)
+        # keep rhythm, do not execute missed polls
+        self.poll_next += self.poll_period
+        while self.poll_next <= t1:
+            self.poll_next += self.poll_period
+            self.nmissed += 1
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of VICI EUHA valve transactions
+
+Compares the original fixed-pause transactions (`fast=False`, ultrawrite and
+ultraread) with the terminator-driven reply reader (`fast=True`) of
+`devcomms.vici_euha.VICI_EUHA`, for `get_pos` and `set_pos`.
+
+WARNING: `set_pos` physically actuates the valve (set `immobile = True` to
+only benchmark `get_pos`).
+
+With `port_str = None` the benchmark runs against the pseudo-terminal valve
+simulator (Linux).
+"""
+
+from time import perf_counter
+from statistics import median
+
+from devcomms.vici_euha import VICI_EUHA
+
+
+# Parameters
+
+port_str = 'COM13'
+# port_str = None # simulator
+immobile = False # if false will physically actuate the valve
+NCMD = 20
+
+
+
+def timeit(func, *args):
+    ts = []
+    for i in range(NCMD):
+        t0 = perf_counter()
+        func(*args)
+        ts.append(perf_counter() - t0)
+    return 'median {0:7.1f} ms   min {1:7.1f} ms   max {2:7.1f} ms'\
+        .format(1e3*median(ts), 1e3*min(ts), 1e3*max(ts))
+
+
+def bench(fast):
+    euha = VICI_EUHA(port_str, fast = fast)
+    print('fast = ', fast)
+    print('    get_pos        :', timeit(euha.get_pos))
+    if not immobile:
+        def switch():
+            euha.set_pos('A')
+            euha.set_pos('B')
+        wrong = [] # position read back just after the move
+        def switch_check():
+            for pos in ['A', 'B']:
+                euha.set_pos(pos)
+                if euha.get_pos() != pos:
+                    wrong.append(pos)
+        print('    set_pos x2     :', timeit(switch))
+        print('    (set+get)x2    :', timeit(switch_check))
+        print('    wrong position : {0:d} of {1:d}'.format(len(wrong), 2*NCMD))
+    euha.close()
+
+
+
+if __name__ == '__main__':
+    for fast in [False, True]:
+        if port_str is None:
+            # a fresh simulator per mode (no moves left over)
+            from devcomms.simulators import VICIEUHASim
+            with VICIEUHASim() as sim:
+                port_str = sim.port
+                bench(fast)
+            port_str = None
+        else:
+            bench(fast)
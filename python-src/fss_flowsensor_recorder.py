@@ -2,6 +2,36 @@
 Flow rate recorder as part of the MOLTECH-FSS Flow Sensor System
 
 This program communicates with MOLTECH-FSS modules via a USB serial link.
+Several sensors (one per channel) can be recorded at the same time. They are
+polled concurrently (one thread per sensor), so that adding sensors does not
+lower the sampling rate of each sensor.
+
+Output is a single tab-separated file. The sensors are polled on a uniform
+time grid (period Tsleep), with absolute deadlines: the time taken by the
+measurements does not add up, and the timeline does not drift. Each row is
+one slot of the grid: the slot time, the scheduling jitter (lateness of the
+start of the measurement), a flag for missed slots (when the previous slot
+took too long; no measurement, but the row is kept to keep the grid
+complete), and the time and flow of every sensor. Each sensor has its own
+time column (midpoint of its request and reply). In continuous mode, the sensors
+are sampled independently: each row is then one sample, with its sensor
+number.
+
+With a single sensor, polled, the file keeps the original two-column format
+(`time(s)`, `flow(nlmin)`), unless `gridtable` is set. Missed slots are then
+left out.
+
+With `outformat = 'hdf5'` the samples go to an HDF5 file instead, with one
+group per sensor (`sensor_0`, `sensor_1`, ...) holding `time` and `flow`
+datasets, and the sensor name and info as attributes. The `grid` group holds
+the slot `time`, `jitter` and `missed` datasets (polling mode). The file is opened in
+SWMR mode (single writer, multiple readers), and can be read during the
+recording:
+
+    with h5py.File(path, 'r', libver='latest', swmr=True) as f:
+        flow = f['sensor_0/flow']
+        ...
+        flow.refresh() # get the samples added since
 
 Hardware and firmware of the MOLTECH-FSS modules are described at
     https://github.com/mhvwerts/MANBAMM-control/tree/main/MOLTECH-flow-sensor-system
@@ -12,64 +42,289 @@ MOLTECH-Anjou, CNRS, Université d'Angers
 """
 
 #%% CONFIGURATION
-portstr = "COM11"
-# portstr = None # development
+portstrs = ["COM11"]
+# portstrs = ["COM11", "COM12", "COM14"] # one sensor per channel
+# portstrs = [None, None] # development (simulated modules)
+
+# use the serial port broker (devcomms.broker) to share the sensor with
+# other programs: set to broker address (e.g. 'tcp://127.0.0.1:7650')
+broker = None
+
+# continuous acquisition: sample as fast as the sensor allows (about 30 Hz),
+# write all samples every Tsleep seconds (direct serial connection only)
+continuous = False
+
+# live plot of the flow (in a separate window and process; needs pyqtgraph)
+# EXPERIMENTAL: only tested on the simulated sensor, see fss_liveview.py
+liveview = False
 
 outpname = '../local/'
+outformat = 'csv' # 'csv' or 'hdf5'
+# text output with the grid columns (slot time, jitter, missed) and the
+# sensor names, also for a single sensor (always so with several sensors)
+gridtable = False
+Tflush = 10.0 # HDF5: write samples to disk every Tflush seconds (text: each)
 
-Tsleep = 1.0
+Tsleep = 1.0 # sampling period (s)
 MAXITER = 20000
 
 #%%
 
 from pathlib import Path
-from time import sleep
-from time import time
+from time import perf_counter_ns
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-if portstr is not None:
-    from devcomms.moltech_fss import MOLTECH_FSS
-else:
-    # simulated module for development purposes
-    from devcomms.moltech_fss import MOLTECH_FSS_dummy as MOLTECH_FSS
+import numpy as np
+
+from devcomms.moltech_fss import MOLTECH_FSS
+from devcomms.moltech_fss import MOLTECH_FSS_dummy
+from devcomms import timing
+if liveview:
+    from fss_liveview import LiveViewFeed
+if broker is not None:
+    from devcomms.broker import MOLTECH_FSS_proxy
+
+
+
+def open_sensor(port_str):
+    if port_str is None:
+        # simulated module for development purposes
+        return MOLTECH_FSS_dummy(port_str)
+    elif broker is not None:
+        return MOLTECH_FSS_proxy(port_str, broker=broker)
+    else:
+        return MOLTECH_FSS(port_str)
+
+
+def parse_flow(reply):
+    # flow (nl/min) from the reply of get_measurement(), NaN if there was
+    # no valid reply (the module answers '?' to bad input)
+    try:
+        return float(reply)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def measure(fss):
+    # monotonic high-resolution timestamps, converted to wall clock time
+    # with the session anchor (see devcomms.timing); returns the raw reply
+    t_meas0 = perf_counter_ns()
+    reply = fss.get_measurement()
+    t_meas1 = perf_counter_ns()
+    return timing.wall_time_ns((t_meas0+t_meas1)//2), reply
+
+
+
+class HDF5Writer:
+    """Append samples to chunked, resizable datasets in an HDF5 file
+    
+    Samples are collected in memory, and added to the file by `flush()`."""
+    def __init__(self, path, fsss, t0_iso, grid_period=None, chunksize=4096):
+        import h5py
+        self.chunksize = chunksize
+        self.f = h5py.File(path, 'w', libver='latest')
+        self.f.attrs['t0_abs_time_iso'] = t0_iso
+        self.series = [] # (datasets, lists of pending data) per group
+        for k, fss in enumerate(fsss):
+            grp = self.f.create_group(f'sensor_{k}')
+            grp.attrs['name'] = fss.name
+            grp.attrs['info'] = fss.info or ''
+            grp.attrs['port'] = str(fss.port_str)
+            self.add_series(grp, [('time', 'f8', 's'),
+                                  ('flow', 'f8', 'nl/min')])
+        if grid_period is not None:
+            grp = self.f.create_group('grid')
+            grp.attrs['period'] = grid_period
+            self.grid = self.add_series(grp, [('time', 'f8', 's'),
+                                              ('jitter', 'f8', 's'),
+                                              ('missed', 'i1', '')])
+        self.f.swmr_mode = True # from here on, readers can open the file
+        
+    def add_series(self, grp, columns):
+        dsets = []
+        for name, dtype, units in columns:
+            dset = grp.create_dataset(name, (0,), dtype=dtype,
+                                      chunks=(self.chunksize,),
+                                      maxshape=(None,))
+            dset.attrs['units'] = units
+            dsets.append(dset)
+        self.series.append((dsets, [[] for dset in dsets]))
+        return len(self.series) - 1
+        
+    def append(self, k, t, flow):
+        # sensor k. t and flow: single values or arrays (floats; missing
+        # or invalid measurements are NaN)
+        self.append_series(k, t, flow)
+        
+    def append_grid(self, t, jitter, missed):
+        self.append_series(self.grid, t, np.nan if jitter is None else jitter,
+                           missed)
+        
+    def append_series(self, i, *values):
+        for dset, pending, v in zip(*self.series[i], values):
+            pending.append(np.array(v, dtype=dset.dtype, ndmin=1))
+        
+    def flush(self):
+        for dsets, pendings in self.series:
+            for dset, pending in zip(dsets, pendings):
+                if not pending:
+                    continue
+                data = np.concatenate(pending)
+                n = dset.shape[0]
+                dset.resize((n + len(data),))
+                dset[n:] = data
+                dset.flush()
+                pending.clear()
+            
+    def close(self):
+        self.flush()
+        self.f.close()
 
 
 
 print('hello, world')
 print()
 
+Nsens = len(portstrs)
 
-fss = MOLTECH_FSS(portstr)
+if continuous and ((broker is not None) or (None in portstrs)):
+    # the simulated module and the broker proxy only answer single polls
+    raise ValueError('continuous acquisition needs directly connected'
+                     ' sensors (no broker, no simulated modules)')
 
+# one thread per sensor: open and poll all sensors at the same time
+pool = ThreadPoolExecutor(max_workers=Nsens)
 
-print(fss.name)
-print(fss.info)
+fsss = list(pool.map(open_sensor, portstrs))
 
-tfile = time()
+for k, fss in enumerate(fsss):
+    print(k, fss.name)
+    print(fss.info)
+
+t0 = timing.clock()
+tfile = timing.wall_time(t0)
 dtfile = datetime.fromtimestamp(tfile)
 tfstr_full = dtfile.isoformat()
 tfstr = tfstr_full.split('.')[0]
-outfname = fss.name + ' ' + tfstr.replace(':','-') + '.csv'
+if Nsens == 1:
+    outfname = fsss[0].name + ' ' + tfstr.replace(':','-')
+else:
+    outfname = f'MOLTECH-FSS {Nsens} sensors ' + tfstr.replace(':','-')
+outfname += '.h5' if outformat == 'hdf5' else '.csv'
 
 print(outfname)
 
+if liveview:
+    view = LiveViewFeed([fss.name for fss in fsss])
+
 outpath = Path(outpname, outfname)
 
-fout = open(outpath, 'w')
-fout.write('t0_abs_time_iso\t')
-fout.write(tfstr_full)
-fout.write('\n')
-fout.write('time(s)\tflow(nlmin)\n')
-for x in range(MAXITER):
-    t_meas0 = time()
-    flow_meas = fss.get_measurement()
-    t_meas1 = time()
-    t_meas = 0.5*(t_meas0+t_meas1) - tfile
-    print(f"{t_meas:8.3f}\t{flow_meas}")
-    fout.write(f"{t_meas:.3f}\t{flow_meas}\n")
-    sleep(Tsleep)
-    fout.flush()
-
-fout.close()    
+# text layout: original two columns for a single polled sensor
+wide = gridtable or continuous or (Nsens > 1)
+
+if outformat == 'hdf5':
+    h5out = HDF5Writer(outpath, fsss, tfstr_full,
+                       grid_period = None if continuous else Tsleep)
+    fout = None
+else:
+    h5out = None
+    fout = open(outpath, 'w')
+    fout.write('t0_abs_time_iso\t')
+    fout.write(tfstr_full)
+    fout.write('\n')
+    if wide:
+        for k, fss in enumerate(fsss):
+            fout.write(f'sensor_{k}\t{fss.name}\n')
+
+def flush_output():
+    # text output: every sample is on disk at once (as before), HDF5 output
+    # is written in chunks every Tflush seconds
+    global t_flush
+    if h5out is None:
+        fout.flush()
+    elif timing.clock() >= t_flush:
+        h5out.flush()
+        t_flush += Tflush
+
+t_flush = timing.clock() + Tflush
+if continuous:
+    if fout is not None:
+        fout.write('sensor\ttime(s)\tflow(nlmin)\n')
+    bufs = [fss.start_acquisition() for fss in fsss]
+    sampler = timing.DeadlineSampler(Tsleep, MAXITER, t0 = t0 + Tsleep)
+    for x, t_slot, jitter in sampler:
+        for k, (fss, buf) in enumerate(zip(fsss, bufs)):
+            t_offset = fss.acq_t0_abs - tfile
+            t_samp, flow_samp = buf.read_new()
+            if liveview:
+                view.push(k, t_samp + t_offset, flow_samp)
+            if h5out is not None:
+                h5out.append(k, t_samp + t_offset, flow_samp)
+            else:
+                for t_meas, flow_meas in zip(t_samp + t_offset, flow_samp):
+                    fout.write(f"{k}\t{t_meas:.3f}\t{flow_meas:.2f}\n")
+            if len(t_samp) > 0:
+                print(f"{k}\t{t_samp[-1]+t_offset:8.3f}\t{flow_samp[-1]:.2f}", end='')
+            stats = fss.acquisition_stats()
+            print(f"\t({stats['rate']:.1f} Hz, {stats['dropped']} dropped,"
+                  f" {stats['overwritten']} overwritten)")
+        flush_output()
+    for fss in fsss:
+        fss.stop_acquisition()
+else:
+    if (fout is not None) and wide:
+        fout.write('time(s)\tjitter(ms)\tmissed\t')
+        fout.write('\t'.join(f'time_{k}(s)\tflow_{k}(nlmin)'
+                             for k in range(Nsens)))
+        fout.write('\n')
+    elif fout is not None:
+        fout.write('time(s)\tflow(nlmin)\n')
+    sampler = timing.DeadlineSampler(Tsleep, MAXITER, t0 = t0)
+    for x, t_slot, jitter in sampler:
+        missed = (jitter is None)
+        if missed:
+            # no time for this slot, keep the row to keep the grid complete
+            samples = [(np.nan, np.nan)] * Nsens
+            jitter_ms = np.nan
+        else:
+            replies = list(pool.map(measure, fsss))
+            samples = [(t_meas, parse_flow(reply))
+                       for t_meas, reply in replies]
+            jitter_ms = 1e3 * jitter
+        row = f"{t_slot-t0:.3f}\t{jitter_ms:.3f}\t{int(missed)}\t"
+        row += '\t'.join(f"{t_meas-tfile:.3f}\t{flow_meas:.2f}"
+                         for t_meas, flow_meas in samples)
+        print(row)
+        if liveview and not missed:
+            for k, (t_meas, flow_meas) in enumerate(samples):
+                view.push(k, t_meas-tfile, flow_meas)
+        if h5out is not None:
+            h5out.append_grid(t_slot-t0, jitter, missed)
+            for k, (t_meas, flow_meas) in enumerate(samples):
+                h5out.append(k, t_meas-tfile, flow_meas)
+        elif wide:
+            fout.write(row + '\n')
+        elif not missed:
+            # the reply as it came, as before (e.g. None if none)
+            t_meas, reply = replies[0]
+            fout.write(f"{t_meas-tfile:.3f}\t{reply}\n")
+        flush_output()
+
+if h5out is not None:
+    h5out.close()
+else:
+    fout.close()    
     
-fss.close()
+for fss in fsss:
+    fss.close()
+pool.shutdown()
+
+if liveview:
+    view.close() # the plot window stays open
+
+print(timing.report())
+stats = sampler.stats()
+print(f"sampling: {stats['slots']} slots, {stats['missed']} missed, jitter"
+      f" mean {stats['jitter_mean_ms']:.2f} ms, p99 {stats['jitter_p99_ms']:.2f} ms,"
+      f" max {stats['jitter_max_ms']:.2f} ms")
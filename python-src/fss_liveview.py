@@ -0,0 +1,401 @@
+"""
+Live flow plot for the MOLTECH-FSS flow recorder
+
+The viewer runs in its own process, so that plotting never blocks the
+recorder loop. The recorder sends its samples with `LiveViewFeed.push()`,
+which only appends them to a queue; a background thread writes them to the
+viewer's stdin (fixed-size binary records). When the viewer can not keep
+up, samples for the viewer (not for the recording!) are dropped.
+
+The viewer keeps the entire history in fixed memory, in a `MinMaxPyramid`
+per sensor: a ring buffer of the last raw samples, and ring buffers of the
+min/max of blocks of 8, 64, 512, ... samples. Each redraw takes the finest
+level that covers the visible time range with at most one point per pixel,
+so the redraw time does not depend on the length of the run (millions of
+points). The min/max envelope keeps short spikes visible. Alternatively,
+`mode = 'lttb'` uses Largest-Triangle-Three-Buckets decimation of the raw
+samples, when these cover the visible range.
+
+The plot follows the whole history. After zooming or panning, it shows the
+selected range (at the resolution available for that range); double-click
+to follow the whole history again.
+
+Uses pyqtgraph (and numba, if available, for LTTB).
+
+EXPERIMENTAL: the viewer has been run with PyQt5 5.15 and pyqtgraph 0.14
+on an offscreen Qt platform only (--demo, and started by the recorder on
+the simulated sensor, devcomms.simulators.FSSSim), not yet on a desktop
+with a real sensor. If the viewer can not start (e.g. pyqtgraph missing),
+it exits, and the recorder goes on recording without live view.
+
+    python fss_liveview.py --demo        synthetic data, 1 week at 30 Hz
+"""
+
+import sys
+import importlib.util
+import threading
+import subprocess
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# one record per sample: sensor number, time (s), flow (nl/min; NaN if none)
+RECORD = np.dtype([('k', '<f8'), ('t', '<f8'), ('flow', '<f8')])
+
+
+
+def _lttb_indices(x, y, nout):
+    # Largest-Triangle-Three-Buckets: index of the selected point in each
+    # bucket (first and last points always selected)
+    n = len(x)
+    sel = np.zeros(nout, dtype=np.int64)
+    every = (n - 2) / (nout - 2)
+    a = 0
+    for i in range(nout - 2):
+        # average of next bucket (the last point, for the last bucket)
+        j0 = int((i + 1) * every) + 1
+        j1 = min(int((i + 2) * every) + 1, n)
+        if j1 <= j0:
+            j0 = n - 1
+            j1 = n
+        avg_x = x[j0:j1].mean()
+        avg_y = y[j0:j1].mean()
+        # point of current bucket making the largest triangle
+        k0 = int(i * every) + 1
+        k1 = int((i + 1) * every) + 1
+        area = np.abs((x[a] - avg_x) * (y[k0:k1] - y[a])
+                      - (x[a] - x[k0:k1]) * (avg_y - y[a]))
+        a = k0 + np.argmax(area)
+        sel[i + 1] = a
+    sel[nout - 1] = n - 1
+    return sel
+
+if njit is not None:
+    _lttb_indices = njit(cache=True)(_lttb_indices)
+
+
+def lttb(x, y, nout):
+    """Decimate (x, y) to `nout` points (LTTB), NaNs are left out"""
+    ok = np.isfinite(y)
+    x = np.ascontiguousarray(x[ok], dtype=np.float64)
+    y = np.ascontiguousarray(y[ok], dtype=np.float64)
+    if len(x) <= nout or nout < 3:
+        return x, y
+    sel = _lttb_indices(x, y, nout)
+    return x[sel], y[sel]
+
+
+
+class MinMaxPyramid:
+    """Bounded-memory history of (t, y) at several resolutions
+
+    Level 0 is a ring buffer of the last `size` samples. Level j is a ring
+    buffer of `size` blocks of factor**j samples: (time of first sample,
+    min, max). Memory is fixed, while the top level covers
+    size * factor**levels samples."""
+    def __init__(self, size=100000, factor=8, levels=6):
+        self.size = size
+        self.factor = factor
+        self.nlev = levels + 1
+        self.t = np.zeros((self.nlev, size))
+        self.ymin = np.zeros((self.nlev, size))
+        self.ymax = np.zeros((self.nlev, size))
+        self.n = [0] * self.nlev # entries written to each level
+        # inputs of the incomplete block of each level (t, min, max)
+        empty = np.zeros(0)
+        self.pending = [(empty, empty, empty)] * self.nlev
+
+    def push(self, t, y):
+        """Add samples (single values or arrays)"""
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        self._write(0, t, y, y)
+        ymin = ymax = y
+        F = self.factor
+        for j in range(1, self.nlev):
+            pt, pmin, pmax = self.pending[j]
+            pt = np.concatenate((pt, t))
+            pmin = np.concatenate((pmin, ymin))
+            pmax = np.concatenate((pmax, ymax))
+            nb = len(pt) // F
+            self.pending[j] = (pt[nb*F:], pmin[nb*F:], pmax[nb*F:])
+            if nb == 0:
+                break
+            t = pt[:nb*F:F]
+            # fmin/fmax: NaN (missing sample) only if the whole block is NaN
+            ymin = np.fmin.reduce(pmin[:nb*F].reshape(nb, F), axis=1)
+            ymax = np.fmax.reduce(pmax[:nb*F].reshape(nb, F), axis=1)
+            self._write(j, t, ymin, ymax)
+
+    def _write(self, j, t, ymin, ymax):
+        m = len(t)
+        if m > self.size:
+            self.n[j] += m - self.size
+            t, ymin, ymax = t[-self.size:], ymin[-self.size:], ymax[-self.size:]
+            m = self.size
+        idx = (self.n[j] + np.arange(m)) % self.size
+        self.t[j, idx] = t
+        self.ymin[j, idx] = ymin
+        self.ymax[j, idx] = ymax
+        self.n[j] += m
+
+    def level(self, j):
+        """Contents of level j, oldest first: (t, ymin, ymax)"""
+        m = min(self.n[j], self.size)
+        idx = (self.n[j] - m + np.arange(m)) % self.size
+        return self.t[j, idx], self.ymin[j, idx], self.ymax[j, idx]
+
+    def trange(self):
+        """(first, last) time of the history, None if empty"""
+        if self.n[0] == 0:
+            return None
+        j = max(j for j in range(self.nlev) if self.n[j] > 0)
+        i_first = (self.n[j] - min(self.n[j], self.size)) % self.size
+        return self.t[j, i_first], self.t[0, (self.n[0] - 1) % self.size]
+
+    def view(self, tmin, tmax, npts, mode='minmax'):
+        """Points to plot for the time range [tmin, tmax]: (t, y, level)
+
+        At most about `npts` blocks (min/max envelope: 2 points per block)."""
+        for j in range(self.nlev):
+            if self.n[j] == 0:
+                break
+            t, lo, hi = self.level(j)
+            # does this level still hold the start of the range?
+            if (t[0] > tmin) and (self.n[j] > self.size) \
+                    and (j < self.nlev - 1) and (self.n[j+1] > 0):
+                continue
+            i0 = max(0, np.searchsorted(t, tmin) - 1)
+            i1 = min(len(t), np.searchsorted(t, tmax, 'right') + 1)
+            if j == 0 and mode == 'lttb':
+                tt, yy = lttb(t[i0:i1], lo[i0:i1], npts)
+                return tt, yy, 0
+            if (i1 - i0 <= npts) or (j == self.nlev - 1) or (self.n[j+1] == 0):
+                if j == 0:
+                    return t[i0:i1], lo[i0:i1], 0
+                # min/max envelope, as a zigzag line
+                tt = np.repeat(t[i0:i1], 2)
+                yy = np.empty(len(tt))
+                yy[0::2] = lo[i0:i1]
+                yy[1::2] = hi[i0:i1]
+                return tt, yy, j
+        return np.zeros(0), np.zeros(0), 0
+
+
+
+class LiveViewFeed:
+    """Recorder side: starts the viewer process and sends samples to it
+
+    `push()` never blocks: samples are queued, and written to the viewer by
+    a background thread. The viewer window stays open after `close()`."""
+    def __init__(self, names, mode='minmax', maxpending=10000):
+        self.proc = subprocess.Popen([sys.executable, __file__,
+                                      '--stdin', '--mode', mode, '--names']
+                                     + list(names),
+                                     stdin=subprocess.PIPE)
+        self.pending = deque()
+        self.maxpending = maxpending
+        self.ndropped = 0
+        self.closed = False
+        self.cv = threading.Condition()
+        self.thread = threading.Thread(target=self._writer,
+                                       name='LiveViewFeed', daemon=True)
+        self.thread.start()
+
+    def push(self, k, t, flow):
+        # sensor k; t and flow: single values or arrays (None: no sample)
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        rec = np.empty(len(t), dtype=RECORD)
+        rec['k'] = k
+        rec['t'] = t
+        if flow is None:
+            flow = np.nan
+        elif np.isscalar(flow):
+            try:
+                flow = float(flow) # reply string of get_measurement()
+            except ValueError:
+                flow = np.nan
+        rec['flow'] = flow
+        with self.cv:
+            if len(self.pending) >= self.maxpending:
+                self.ndropped += len(rec)
+                return
+            self.pending.append(rec)
+            self.cv.notify()
+
+    def _writer(self):
+        while True:
+            with self.cv:
+                while not self.pending and not self.closed:
+                    self.cv.wait()
+                recs = list(self.pending)
+                self.pending.clear()
+                closed = self.closed
+            try:
+                if recs:
+                    self.proc.stdin.write(b''.join(r.tobytes() for r in recs))
+                    self.proc.stdin.flush()
+                if closed:
+                    self.proc.stdin.close()
+                    return
+            except OSError:
+                # viewer window was closed
+                with self.cv:
+                    self.closed = True
+                    self.pending.clear()
+                return
+
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify()
+        self.thread.join()
+
+
+
+class _StreamSource:
+    # viewer side: records from the recorder, read by a background thread
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = deque()
+        self.thread = threading.Thread(target=self._reader, daemon=True)
+        self.thread.start()
+
+    def _reader(self):
+        rest = b''
+        while True:
+            data = self.stream.read1(65536)
+            if not data:
+                return # end of recording
+            data = rest + data
+            nrec = len(data) // RECORD.itemsize
+            rest = data[nrec*RECORD.itemsize:]
+            self.chunks.append(np.frombuffer(data[:nrec*RECORD.itemsize],
+                                             dtype=RECORD))
+
+    def drain(self):
+        recs = []
+        while self.chunks:
+            recs.append(self.chunks.popleft())
+        return np.concatenate(recs) if recs else np.zeros(0, dtype=RECORD)
+
+
+
+class _DemoSource:
+    # synthetic flow at 30 Hz, one week of data in about a minute
+    def __init__(self, nsens=2, rate=30., per_call=200000):
+        self.nsens = nsens
+        self.rate = rate
+        self.per_call = per_call
+        self.i = 0
+
+    def drain(self):
+        t = (self.i + np.arange(self.per_call)) / self.rate
+        self.i += self.per_call
+        recs = np.empty(self.nsens * self.per_call, dtype=RECORD)
+        for k in range(self.nsens):
+            r = recs[k*self.per_call:(k+1)*self.per_call]
+            r['k'] = k
+            r['t'] = t
+            r['flow'] = (250. + 50.*np.sin(2*np.pi*t/86400.) + 20.*k
+                         + np.random.normal(0, 2., len(t)))
+            r['flow'][np.random.random(len(t)) < 1e-5] += 200. # spikes
+        return recs
+
+
+
+def run_viewer(source, names, mode='minmax', fps=5.):
+    import pyqtgraph as pg
+
+    pg.mkQApp('MOLTECH-FSS live view')
+    win = pg.GraphicsLayoutWidget(show=True, title='MOLTECH-FSS live view')
+    win.resize(1000, 500)
+    plot = win.addPlot()
+    plot.setLabel('bottom', 'time (s)')
+    plot.setLabel('left', 'flow (nl/min)')
+    plot.showGrid(x=True, y=True)
+    plot.addLegend()
+    plot.enableAutoRange(axis='y')
+    win.nextRow()
+    status = win.addLabel(justify='left')
+
+    pyramids = [MinMaxPyramid() for name in names]
+    curves = [plot.plot(pen=(k, len(names)), name=name, connect='finite')
+              for k, name in enumerate(names)]
+    nsamples = [0] * len(names)
+
+    follow = [True] # show whole history, until the user zooms/pans
+    def stop_following(*args):
+        follow[0] = False
+    def mouse_clicked(ev):
+        if ev.double():
+            follow[0] = True
+    plot.vb.sigRangeChangedManually.connect(stop_following)
+    plot.scene().sigMouseClicked.connect(mouse_clicked)
+
+    def update():
+        t0 = perf_counter()
+        recs = source.drain()
+        for k, pyr in enumerate(pyramids):
+            rk = recs[recs['k'] == k]
+            if len(rk) > 0:
+                pyr.push(rk['t'], rk['flow'])
+                nsamples[k] += len(rk)
+        t1 = perf_counter()
+        tranges = [pyr.trange() for pyr in pyramids]
+        tranges = [tr for tr in tranges if tr is not None]
+        if not tranges:
+            return
+        if follow[0]:
+            tmin = min(tr[0] for tr in tranges)
+            tmax = max(tr[1] for tr in tranges)
+            plot.setXRange(tmin, tmax, padding=0.02)
+        else:
+            tmin, tmax = plot.vb.viewRange()[0]
+        npts = max(100, int(plot.vb.width()))
+        levels = []
+        for pyr, curve in zip(pyramids, curves):
+            t, y, j = pyr.view(tmin, tmax, npts, mode)
+            curve.setData(t, y)
+            levels.append(j)
+        t2 = perf_counter()
+        status.setText(f'{sum(nsamples)} samples, level {max(levels)},'
+                       f' ingest {1e3*(t1-t0):.1f} ms,'
+                       f' redraw {1e3*(t2-t1):.1f} ms')
+
+    timer = pg.QtCore.QTimer()
+    timer.timeout.connect(update)
+    timer.start(int(1000 / fps))
+    pg.exec()
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='MOLTECH-FSS live flow plot')
+    parser.add_argument('--stdin', action='store_true',
+                        help='read samples from stdin (started by recorder)')
+    parser.add_argument('--demo', action='store_true',
+                        help='synthetic data')
+    parser.add_argument('--mode', default='minmax', choices=['minmax', 'lttb'])
+    parser.add_argument('--names', nargs='*', default=None)
+    args = parser.parse_args()
+    if importlib.util.find_spec('pyqtgraph') is None:
+        # run_viewer needs it (LiveViewFeed does not)
+        sys.exit('fss_liveview: the viewer needs pyqtgraph')
+    if args.stdin:
+        source = _StreamSource(sys.stdin.buffer)
+        names = args.names
+    elif args.demo:
+        source = _DemoSource()
+        names = [f'demo sensor {k}' for k in range(source.nsens)]
+    else:
+        parser.error('either --stdin or --demo')
+    run_viewer(source, names, args.mode)
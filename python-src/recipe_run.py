@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Run a multi-device recipe (JSON or YAML, see devcomms/recipe.py)
+
+    python recipe_run.py recipes/inject-example.json
+    python recipe_run.py recipes/inject-example.json --check   (only check)
+    python recipe_run.py recipes/inject-example.json --sim     (simulators)
+
+The recipe is compiled and checked before any device is opened. The devices
+are opened all at the same time (devcomms.startup). The readiness timeline
+of the devices, and every event with its planned time, lateness and
+completion time, are logged in recipe_log_<date>_<time>.txt, with a timing
+report per cycle.
+"""
+
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from devcomms.recipe import load_recipe, compile_recipe, RecipeRunner
+from devcomms.timing import wall_time
+
+
+
+def isostamp(t):
+    return datetime.fromtimestamp(wall_time(t)).isoformat()
+
+
+def simulate(recipe):
+    # replace the ports of the recipe by device simulators
+    from devcomms.simulators import AladdinSim, VICITTLSim, VICIEUHASim,\
+        FLSHSim
+    sims = {}
+    for name, dev in recipe['devices'].items():
+        sim = sims.get(dev['port'])
+        if sim is None:
+            if dev['kind'] == 'aladdin':
+                ids = [d['id'] for d in recipe['devices'].values()
+                       if d['port'] == dev['port']]
+                sim = AladdinSim(pump_ids = ids)
+            else:
+                sim = {'vici_ttl': VICITTLSim, 'vici_euha': VICIEUHASim,
+                       'flsh': FLSHSim}[dev['kind']]()
+            sims[dev['port']] = sim.start()
+    for dev in recipe['devices'].values():
+        dev['port'] = sims[dev['port']].port
+    return list(sims.values())
+
+
+def run(recipe, logfname):
+    timeline = compile_recipe(recipe)
+    print(timeline.summary())
+    logfile = open(logfname, 'w')
+    logfile.write('# time\tcycle\tdevice\tcommand\tplanned\tlateness (ms)\t'
+                  'done (ms after planned)\terror\n')
+
+    def log(line):
+        print(line)
+        logfile.write('# '+line+'\n')
+        logfile.flush()
+
+    def log_event(ev, rec):
+        planned, actual, done, error = rec
+        logfile.write('{0:s}\t{1:d}\t{2:s}\t{3:s}{4!r}\t{5:s}\t{6:.3f}\t'
+                      '{7:.1f}\t{8:s}\n'.format(isostamp(actual), ev.cycle,
+                        ev.device, ev.method, ev.args, isostamp(planned),
+                        1e3*(actual-planned), 1e3*(done-planned),
+                        '' if error is None else repr(error)))
+
+    runner = RecipeRunner(timeline, log, log_event)
+    print('opening devices')
+    try:
+        try:
+            runner.open()
+        finally:
+            # readiness timeline of the devices, also when one failed
+            if runner.readiness is not None:
+                for line in runner.readiness.report().split('\n'):
+                    log(line)
+        runner.start()
+        print('running, end at', isostamp(runner.t0 + timeline.duration()))
+        # (wait in steps, so that Ctrl-C works)
+        while not runner.wait(0.5):
+            pass
+        print('done')
+    except IOError as ex:
+        log(str(ex))
+    except KeyboardInterrupt:
+        log('interrupted')
+    finally:
+        runner.close()
+        logfile.close()
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a multi-device recipe')
+    parser.add_argument('recipe', help='recipe file (.json, .yaml)')
+    parser.add_argument('--check', action='store_true',
+                        help='only compile and check the recipe')
+    parser.add_argument('--sim', action='store_true',
+                        help='use device simulators instead of the ports')
+    args = parser.parse_args()
+
+    recipe = load_recipe(args.recipe)
+    t = perf_counter()
+    try:
+        timeline = compile_recipe(recipe)
+    except ValueError as ex:
+        print(ex)
+        sys.exit(1)
+    print('compiled and checked in {0:.1f} ms'.format(1e3*(perf_counter()-t)))
+    if args.check:
+        print(timeline.summary())
+        sys.exit(0)
+
+    sims = simulate(recipe) if args.sim else []
+    logfname = 'recipe_log_'+datetime.now().strftime('%y%m%d_%H%M%S')+'.txt'
+    try:
+        run(recipe, logfname)
+    finally:
+        for sim in sims:
+            sim.stop()
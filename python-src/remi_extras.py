@@ -8,13 +8,26 @@ Extra widgets, routines etc. to work with REMI
 @author: Martinus Werts
 """
 
+import json
+from collections import deque
+
 from remi.gui import TextInput
 
 class LineWriterBox(TextInput):
+    """
+    Text box showing the last `maxlines` lines written with writeln()
+
+    With autoflush = False, writeln() only stores the line, and the widget is
+    updated by flush(), to be called once per UI update (e.g. at the end of
+    App.idle) so that a burst of lines gives one update. flush(app) only
+    sends the new lines to the browsers (a small javascript adding them to
+    the text area), not the whole text.
+    """
     def __init__(self, *args,
                  initlines = [],
                  maxlines = 50,
                  reverse_out = False,
+                 autoflush = True,
                  **kwargs):
         # kwargs override
         kwargs.update(single_line = False)
@@ -26,22 +39,53 @@ class LineWriterBox(TextInput):
         # for now just use inverted writeln (new lines added to top)
         self.maxlines = maxlines
         self.reverse_out = reverse_out
-        self.lines = []
+        self.autoflush = autoflush
+        self.lines = deque(maxlen = maxlines)
+        self.nnew = 0 # lines not yet flushed
         for line in initlines:
             self.writeln(line)
+        self.flush()
             
     def writeln(self, line):
         self.lines.append(line)
-        while len(self.lines) > self.maxlines:
-            self.lines.pop(0)
-        outstr = ''
+        self.nnew += 1
+        if self.autoflush:
+            self.flush()
+
+    def outstr(self, lines = None):
+        if lines is None:
+            lines = self.lines
         if self.reverse_out:
-            outlines = self.lines[-1::-1]
-        else:
-            outlines = self.lines
-        for line in outlines:
-            outstr += line+'\n'
-        self.set_text(outstr)
-        
-    
+            lines = reversed(lines)
+        return ''.join(line+'\n' for line in lines)
 
+    def flush(self, app = None):
+        """Show the new lines. With `app`, only send the new lines."""
+        if self.nnew == 0:
+            return
+        nnew = min(self.nnew, len(self.lines))
+        self.nnew = 0
+        if (app is None) or self._ischanged():
+            self.set_text(self.outstr())
+            return
+        # browsers: add the new lines to the text area
+        new = self.outstr(list(self.lines)[-nnew:])
+        if self.reverse_out:
+            js = "v=n+e.value; l=v.split('\\n'); if(l.length>m+1) v=l.slice(0,m).join('\\n')+'\\n';"
+        else:
+            js = "v=e.value+n; l=v.split('\\n'); if(l.length>m+1) v=l.slice(-m-1).join('\\n');"
+        app.execute_javascript(
+            "(function(){var e=document.getElementById('%s'); if(!e) return;"
+            " var n=%s, m=%d, v, l; %s e.value=v;})();"\
+            % (self.identifier, json.dumps(new), self.maxlines, js))
+        # widget: update without sending it again, and patch the cached html
+        # of the parents (for pages loaded later)
+        old = self._backup_repr
+        self.disable_refresh()
+        self.set_text(self.outstr())
+        new = self.repr({})
+        self.enable_refresh()
+        parent = self.get_parent()
+        while hasattr(parent, '_backup_repr'):
+            parent._backup_repr = parent._backup_repr.replace(old, new, 1)
+            parent = parent.get_parent()